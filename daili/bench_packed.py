@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+"""
+代理候选去重基准测试 - 对比 list(set(...)) 与 PackedProxySet 的内存占用和去重耗时
+"""
+
+import sys
+import gc
+import time
+import random
+import argparse
+import tracemalloc
+
+from daili import PackedProxySet
+
+
+def generate_entries(count, duplicate_ratio=0.4, plain_ratio=0.95, seed=7):
+    """生成多源聚合后的候选条目（含重复、少量域名/认证条目）"""
+    rng = random.Random(seed)
+    unique_count = max(1, int(count * (1 - duplicate_ratio)))
+    seeds = [rng.getrandbits(48) for _ in range(unique_count)]
+
+    for i in range(count):
+        value = seeds[i] if i < unique_count else seeds[rng.randrange(unique_count)]
+        ip = (value >> 16) & 0xFFFFFFFF
+        port = (value & 0xFFFF) or 1
+        host = f"{ip >> 24}.{(ip >> 16) & 255}.{(ip >> 8) & 255}.{ip & 255}"
+        if (value % 1000) / 1000 < plain_ratio:
+            yield f"{host}:{port}"
+        elif value % 2:
+            yield f"user{value % 50}:pass@{host}:{port}"
+        else:
+            yield f"proxy{value % 100000}.example.com:{port}"
+
+
+def build_with_set(entries):
+    """原有方式: list(set(...))"""
+    return list(set(entries))
+
+
+def build_packed(entries):
+    """打包方式: PackedProxySet + 排序去重"""
+    packed = PackedProxySet(entries)
+    packed.dedupe()
+    return packed
+
+
+def measure_memory(builder, count):
+    """返回 (构建后常驻字节, 峰值字节)，输入条目由生成器即时产生"""
+    gc.collect()
+    tracemalloc.start()
+    container = builder(generate_entries(count))
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del container
+    return current, peak
+
+
+def measure_time(builder, entries):
+    """返回 (容器, 耗时秒)"""
+    gc.collect()
+    start = time.perf_counter()
+    container = builder(entries)
+    return container, time.perf_counter() - start
+
+
+def measure_lookups(container, probes):
+    """成员检查耗时（秒）"""
+    start = time.perf_counter()
+    hits = sum(1 for probe in probes if probe in container)
+    return time.perf_counter() - start, hits
+
+
+def main():
+    parser = argparse.ArgumentParser(description="代理候选去重基准测试")
+    parser.add_argument("--entries", type=int, default=2_000_000, help="聚合后的候选条目数")
+    parser.add_argument("--lookups", type=int, default=200_000, help="成员检查次数")
+    args = parser.parse_args()
+
+    mb = 1024 * 1024
+    print(f"\n🧪🧪🧪🧪 候选条目: {args.entries:,} (约40%重复, 95%为纯IPv4)")
+
+    set_current, set_peak = measure_memory(build_with_set, args.entries)
+    packed_current, packed_peak = measure_memory(build_packed, args.entries)
+
+    entries = list(generate_entries(args.entries))
+    unique_list, set_time = measure_time(build_with_set, entries)
+    packed, packed_time = measure_time(build_packed, entries)
+
+    probes = random.Random(1).sample(entries, min(args.lookups, len(entries)))
+    # 原有代码在列表上去重后没有索引，成员检查只能再建一次set
+    lookup_set = set(unique_list)
+    set_lookup_time, set_hits = measure_lookups(lookup_set, probes)
+    packed_lookup_time, packed_hits = measure_lookups(packed, probes)
+
+    print("\n" + "="*72)
+    print(f"{'方式':16s} {'去重后':>10s} {'常驻内存':>10s} {'峰值内存':>10s} {'去重耗时':>10s} {'查找耗时':>10s}")
+    print("-"*72)
+    print(f"{'list(set(...))':16s} {len(unique_list):10,d} {set_current / mb:9.1f}M {set_peak / mb:9.1f}M "
+          f"{set_time:9.2f}s {set_lookup_time:9.3f}s")
+    print(f"{'PackedProxySet':16s} {len(packed):10,d} {packed_current / mb:9.1f}M {packed_peak / mb:9.1f}M "
+          f"{packed_time:9.2f}s {packed_lookup_time:9.3f}s")
+    print("-"*72)
+    print(f"📦📦📦📦 打包区: {packed.memory_bytes() / mb:.1f}MB | 常驻内存节省 {set_current / max(packed_current, 1):.1f}x")
+    print(f"📊📊📊📊 查找命中: set {set_hits:,} / packed {packed_hits:,}")
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+"""
+代理列表解析基准测试 - 对比逐行clean_and_validate_proxy与单遍parse_proxy_blob
+"""
+
+import sys
+import time
+import random
+import argparse
+import re
+from collections import Counter
+
+from daili import GitHubProxyTester, parse_proxy_blob
+
+
+PORT_SUFFIX_RE = re.compile(r':\d+$')
+
+
+def generate_lines(count, seed=42):
+    """生成混合格式的合成代理列表（与真实下载源的格式分布接近）"""
+    rng = random.Random(seed)
+    lines = []
+
+    for i in range(count):
+        ip = f"{rng.randint(1, 223)}.{rng.randint(0, 255)}.{rng.randint(0, 255)}.{rng.randint(1, 254)}"
+        port = rng.randint(1, 65535)
+        kind = rng.random()
+
+        if kind < 0.70:
+            lines.append(f"{ip}:{port}")
+        elif kind < 0.80:
+            scheme = rng.choice(['http', 'https', 'socks4', 'socks5'])
+            lines.append(f"{scheme}://{ip}:{port}")
+        elif kind < 0.85:
+            lines.append(f"user{i % 97}:pass{i % 13}@{ip}:{port}")
+        elif kind < 0.90:
+            lines.append(f"socks5://{ip}:{port}/#{rng.uniform(50, 5000):.1f}ms%20tel")
+        elif kind < 0.95:
+            lines.append(rng.choice(["# 注释行", "// comment", ""]))
+        else:
+            lines.append(rng.choice([f"{ip}", f"{ip}:{port} US", "garbage line", f"{ip}:99999"]))
+
+    return "\n".join(lines)
+
+
+def parse_per_line(tester, text):
+    """原有路径: 逐行strip、跳过注释，再调用clean_and_validate_proxy"""
+    proxies = []
+    for line in text.splitlines():
+        line = line.strip()
+        if not line or line.startswith('#') or line.startswith('//'):
+            continue
+        proxy = tester.clean_and_validate_proxy(line)
+        if proxy:
+            proxies.append(proxy)
+    return proxies
+
+
+def timed(func, *args):
+    """执行并返回 (结果, 耗时秒)"""
+    start = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description="代理列表解析基准测试")
+    parser.add_argument("--lines", type=int, default=1_000_000, help="合成列表行数")
+    args = parser.parse_args()
+
+    tester = GitHubProxyTester(use_store=False)
+
+    print(f"\n🧪🧪🧪🧪 生成 {args.lines:,} 行合成代理列表...")
+    text = generate_lines(args.lines)
+    print(f"📦📦📦📦 文本大小: {len(text) / 1024 / 1024:.1f}MB")
+
+    old_result, old_time = timed(parse_per_line, tester, text)
+    new_result, new_time = timed(parse_proxy_blob, text)
+
+    print("\n" + "="*60)
+    print(f"{'解析方式':20s} {'耗时':>10s} {'行/秒':>14s} {'有效代理':>10s}")
+    print("-"*60)
+    print(f"{'逐行clean_and_validate':20s} {old_time:9.2f}s {args.lines / old_time:14,.0f} {len(old_result):10,d}")
+    print(f"{'单遍parse_proxy_blob':20s} {new_time:9.2f}s {args.lines / new_time:14,.0f} {len(new_result):10,d}")
+    print("-"*60)
+    print(f"🚀🚀🚀🚀 加速比: {old_time / new_time:.1f}x")
+
+    # 原有路径会把没有端口的裸主机也当作代理返回，单遍解析器直接丢弃
+    old_with_port = Counter(proxy for proxy in old_result if PORT_SUFFIX_RE.search(proxy))
+    new_counter = Counter(new_result)
+    same = sum((old_with_port & new_counter).values())
+    print(f"📊📊📊📊 结果一致: {same:,}/{len(new_result):,} 条 "
+          f"(原路径另有 {len(old_result) - sum(old_with_port.values()):,} 条无端口的裸主机)")
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,345 @@
+#!/usr/bin/env python3
+"""
+离线吞吐/延迟基准测试 - 本地模拟HTTP CONNECT、SOCKS4、SOCKS5代理与测试网站，
+不访问外网即可对比各测试引擎配置
+
+模拟器在子进程中运行（单个asyncio事件循环），每种协议只监听一个端口；
+代理地址使用127.a.b.c回环地址区分，模拟器通过连接的本地地址确定该代理的行为：
+  正常   - 握手应答前延迟 latency ± jitter 毫秒
+  drop   - 接受连接后立即关闭
+  reset  - 接受连接后发送RST
+  黑洞   - 接受连接但从不应答，直到客户端超时断开
+"""
+
+import os
+import sys
+import time
+import json
+import socket
+import struct
+import random
+import asyncio
+import hashlib
+import argparse
+import contextlib
+import multiprocessing
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+from daili import GitHubProxyTester, percentile
+
+
+# 测试引擎配置: 名称 -> (GitHubProxyTester参数, 测试方式)
+CONFIGS = {
+    'thread': ({'engine': 'thread'}, 'batch'),
+    'async': ({'engine': 'async'}, 'batch'),
+    'thread+tiered': ({'engine': 'thread', 'tiered': True}, 'tiered'),
+    'async+sweep': ({'engine': 'async', 'sweep': True}, 'sweep'),
+}
+
+# 协议 -> 模拟器监听端口的键
+PROTOCOL_PORTS = {'HTTP': 'http', 'SOCKS4': 'socks4', 'SOCKS5': 'socks5'}
+
+PAGE = b"<html><title>bench</title><body>localhost bench target</body></html>"
+
+
+def raise_fd_limit():
+    """把文件描述符软限制提到硬限制（大并发时每个探测要占用多个fd）"""
+    if resource is None:
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft != hard:
+        with contextlib.suppress(ValueError, OSError):
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+def proxy_address(index):
+    """第index个模拟代理的回环地址（127.1.0.0起，避开127.0.0.1上的目标网站）"""
+    return f"127.{1 + (index >> 16)}.{(index >> 8) & 255}.{index & 255}"
+
+
+def proxy_profile(ip, profile):
+    """根据地址确定该代理的行为，模拟器与统计预期结果共用同一函数"""
+    digest = hashlib.blake2b(f"{profile['seed']}:{ip}".encode(), digest_size=8).digest()
+    roll = int.from_bytes(digest, 'big') / 2 ** 64
+    for behavior in ('drop', 'reset', 'blackhole'):
+        if roll < profile[behavior]:
+            return behavior
+        roll -= profile[behavior]
+    return 'ok'
+
+
+class ProxySimulator:
+    """运行在子进程中的模拟代理与测试网站"""
+
+    def __init__(self, profile):
+        self.profile = profile
+        self.rng = random.Random(profile['seed'])
+        self.target_port = None
+
+    async def _delay(self):
+        latency = self.profile['latency'] + self.rng.gauss(0, self.profile['jitter'])
+        await asyncio.sleep(max(0, latency) / 1000)
+
+    async def _pipe(self, reader, writer):
+        try:
+            while True:
+                data = await reader.read(65536)
+                if not data:
+                    break
+                writer.write(data)
+                await writer.drain()
+        except (ConnectionError, OSError):
+            pass
+        finally:
+            writer.close()
+
+    async def _misbehave(self, reader, writer):
+        """按代理行为处理连接，返回True表示已经处理（不再正常应答）"""
+        ip = writer.get_extra_info('sockname')[0]
+        behavior = proxy_profile(ip, self.profile)
+        if behavior == 'ok':
+            return False
+
+        if behavior == 'reset':
+            sock = writer.get_extra_info('socket')
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack('ii', 1, 0))
+            writer.transport.abort()
+        elif behavior == 'drop':
+            writer.close()
+        else:
+            # 黑洞: 读到客户端断开为止，从不应答
+            with contextlib.suppress(ConnectionError, OSError):
+                while await reader.read(65536):
+                    pass
+            writer.close()
+        return True
+
+    async def _tunnel(self, reader, writer, host, port, reply, first_data=b""):
+        """连接目标并回复握手应答，之后双向转发"""
+        try:
+            target_reader, target_writer = await asyncio.open_connection(host, port)
+        except OSError:
+            writer.close()
+            return
+        await self._delay()
+        if reply:
+            writer.write(reply)
+        if first_data:
+            target_writer.write(first_data)
+        await asyncio.gather(self._pipe(reader, target_writer), self._pipe(target_reader, writer))
+
+    async def handle_http(self, reader, writer):
+        if await self._misbehave(reader, writer):
+            return
+        try:
+            head = await reader.readuntil(b"\r\n\r\n")
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+            writer.close()
+            return
+        method, target = head.split(b" ", 2)[:2]
+        if method == b"CONNECT":
+            host, port = target.decode().rsplit(":", 1)
+            await self._tunnel(reader, writer, host, int(port), b"HTTP/1.1 200 Connection established\r\n\r\n")
+        else:
+            # absolute-form请求: 原样转发给目标网站
+            await self._tunnel(reader, writer, '127.0.0.1', self.target_port, b"", first_data=head)
+
+    async def handle_socks4(self, reader, writer):
+        if await self._misbehave(reader, writer):
+            return
+        try:
+            header = await reader.readexactly(8)
+            while (await reader.readexactly(1)) != b"\0":
+                pass
+        except (asyncio.IncompleteReadError, ConnectionError):
+            writer.close()
+            return
+        port = struct.unpack(">H", header[2:4])[0]
+        host = socket.inet_ntoa(header[4:8])
+        await self._tunnel(reader, writer, host, port, b"\x00\x5a" + b"\0" * 6)
+
+    async def handle_socks5(self, reader, writer):
+        if await self._misbehave(reader, writer):
+            return
+        try:
+            greeting = await reader.readexactly(2)
+            await reader.readexactly(greeting[1])
+            writer.write(b"\x05\x00")
+            request = await reader.readexactly(4)
+            if request[3] == 1:
+                host = socket.inet_ntoa(await reader.readexactly(4))
+            elif request[3] == 3:
+                host = (await reader.readexactly((await reader.readexactly(1))[0])).decode()
+            else:
+                host = socket.inet_ntop(socket.AF_INET6, await reader.readexactly(16))
+            port = struct.unpack(">H", await reader.readexactly(2))[0]
+        except (asyncio.IncompleteReadError, ConnectionError):
+            writer.close()
+            return
+        await self._tunnel(reader, writer, host, port, b"\x05\x00\x00\x01" + b"\0" * 6)
+
+    async def handle_target(self, reader, writer):
+        try:
+            await reader.readuntil(b"\r\n\r\n")
+            writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: text/html\r\nContent-Length: %d\r\n"
+                         b"Connection: close\r\n\r\n" % len(PAGE) + PAGE)
+            await writer.drain()
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, conn):
+        target = await asyncio.start_server(self.handle_target, '127.0.0.1', 0, backlog=4096)
+        self.target_port = target.sockets[0].getsockname()[1]
+        ports = {'target': self.target_port}
+        servers = [target]
+        # 代理监听0.0.0.0才能接受发往任意127.a.b.c的连接，非回环来源直接拒绝
+        for name, handler in (('http', self.handle_http), ('socks4', self.handle_socks4),
+                              ('socks5', self.handle_socks5)):
+            server = await asyncio.start_server(self._loopback_only(handler), '0.0.0.0', 0, backlog=4096)
+            ports[name] = server.sockets[0].getsockname()[1]
+            servers.append(server)
+
+        conn.send(ports)
+        await asyncio.get_running_loop().run_in_executor(None, conn.recv)
+        for server in servers:
+            server.close()
+
+    def _loopback_only(self, handler):
+        async def guarded(reader, writer):
+            peer = writer.get_extra_info('peername')
+            if not peer or not peer[0].startswith('127.'):
+                writer.close()
+                return
+            await handler(reader, writer)
+        return guarded
+
+
+def run_simulator(profile, conn):
+    """子进程入口"""
+    raise_fd_limit()
+    asyncio.run(ProxySimulator(profile).serve(conn))
+
+
+@contextlib.contextmanager
+def simulator(profile):
+    """启动模拟器子进程，返回各监听端口"""
+    parent_conn, child_conn = multiprocessing.Pipe()
+    process = multiprocessing.Process(target=run_simulator, args=(profile, child_conn), daemon=True)
+    process.start()
+    try:
+        yield parent_conn.recv()
+    finally:
+        parent_conn.send('stop')
+        process.join(timeout=5)
+        if process.is_alive():
+            process.terminate()
+
+
+def run_config(name, size, proxy_type, ports, profile, args):
+    """用一种引擎配置测试size个模拟代理，返回一行统计"""
+    kwargs, mode = CONFIGS[name]
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        tester = GitHubProxyTester(use_store=False, async_concurrency=args.concurrency, **kwargs)
+    # 基准测试不写结果日志，也不打扰result/下的真实结果
+    tester.journal = None
+    tester.handshake_timeout = args.timeout
+    tester.sweep_timeout = min(tester.sweep_timeout, args.timeout)
+    tester._test_urls = [{
+        'url': f"http://127.0.0.1:{ports['target']}/",
+        'name': '本地目标',
+        'timeout': args.timeout,
+        'check_string': 'localhost',
+        'site_abbr': 'loc',
+    }]
+
+    port = ports[PROTOCOL_PORTS[proxy_type]]
+    proxies = [f"{proxy_address(i)}:{port}" for i in range(size)]
+    expected = sum(1 for i in range(size) if proxy_profile(proxy_address(i), profile) == 'ok')
+
+    start = time.perf_counter()
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        if mode == 'sweep':
+            candidates, rejected = tester.prepare_candidates(proxies, proxy_type)
+            all_results, successful = tester.batch_test_proxies(candidates, proxy_type, args.workers)
+            all_results = rejected + all_results
+        elif mode == 'tiered':
+            all_results, successful = tester.tiered_test_proxies(proxies, proxy_type, args.workers)
+        else:
+            all_results, successful = tester.batch_test_proxies(proxies, proxy_type, args.workers)
+    elapsed = time.perf_counter() - start
+
+    latencies = sorted(r['latency_ms'] for r in successful)
+    return {
+        'config': name,
+        'type': proxy_type,
+        'proxies': size,
+        'seconds': round(elapsed, 2),
+        'proxies_per_second': round(size / elapsed, 1),
+        'expected_ok': expected,
+        'successful': len(successful),
+        'results': len(all_results),
+        'p50_ms': round(percentile(latencies, 50), 1),
+        'p90_ms': round(percentile(latencies, 90), 1),
+        'p99_ms': round(percentile(latencies, 99), 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="离线代理测试基准（本地模拟代理与目标网站）")
+    parser.add_argument("--sizes", default="1000,10000,100000", help="代理数量，逗号分隔")
+    parser.add_argument("--configs", default=",".join(CONFIGS), help=f"引擎配置，可选: {', '.join(CONFIGS)}")
+    parser.add_argument("--types", default="SOCKS5", help="代理协议，可选: HTTP,SOCKS4,SOCKS5")
+    parser.add_argument("--workers", type=int, default=80, help="线程引擎的并发线程数")
+    parser.add_argument("--concurrency", type=int, default=500, help="asyncio引擎的并发上限")
+    parser.add_argument("--timeout", type=float, default=2, help="单次探测超时（秒）")
+    parser.add_argument("--latency", type=float, default=50, help="模拟代理的握手延迟（毫秒）")
+    parser.add_argument("--jitter", type=float, default=20, help="延迟抖动的标准差（毫秒）")
+    parser.add_argument("--drop", type=float, default=0.10, help="接受后立即关闭的代理比例")
+    parser.add_argument("--reset", type=float, default=0.10, help="接受后发送RST的代理比例")
+    parser.add_argument("--blackhole", type=float, default=0.05, help="从不应答的代理比例")
+    parser.add_argument("--seed", type=int, default=7, help="随机种子（相同种子结果可复现）")
+    parser.add_argument("--json", help="把结果另存为JSON文件")
+    args = parser.parse_args()
+
+    raise_fd_limit()
+    profile = {key: getattr(args, key) for key in ('latency', 'jitter', 'drop', 'reset', 'blackhole', 'seed')}
+    sizes = [int(size) for size in args.sizes.split(',') if size]
+    configs = [name for name in args.configs.split(',') if name]
+    proxy_types = [t.strip().upper() for t in args.types.split(',') if t.strip()]
+
+    print(f"\n🧪🧪🧪🧪 离线基准: 规模 {sizes} | 配置 {configs} | 协议 {proxy_types}")
+    print(f"📊📊📊📊 模拟代理: 延迟 {args.latency}±{args.jitter}ms | drop {args.drop:.0%} | "
+          f"reset {args.reset:.0%} | 黑洞 {args.blackhole:.0%} | 探测超时 {args.timeout}秒")
+
+    rows = []
+    with simulator(profile) as ports:
+        header = (f"{'配置':14s} {'协议':7s} {'代理数':>8s} {'耗时':>8s} {'个/秒':>8s} "
+                  f"{'成功/预期':>13s} {'P50':>7s} {'P90':>7s} {'P99':>7s}")
+        print("\n" + "="*len(header))
+        print(header)
+        print("-"*len(header))
+        for proxy_type in proxy_types:
+            for size in sizes:
+                for name in configs:
+                    row = run_config(name, size, proxy_type, ports, profile, args)
+                    rows.append(row)
+                    print(f"{name:14s} {proxy_type:7s} {size:8d} {row['seconds']:7.1f}s "
+                          f"{row['proxies_per_second']:8.1f} {row['successful']:6d}/{row['expected_ok']:<6d} "
+                          f"{row['p50_ms']:6.0f}ms {row['p90_ms']:6.0f}ms {row['p99_ms']:6.0f}ms", flush=True)
+
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump({'profile': profile, 'rows': rows}, f, ensure_ascii=False, indent=2)
+        print(f"\n💾💾💾💾 结果已保存: {args.json}")
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
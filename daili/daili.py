@@ -14,11 +14,1470 @@ from datetime import datetime
 from typing import List, Dict, Tuple, Optional
 import threading
 import re
-from urllib.parse import urlparse
+from urllib.parse import urlparse, urljoin
 import warnings
+import asyncio
+import ssl
+import base64
+import ipaddress
+import selectors
+import sqlite3
+import math
+import zlib
+import bisect
+from array import array
+import gzip
+import hashlib
+import errno
+import glob
+import multiprocessing
+import heapq
+import queue
+import tempfile
+from collections import deque, OrderedDict
 
-class GitHubProxyTester:
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+# 浏览器请求头（同步/异步测试引擎共用）
+DEFAULT_HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36',
+    'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8',
+    'Accept-Language': 'en-US,en;q=0.5',
+}
+
+# 代理类型对应的默认端口
+DEFAULT_PROXY_PORTS = {'http': 80, 'https': 443, 'socks4': 1080, 'socks5': 1080}
+
+REDIRECT_CODES = (301, 302, 303, 307, 308)
+
+# 代理行语法: [协议://][用户:密码@]主机:端口[/#延迟等附加信息]
+# 第1组是规范化后的代理本身，第2组是端口；注释行（# 或 //开头）、
+# 无端口或带其他说明文字的行都不会匹配
+PROXY_LINE_RE = re.compile(r"""
+    ^[ \t]*
+    (
+        (?:(?:https?|socks[45])://)?
+        (?:[^\s:@/#]+(?::[^\s@/#]+)?@)?
+        (?:\[[0-9A-Fa-f:.]+\]|[A-Za-z0-9][A-Za-z0-9.\-]*)
+        :(\d{1,5})
+    )
+    (?:[/#][^\r\n]*)?
+    [ \t]*\r?$
+""", re.MULTILINE | re.VERBOSE)
+
+
+def parse_proxy_blob(text):
+    """单遍解析整段文本，返回规范化后的代理列表
+    
+    与逐行调用clean_and_validate_proxy的结果一致：无协议头的保留
+    "[用户:密码@]主机:端口"，有协议头的保留协议，去掉"/#"之后的附加信息。
+    """
+    return [
+        proxy for proxy, port in PROXY_LINE_RE.findall(text)
+        if 0 < int(port) < 65536
+    ]
+
+
+def write_atomic(path, data):
+    """先写临时文件、fsync后再os.replace，读取方（如仓库根目录的daili.py）不会看到写了一半的文件
+    
+    临时文件名唯一（同目录下的NamedTemporaryFile），多个进程同时写同一路径互不干扰；
+    崩溃时原文件保持完整。
+    """
+    if isinstance(data, str):
+        data = data.encode('utf-8')
+    directory = os.path.dirname(os.path.abspath(path))
+    with tempfile.NamedTemporaryFile(dir=directory, prefix=f".{os.path.basename(path)}.",
+                                     suffix=".tmp", delete=False) as f:
+        tmp_path = f.name
+        try:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        except BaseException:
+            f.close()
+            os.unlink(tmp_path)
+            raise
+    try:
+        # NamedTemporaryFile以0600创建，沿用原文件的权限（新文件用0644）
+        mode = os.stat(path).st_mode & 0o777 if os.path.exists(path) else 0o644
+        os.chmod(tmp_path, mode)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+class PackedProxySet:
+    """紧凑的代理候选容器与去重索引
+    
+    不重复的条目少于pack_threshold时就是一个普通set（小规模时set最快）；
+    超过后转为打包模式: 纯IPv4的"a.b.c.d:端口"打包成48位整数（IP<<16 | 端口）
+    存入array('Q')，排序后线性去重、用二分查找判断成员；带域名、认证信息或
+    协议头的条目仍走普通set。
+    """
+    
+    PACK_THRESHOLD = 100_000
+    # 只匹配能原样还原的写法（十进制、无前导零），省去打包后再inet_ntoa比对
+    _OCTET = r'(?:25[0-5]|2[0-4]\d|1\d\d|[1-9]?\d)'
+    _PLAIN_IPV4 = re.compile(rf'((?:{_OCTET}\.){{3}}{_OCTET}):([1-9]\d{{0,4}})', re.ASCII)
+    
+    def __init__(self, proxies=(), pack_threshold=None):
+        self.pack_threshold = self.PACK_THRESHOLD if pack_threshold is None else pack_threshold
+        self._small = set()
+        self._packing = False
+        self._packed = array('Q')
+        self._others = set()
+        self._sorted = True
+        self.total_added = 0
+        self.extend(proxies)
+    
+    @staticmethod
+    def pack(proxy):
+        """把"a.b.c.d:端口"打包为整数，无法无损还原的返回None"""
+        match = PackedProxySet._PLAIN_IPV4.fullmatch(proxy)
+        if match is None:
+            return None
+        host, port = match.groups()
+        port_num = int(port)
+        if port_num > 65535:
+            return None
+        return int.from_bytes(socket.inet_aton(host), 'big') << 16 | port_num
+    
+    @staticmethod
+    def unpack(value):
+        """把48位整数还原为 a.b.c.d:端口 字符串"""
+        return f"{socket.inet_ntoa((value >> 16).to_bytes(4, 'big'))}:{value & 0xFFFF}"
+    
+    def add(self, proxy):
+        """添加一个代理"""
+        self.total_added += 1
+        if not self._packing:
+            self._small.add(proxy)
+            if len(self._small) >= self.pack_threshold:
+                self._start_packing()
+            return
+        self._add_packed(proxy)
+    
+    def _add_packed(self, proxy):
+        value = self.pack(proxy)
+        if value is None:
+            self._others.add(proxy)
+        else:
+            self._packed.append(value)
+            self._sorted = False
+    
+    def _start_packing(self):
+        """不重复条目达到阈值，把set中的条目转入打包区"""
+        small, self._small = self._small, set()
+        self._packing = True
+        for proxy in small:
+            self._add_packed(proxy)
+    
+    def extend(self, proxies):
+        """批量添加代理"""
+        proxies = iter(proxies)
+        if not self._packing:
+            for proxy in proxies:
+                self.add(proxy)
+                if self._packing:
+                    break
+        # 打包模式下内联循环，省去每条两次方法调用
+        pack, append, add_other = self.pack, self._packed.append, self._others.add
+        added = 0
+        for proxy in proxies:
+            added += 1
+            value = pack(proxy)
+            if value is None:
+                add_other(proxy)
+            else:
+                append(value)
+        if added:
+            self.total_added += added
+            self._sorted = False
+    
+    def dedupe(self):
+        """排序后线性去重打包区（惰性执行，添加后首次查询时触发），不经过set"""
+        if self._sorted:
+            return
+        # array没有原地排序，排序结果是临时列表；先释放旧数组再写回，压低峰值内存
+        values = sorted(self._packed)
+        self._packed = unique = array('Q')
+        append = unique.append
+        previous = -1
+        for value in values:
+            if value != previous:
+                append(value)
+                previous = value
+        self._sorted = True
+    
+    def __contains__(self, proxy):
+        if not self._packing:
+            return proxy in self._small
+        value = self.pack(proxy)
+        if value is None:
+            return proxy in self._others
+        self.dedupe()
+        index = bisect.bisect_left(self._packed, value)
+        return index < len(self._packed) and self._packed[index] == value
+    
+    def __len__(self):
+        if not self._packing:
+            return len(self._small)
+        self.dedupe()
+        return len(self._packed) + len(self._others)
+    
+    def __iter__(self):
+        """先按IP/端口数值顺序输出打包条目，再按字母序输出其他条目（set模式下按字母序）"""
+        if not self._packing:
+            yield from sorted(self._small)
+            return
+        self.dedupe()
+        for value in self._packed:
+            yield self.unpack(value)
+        yield from sorted(self._others)
+    
+    def memory_bytes(self):
+        """打包区占用的字节数（不含普通set部分）"""
+        return self._packed.buffer_info()[1] * self._packed.itemsize
+
+
+class ProxyHandshakeError(Exception):
+    """代理握手阶段的协议错误（CONNECT非200、SOCKS拒绝等）"""
+
+
+def split_proxy_url(proxy_url):
+    """拆分代理URL，返回 (协议, 主机, 端口, 用户名, 密码)"""
+    parsed = urlparse(proxy_url)
+    scheme = parsed.scheme or 'http'
+    port = parsed.port or DEFAULT_PROXY_PORTS.get(scheme, 80)
+    return scheme, parsed.hostname, port, parsed.username, parsed.password
+
+
+def build_http_connect(host, port, username=None, password=None):
+    """构造HTTP CONNECT请求"""
+    lines = [f"CONNECT {host}:{port} HTTP/1.1", f"Host: {host}:{port}"]
+    if username:
+        token = base64.b64encode(f"{username}:{password or ''}".encode()).decode()
+        lines.append(f"Proxy-Authorization: Basic {token}")
+    return ("\r\n".join(lines) + "\r\n\r\n").encode()
+
+
+def build_socks4_connect(ip, port, userid=None):
+    """构造SOCKS4 CONNECT请求（目标必须是IPv4地址）"""
+    return (b"\x04\x01" + port.to_bytes(2, 'big') + socket.inet_aton(ip)
+            + (userid or '').encode() + b"\x00")
+
+
+def build_socks5_greeting(with_auth=False):
+    """构造SOCKS5问候报文（方法协商）"""
+    return b"\x05\x02\x00\x02" if with_auth else b"\x05\x01\x00"
+
+
+def build_socks5_auth(username, password):
+    """构造SOCKS5用户名/密码认证报文（RFC 1929）"""
+    user = (username or '').encode()
+    pwd = (password or '').encode()
+    return b"\x01" + bytes([len(user)]) + user + bytes([len(pwd)]) + pwd
+
+
+def build_socks5_connect(ip, port):
+    """构造SOCKS5 CONNECT请求"""
+    addr = ipaddress.ip_address(ip)
+    atyp = b"\x01" if addr.version == 4 else b"\x04"
+    return b"\x05\x01\x00" + atyp + addr.packed + port.to_bytes(2, 'big')
+
+
+def socks5_reply_tail_length(header):
+    """根据SOCKS5应答前4字节计算剩余的地址+端口长度"""
+    atyp = header[3]
+    if atyp == 1:
+        return 4 + 2
+    if atyp == 4:
+        return 16 + 2
+    if atyp == 3:
+        return None  # 需要再读1字节长度
+    raise ProxyHandshakeError(f"SOCKS5未知地址类型: {atyp}")
+
+
+def parse_http_head(head):
+    """解析HTTP响应头，返回 (状态码, 头部字典)"""
+    lines = head.decode('iso-8859-1').split("\r\n")
+    parts = lines[0].split(' ', 2)
+    if len(parts) < 2 or not parts[0].startswith('HTTP/'):
+        raise ProxyHandshakeError(f"无效的HTTP响应: {lines[0][:30]}")
+    headers = {}
+    for line in lines[1:]:
+        if ':' in line:
+            key, value = line.split(':', 1)
+            headers[key.strip().lower()] = value.strip()
+    return int(parts[1]), headers
+
+
+def build_http_request(url, absolute_form=False, proxy_auth=None):
+    """构造GET请求报文，absolute_form用于通过HTTP代理访问http://网站"""
+    parsed = urlparse(url)
+    target = url if absolute_form else (parsed.path or '/') + (f"?{parsed.query}" if parsed.query else '')
+    lines = [f"GET {target} HTTP/1.1", f"Host: {parsed.netloc}"]
+    lines += [f"{key}: {value}" for key, value in DEFAULT_HEADERS.items()]
+    lines += ["Accept-Encoding: identity", "Connection: close"]
+    if proxy_auth:
+        lines.append(f"Proxy-Authorization: Basic {proxy_auth}")
+    return ("\r\n".join(lines) + "\r\n\r\n").encode()
+
+
+def insecure_ssl_context():
+    """测试代理时使用的不校验证书的SSL上下文"""
+    ctx = ssl.create_default_context()
+    ctx.check_hostname = False
+    ctx.verify_mode = ssl.CERT_NONE
+    return ctx
+
+
+def proxy_handshake_steps(scheme, target_host, target_ip, target_port, username=None, password=None):
+    """代理握手状态机（与IO无关），同步/异步驱动共用
+
+    产出 ('send', 数据)、('read', 字节数) 或 ('readuntil', 分隔符)，
+    驱动方把读到的数据send回来；协议错误时抛出ProxyHandshakeError。
+    """
+    if scheme in ('http', 'https'):
+        yield 'send', build_http_connect(target_host, target_port, username, password)
+        head = yield 'readuntil', b"\r\n\r\n"
+        status, _ = parse_http_head(head)
+        if status != 200:
+            raise ProxyHandshakeError(f"CONNECT返回 {status}")
+    elif scheme == 'socks4':
+        yield 'send', build_socks4_connect(target_ip, target_port, username)
+        reply = yield 'read', 8
+        if reply[1] != 0x5A:
+            raise ProxyHandshakeError(f"SOCKS4拒绝连接: {reply[1]:#x}")
+    elif scheme == 'socks5':
+        yield 'send', build_socks5_greeting(bool(username))
+        reply = yield 'read', 2
+        if reply[0] != 0x05:
+            raise ProxyHandshakeError("SOCKS5版本不匹配")
+        if reply[1] == 0x02 and username:
+            yield 'send', build_socks5_auth(username, password)
+            auth_reply = yield 'read', 2
+            if auth_reply[1] != 0x00:
+                raise ProxyHandshakeError("SOCKS5认证失败")
+        elif reply[1] != 0x00:
+            raise ProxyHandshakeError(f"SOCKS5不支持的认证方法: {reply[1]:#x}")
+        yield 'send', build_socks5_connect(target_ip, target_port)
+        header = yield 'read', 4
+        if header[1] != 0x00:
+            raise ProxyHandshakeError(f"SOCKS5拒绝连接: {header[1]:#x}")
+        tail = socks5_reply_tail_length(header)
+        if tail is None:
+            tail = (yield 'read', 1)[0] + 2
+        yield 'read', tail
+    else:
+        raise ProxyHandshakeError(f"不支持的代理协议: {scheme}")
+
+
+def _recv_exact(sock, size):
+    """从阻塞socket精确读取size字节"""
+    data = b""
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise ProxyHandshakeError("代理提前关闭连接")
+        data += chunk
+    return data
+
+
+def _recv_until(sock, separator, max_size=65536):
+    """从阻塞socket读取直到出现分隔符"""
+    data = b""
+    while separator not in data:
+        chunk = sock.recv(4096)
+        if not chunk:
+            raise ProxyHandshakeError("代理提前关闭连接")
+        data += chunk
+        if len(data) > max_size:
+            raise ProxyHandshakeError("代理响应头过长")
+    return data
+
+
+def drive_handshake_sync(sock, steps):
+    """用阻塞socket驱动proxy_handshake_steps状态机"""
+    reply = None
+    try:
+        while True:
+            op, arg = steps.send(reply)
+            if op == 'send':
+                sock.sendall(arg)
+                reply = None
+            elif op == 'read':
+                reply = _recv_exact(sock, arg)
+            else:
+                reply = _recv_until(sock, arg)
+    except StopIteration:
+        pass
+
+
+async def drive_handshake_async(reader, writer, steps):
+    """用asyncio流驱动proxy_handshake_steps状态机"""
+    reply = None
+    try:
+        while True:
+            op, arg = steps.send(reply)
+            if op == 'send':
+                writer.write(arg)
+                await writer.drain()
+                reply = None
+            elif op == 'read':
+                reply = await reader.readexactly(arg)
+            else:
+                reply = await reader.readuntil(arg)
+    except StopIteration:
+        pass
+    except asyncio.IncompleteReadError:
+        raise ProxyHandshakeError("代理提前关闭连接")
+
+
+def fd_limit(default=1024):
+    """当前进程可打开的文件描述符上限（RLIMIT_NOFILE软限制）"""
+    if resource is None:
+        return default
+    try:
+        soft, _ = resource.getrlimit(resource.RLIMIT_NOFILE)
+    except (ValueError, OSError):
+        return default
+    return default if soft == resource.RLIM_INFINITY else soft
+
+
+# 单次探测的阶段（按发生顺序）及显示名称
+PHASE_LABELS = {
+    'tcp': 'TCP扫描',
+    'dns': 'DNS',
+    'connect': '连接',
+    'handshake': '代理握手',
+    'tls': 'TLS',
+    'ttfb': '首字节',
+    'body': '正文',
+}
+
+
+def add_phase(phases, name, started):
+    """把从started（time.perf_counter()）到现在的耗时累加到phases[name]（毫秒），重定向时各跳累加"""
+    phases[name] = phases.get(name, 0) + (time.perf_counter() - started) * 1000
+
+
+def percentile(sorted_values, q):
+    """已排序列表的百分位数（最近秩法）"""
+    if not sorted_values:
+        return 0
+    rank = max(1, math.ceil(q / 100 * len(sorted_values)))
+    return sorted_values[rank - 1]
+
+
+# 超时类错误（代理或网络慢），与本机资源错误区分
+TIMEOUT_ERRORS = ('连接超时', '读取超时', '代理超时', 'Socket超时')
+
+# 本机资源耗尽: 文件描述符用尽、socket缓冲区不足、本地端口用尽
+LOCAL_RESOURCE_ERRNOS = {errno.EMFILE, errno.ENFILE, errno.ENOBUFS, errno.EADDRNOTAVAIL}
+
+
+def is_local_resource_error(exc):
+    """异常链中是否有本机资源耗尽的错误（而不是代理本身的问题）"""
+    seen = set()
+    stack = [exc]
+    while stack:
+        error = stack.pop()
+        if not isinstance(error, BaseException) or id(error) in seen:
+            continue
+        seen.add(id(error))
+        if isinstance(error, OSError) and error.errno in LOCAL_RESOURCE_ERRNOS:
+            return True
+        if 'Too many open files' in str(error):
+            return True
+        stack.extend([error.__cause__, error.__context__, getattr(error, 'reason', None)])
+        stack.extend(arg for arg in error.args if isinstance(arg, BaseException))
+    return False
+
+
+class ConcurrencyController:
+    """AIMD并发控制: 超时率与本机资源错误保持低位时加性增加在途探测上限，升高时乘性减半
+    
+    公开代理本身的超时率就很高且波动大，所以以窗口超时率的指数滑动平均为基线，
+    窗口至少window个探测；超出基线tolerance才算拥塞，连续patience个拥塞窗口才减半，
+    单个噪声窗口只会暂停增长。EMFILE/ENOBUFS等本机错误立即减半。
+    上限受RLIMIT_NOFILE约束（每个探测按fds_per_probe个描述符计，另留fd_reserve个）。
+    """
+    
+    def __init__(self, initial, ceiling, floor=4, adaptive=True, tolerance=0.15,
+                 window=50, smoothing=0.2, patience=3, fds_per_probe=2, fd_reserve=128):
+        self.floor = floor
+        self.maximum = max(floor, min(ceiling, (fd_limit() - fd_reserve) // fds_per_probe))
+        self.adaptive = adaptive
+        self.tolerance = tolerance
+        self.window = window
+        self.smoothing = smoothing
+        self.patience = patience
+        self.limit = max(floor, min(initial, self.maximum))
+        self.initial = self.limit
+        self.step = max(1, self.limit // 10)
+        self.baseline = None
+        self._congested = 0
+        self.local_errors = 0
+        self.decreases = 0
+        self.increases = 0
+        self._started = time.monotonic()
+        self.history = [(0.0, self.limit)]
+        self._reset_window()
+    
+    def _reset_window(self):
+        self._finished = 0
+        self._timeouts = 0
+    
+    def _set(self, value):
+        value = max(self.floor, min(int(value), self.maximum))
+        if value != self.limit:
+            self.limit = value
+            self.history.append((round(time.monotonic() - self._started, 1), value))
+    
+    def record(self, result):
+        """每个探测完成时调用，返回当前并发上限"""
+        if not self.adaptive:
+            return self.limit
+        
+        if result.get('local_error'):
+            self.local_errors += 1
+            self.decreases += 1
+            self._congested = 0
+            self._set(self.limit * 0.5)
+            self._reset_window()
+            return self.limit
+        
+        self._finished += 1
+        if result.get('error') in TIMEOUT_ERRORS:
+            self._timeouts += 1
+        
+        # 每完成约一个并发窗口的探测评估一次
+        if self._finished >= max(self.window, self.limit):
+            rate = self._timeouts / self._finished
+            if self.baseline is None:
+                self.baseline = rate
+            congested = rate > self.baseline + self.tolerance
+            # 基线跟随超时率缓慢移动（按历史排序时列表后段的超时率本来就更高）
+            self.baseline += self.smoothing * (rate - self.baseline)
+            if not congested:
+                self._congested = 0
+                self.increases += 1
+                self._set(self.limit + self.step)
+            else:
+                self._congested += 1
+                if self._congested >= self.patience:
+                    self._congested = 0
+                    self.decreases += 1
+                    self._set(self.limit * 0.5)
+            self._reset_window()
+        return self.limit
+    
+    def summary(self):
+        limits = [limit for _, limit in self.history]
+        return {
+            'initial': self.initial,
+            'final': self.limit,
+            'peak': max(limits),
+            'lowest': min(limits),
+            'maximum': self.maximum,
+            'increases': self.increases,
+            'decreases': self.decreases,
+            'local_errors': self.local_errors,
+            'timeline': self.history,
+        }
+    
+    def describe(self):
+        """一行文字描述并发随时间的变化"""
+        summary = self.summary()
+        timeline = self.history
+        if len(timeline) > 12:
+            stride = math.ceil(len(timeline) / 12)
+            timeline = timeline[::stride] + ([timeline[-1]] if (len(timeline) - 1) % stride else [])
+        points = " → ".join(f"{limit}@{seconds:.0f}s" for seconds, limit in timeline)
+        return (f"初始 {summary['initial']} | 最终 {summary['final']} | 峰值 {summary['peak']} | "
+                f"上限 {summary['maximum']} | +{summary['increases']}/-{summary['decreases']} | "
+                f"本机资源错误 {summary['local_errors']} | {points}")
+
+
+class TimeoutPolicy:
+    """自适应探测超时: 学习成功探测的建连耗时与首字节耗时，连接和读取分别截止
+    
+    建连 = DNS + 连接 + 代理握手 + TLS（只有asyncio引擎和分级预检能测到），
+    读取 = 首字节耗时（requests路径的首字节包含建连，偏保守）。
+    截止时间 = P{percentile} × multiplier，不低于floor秒、不超过网站配置的超时；
+    样本不足min_samples时沿用网站配置的超时。
+    """
+    
+    CONNECT_PHASES = ('dns', 'connect', 'handshake', 'tls')
+    
+    def __init__(self, percentile=95, multiplier=1.5, floor=1.0, min_samples=30, max_samples=5000):
+        self.percentile = percentile
+        self.multiplier = multiplier
+        self.floor = floor
+        self.min_samples = min_samples
+        self.kills = {'connect': 0, 'read': 0}
+        self._connect = deque(maxlen=max_samples)
+        self._read = deque(maxlen=max_samples)
+        self._cutoffs = (None, None)
+        self._pending = 0
+        self._lock = threading.Lock()
+    
+    @property
+    def enabled(self):
+        return self.percentile > 0
+    
+    def observe(self, result):
+        """记录一次成功探测的阶段耗时（关闭时也收集样本，之后开启可直接使用）"""
+        if not result.get('success'):
+            return
+        phases = result.get('phases') or {}
+        with self._lock:
+            if 'connect' in phases or 'handshake' in phases:
+                self._connect.append(sum(phases.get(name, 0) for name in self.CONNECT_PHASES))
+            if 'ttfb' in phases:
+                self._read.append(phases['ttfb'])
+            self._pending += 1
+            # 攒够一批样本再重算分位数，避免每次探测都排序
+            if self.enabled and (self._pending >= 20 or self._cutoffs == (None, None)):
+                self._pending = 0
+                read = self._cutoff(self._read)
+                # requests路径测不到建连耗时，用首字节截止兜底（首字节本身包含建连）
+                self._cutoffs = (self._cutoff(self._connect) or read, read)
+    
+    def _cutoff(self, samples):
+        if len(samples) < self.min_samples:
+            return None
+        return max(self.floor, percentile(sorted(samples), self.percentile) * self.multiplier / 1000)
+    
+    def deadlines(self, base):
+        """返回 (连接截止秒, 读取截止秒)"""
+        if not self.enabled:
+            return base, base
+        connect, read = self._cutoffs
+        return (min(base, connect) if connect else base, min(base, read) if read else base)
+    
+    def record_kill(self, kind, deadline, base):
+        """截止时间比网站配置的超时短且触发了超时: 记为提前终止，返回是否提前"""
+        if deadline >= base:
+            return False
+        with self._lock:
+            self.kills[kind] += 1
+        return True
+    
+    def describe(self, base):
+        connect, read = self.deadlines(base)
+        return (f"连接 {connect:.1f}秒 ({len(self._connect)}样本) | 读取 {read:.1f}秒 ({len(self._read)}样本) | "
+                f"P{self.percentile:g}×{self.multiplier:g}，上限{base:g}秒 | "
+                f"提前终止: 连接 {self.kills['connect']} 个，读取 {self.kills['read']} 个")
+
+
+class BodyVerifier:
+    """流式页面校验：逐块读取，按字节不区分大小写匹配，命中check_string立即停止
+    
+    最多读取max_bytes字节，不解码整个页面；未命中check_string时沿用原有
+    规则：页面中出现至少2个常见HTML标记即视为有效页面。
+    """
+    
+    COMMON_INDICATORS = (b'html', b'http', b'www', b'com', b'net', b'org', b'title', b'body', b'head')
+    
+    def __init__(self, check_string, max_bytes=256 * 1024):
+        self.check_string = check_string or ''
+        self.needle = self.check_string.lower().encode('utf-8')
+        self.max_bytes = max_bytes
+        self.bytes_read = 0
+        self.found = False
+        self.indicators = set()
+        self._tail = b''
+        longest = max([len(self.needle)] + [len(i) for i in self.COMMON_INDICATORS])
+        self._overlap = longest - 1
+    
+    @property
+    def done(self):
+        """是否已无需继续读取"""
+        return not self.needle or self.found or self.bytes_read >= self.max_bytes
+    
+    def feed(self, chunk):
+        """喂入一块数据，返回True表示可以停止读取"""
+        if self.done:
+            return True
+        
+        chunk = chunk[:self.max_bytes - self.bytes_read]
+        self.bytes_read += len(chunk)
+        # 拼接上一块的尾部，避免关键字跨块被切断
+        data = self._tail + chunk.lower()
+        
+        if self.needle in data:
+            self.found = True
+            return True
+        
+        if len(self.indicators) < 2:
+            for indicator in self.COMMON_INDICATORS:
+                if indicator not in self.indicators and indicator in data:
+                    self.indicators.add(indicator)
+        
+        self._tail = data[-self._overlap:] if self._overlap else b''
+        return self.done
+    
+    def apply(self, result):
+        """把校验结论写入结果字典"""
+        result['bytes_read'] = self.bytes_read
+        if not self.needle or self.found:
+            result['success'] = True
+            result['error'] = None
+        elif len(self.indicators) >= 2:  # 提高阈值减少误判
+            result['success'] = True
+            result['error'] = f"未找到 '{self.check_string}' 但页面有效"
+        else:
+            result['error'] = f"未找到 '{self.check_string}' 且页面无效"
+
+
+class SessionPool:
+    """按代理URL缓存requests.Session的有界LRU池，多个工作线程共享
+    
+    同一个代理在整个测试期间复用一个Session（及其TCP/TLS/SOCKS连接），
+    超过max_size时关闭最久未使用的Session。
+    """
+    
+    def __init__(self, max_size=256):
+        self.max_size = max_size
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.connections_opened = 0
+        self.requests_sent = 0
+    
+    def get(self, proxy_url):
+        """获取代理对应的Session，不存在时新建"""
+        with self._lock:
+            session = self._sessions.get(proxy_url)
+            if session is not None:
+                self._sessions.move_to_end(proxy_url)
+                self.hits += 1
+                return session
+            
+            self.misses += 1
+            session = requests.Session()
+            session.proxies = {'http': proxy_url, 'https': proxy_url}
+            # 不读取环境变量: 否则HTTP(S)_PROXY/ALL_PROXY会覆盖session.proxies，探测走了别的代理
+            session.trust_env = False
+            session.headers.update(DEFAULT_HEADERS)
+            self._sessions[proxy_url] = session
+            
+            evicted = []
+            while len(self._sessions) > self.max_size:
+                _, old_session = self._sessions.popitem(last=False)
+                evicted.append(old_session)
+                self.evictions += 1
+        
+        for old_session in evicted:
+            self._close(old_session)
+        return session
+    
+    def release(self, proxy_url):
+        """代理测试结束，关闭并移除其Session"""
+        with self._lock:
+            session = self._sessions.pop(proxy_url, None)
+        if session is not None:
+            self._close(session)
+    
+    def close_all(self):
+        """关闭池中所有Session"""
+        with self._lock:
+            sessions = list(self._sessions.values())
+            self._sessions.clear()
+        for session in sessions:
+            self._close(session)
+    
+    def _close(self, session):
+        """关闭Session前统计urllib3连接池的连接数与请求数"""
+        opened = sent = 0
+        for adapter in session.adapters.values():
+            managers = list(getattr(adapter, 'proxy_manager', {}).values())
+            managers.append(getattr(adapter, 'poolmanager', None))
+            for manager in managers:
+                if manager is None:
+                    continue
+                for key in list(manager.pools.keys()):
+                    pool = manager.pools.get(key)
+                    if pool is not None:
+                        opened += pool.num_connections
+                        sent += pool.num_requests
+        with self._lock:
+            self.connections_opened += opened
+            self.requests_sent += sent
+        session.close()
+    
+    def stats(self):
+        """复用统计"""
+        with self._lock:
+            return {
+                'session_hits': self.hits,
+                'session_misses': self.misses,
+                'session_evictions': self.evictions,
+                'connections_opened': self.connections_opened,
+                'requests_sent': self.requests_sent,
+                'connections_reused': max(0, self.requests_sent - self.connections_opened),
+            }
+
+
+class ProxyStore:
+    """SQLite代理健康库，以 (类型, 主机, 端口) 为主键
+    
+    记录首次/最近出现时间、最近成功时间、滚动平均延迟、连续失败次数和来源URL，
+    下载合并与结果保存都是带索引的upsert，txt/json文件从库中导出。
+    """
+    
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS proxies (
+        type TEXT NOT NULL,
+        host TEXT NOT NULL,
+        port INTEGER NOT NULL,
+        proxy TEXT NOT NULL,
+        source TEXT,
+        first_seen REAL NOT NULL,
+        last_seen REAL NOT NULL,
+        last_tested REAL,
+        last_success REAL,
+        last_ok INTEGER NOT NULL DEFAULT 0,
+        latency_ms REAL,
+        last_latency_ms REAL,
+        last_site TEXT,
+        failure_streak INTEGER NOT NULL DEFAULT 0,
+        test_count INTEGER NOT NULL DEFAULT 0,
+        success_count INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (type, host, port)
+    );
+    CREATE INDEX IF NOT EXISTS idx_proxies_seen ON proxies (type, last_seen);
+    CREATE INDEX IF NOT EXISTS idx_proxies_success ON proxies (type, last_success);
+    CREATE INDEX IF NOT EXISTS idx_proxies_tested ON proxies (type, last_tested);
+    """
+    
+    # 滚动平均延迟中新样本的权重
+    LATENCY_ALPHA = 0.3
+    
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self.conn = sqlite3.connect(db_path)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(self.SCHEMA)
+        self.conn.commit()
+    
+    def close(self):
+        """关闭数据库连接"""
+        self.conn.close()
+    
+    def count(self, proxy_type):
+        """某类型的代理总数"""
+        row = self.conn.execute("SELECT COUNT(*) FROM proxies WHERE type = ?", (proxy_type,)).fetchone()
+        return row[0]
+    
+    def upsert_candidates(self, proxy_type, entries, source=None, now=None):
+        """合并候选代理，entries为 [(主机, 端口, 代理字符串)]，返回写入条数"""
+        now = now or time.time()
+        rows = [(proxy_type, host, port, proxy, source, now, now) for host, port, proxy in entries]
+        with self.conn:
+            self.conn.executemany(
+                """
+                INSERT INTO proxies (type, host, port, proxy, source, first_seen, last_seen)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (type, host, port) DO UPDATE SET
+                    proxy = excluded.proxy,
+                    source = COALESCE(excluded.source, proxies.source),
+                    last_seen = excluded.last_seen
+                """,
+                rows
+            )
+        return len(rows)
+    
+    def record_results(self, proxy_type, rows, now=None):
+        """写入测试结果，rows为 [(主机, 端口, 代理字符串, 是否成功, 延迟ms, 网站缩写)]"""
+        now = now or time.time()
+        alpha = self.LATENCY_ALPHA
+        params = [
+            (proxy_type, host, port, proxy, now, now, now,
+             now if ok else None, 1 if ok else 0,
+             latency if ok else None, latency if ok else None, site if ok else None,
+             0 if ok else 1, 1 if ok else 0)
+            for host, port, proxy, ok, latency, site in rows
+        ]
+        with self.conn:
+            self.conn.executemany(
+                f"""
+                INSERT INTO proxies (type, host, port, proxy, first_seen, last_seen, last_tested,
+                                     last_success, last_ok, latency_ms, last_latency_ms, last_site,
+                                     failure_streak, test_count, success_count)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, 1, ?)
+                ON CONFLICT (type, host, port) DO UPDATE SET
+                    last_tested = excluded.last_tested,
+                    test_count = proxies.test_count + 1,
+                    last_ok = excluded.last_ok,
+                    last_success = COALESCE(excluded.last_success, proxies.last_success),
+                    success_count = proxies.success_count + excluded.success_count,
+                    failure_streak = CASE WHEN excluded.last_ok = 1 THEN 0
+                                          ELSE proxies.failure_streak + 1 END,
+                    latency_ms = CASE WHEN excluded.last_ok = 0 THEN proxies.latency_ms
+                                      WHEN proxies.latency_ms IS NULL THEN excluded.latency_ms
+                                      ELSE proxies.latency_ms * {1 - alpha} + excluded.latency_ms * {alpha} END,
+                    last_latency_ms = COALESCE(excluded.last_latency_ms, proxies.last_latency_ms),
+                    last_site = COALESCE(excluded.last_site, proxies.last_site)
+                """,
+                params
+            )
+    
+    def candidates(self, proxy_type, since):
+        """since之后出现过或测试成功过的代理"""
+        rows = self.conn.execute(
+            """
+            SELECT proxy FROM proxies
+            WHERE type = ? AND (last_seen >= ? OR last_success >= ?)
+            ORDER BY host, port
+            """,
+            (proxy_type, since, since)
+        )
+        return [row[0] for row in rows]
+    
+    def successful_since(self, proxy_type, since):
+        """since之后测试成功的代理，按本次延迟升序"""
+        rows = self.conn.execute(
+            """
+            SELECT proxy, last_latency_ms, last_site FROM proxies
+            WHERE type = ? AND last_ok = 1 AND last_tested >= ?
+            ORDER BY last_latency_ms
+            """,
+            (proxy_type, since)
+        )
+        return [
+            {'proxy': proxy, 'latency_ms': latency, 'site_abbr': site or 'unk', 'success': True}
+            for proxy, latency, site in rows
+        ]
+    
+    def has_sourced_since(self, proxy_type, since):
+        """since之后是否有从下载源或候选文件合并进来的代理"""
+        row = self.conn.execute(
+            "SELECT 1 FROM proxies WHERE type = ? AND source IS NOT NULL AND last_seen >= ? LIMIT 1",
+            (proxy_type, since)
+        ).fetchone()
+        return row is not None
+    
+    def history(self, proxy_type):
+        """某类型所有代理的历史: {(主机, 端口): (测试次数, 成功次数, 连续失败, 最近测试, 最近成功)}"""
+        rows = self.conn.execute(
+            """
+            SELECT host, port, test_count, success_count, failure_streak, last_tested, last_success
+            FROM proxies WHERE type = ?
+            """,
+            (proxy_type,)
+        )
+        return {(host, port): rest for host, port, *rest in rows}
+    
+    def has_successes(self, proxy_type):
+        """是否已有成功记录（用于首次从result/*.txt迁移）"""
+        row = self.conn.execute(
+            "SELECT 1 FROM proxies WHERE type = ? AND last_success IS NOT NULL LIMIT 1", (proxy_type,)
+        ).fetchone()
+        return row is not None
+
+
+class SourceCache:
+    """代理源的磁盘缓存：正文（gzip）、ETag、Last-Modified、解析结果及其摘要
+    
+    下载时发送If-None-Match/If-Modified-Since，304时直接复用上次的解析结果；
+    200时按排序去重后条目的摘要判断内容是否真的变化（计入"内容未变"）。
+    """
+    
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        os.makedirs(cache_dir, exist_ok=True)
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.not_modified = 0
+        self.unchanged = 0
+        self.bytes_downloaded = 0
+        self.bytes_saved = 0
+    
+    def _path(self, url, suffix):
+        key = hashlib.sha1(url.encode('utf-8')).hexdigest()[:16]
+        return os.path.join(self.cache_dir, f"{key}{suffix}")
+    
+    def load(self, url):
+        """读取缓存元数据，缓存不完整时返回None"""
+        meta_path = self._path(url, ".json")
+        if not (os.path.exists(meta_path) and os.path.exists(self._path(url, ".entries"))):
+            return None
+        try:
+            with open(meta_path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+    
+    def conditional_headers(self, meta):
+        """根据缓存生成条件请求头"""
+        headers = {}
+        if meta:
+            if meta.get('etag'):
+                headers['If-None-Match'] = meta['etag']
+            if meta.get('last_modified'):
+                headers['If-Modified-Since'] = meta['last_modified']
+        return headers
+    
+    def entries(self, url):
+        """读取缓存的解析结果（每行一个代理）"""
+        with open(self._path(url, ".entries"), 'r', encoding='utf-8') as f:
+            return [line for line in f.read().split("\n") if line]
+    
+    def save(self, url, body, etag, last_modified, digest, entries):
+        """保存正文与解析结果"""
+        write_atomic(self._path(url, ".body.gz"), gzip.compress(body))
+        write_atomic(self._path(url, ".entries"), "\n".join(entries).encode('utf-8'))
+        meta = {
+            'url': url,
+            'etag': etag,
+            'last_modified': last_modified,
+            'digest': digest,
+            'size': len(body),
+            'entries': len(entries),
+            'fetched_at': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+        }
+        write_atomic(self._path(url, ".json"), json.dumps(meta, ensure_ascii=False, indent=2).encode('utf-8'))
+    
+    def record(self, wire_bytes=0, saved_bytes=0, not_modified=False, unchanged=False):
+        """记录一次下载的统计"""
+        with self._lock:
+            self.requests += 1
+            self.bytes_downloaded += wire_bytes
+            self.bytes_saved += saved_bytes
+            self.not_modified += int(not_modified)
+            self.unchanged += int(unchanged)
+    
+    def summary(self):
+        """缓存命中率与节省的字节数"""
+        with self._lock:
+            hit_ratio = self.not_modified / self.requests if self.requests else 0
+            return {
+                'requests': self.requests,
+                'not_modified': self.not_modified,
+                'unchanged': self.unchanged,
+                'hit_ratio': hit_ratio,
+                'bytes_downloaded': self.bytes_downloaded,
+                'bytes_saved': self.bytes_saved,
+            }
+
+
+class ResultJournal:
+    """崩溃安全的测试结果日志（JSONL，每行一条结果）
+    
+    结果完成即进入缓冲区，攒够flush_every条或距上次落盘超过fsync_interval秒时
+    一次写入并fsync。进程被杀最多丢失最后一个批次，写了一半的行在读取时跳过。
+    文件在第一次落盘时才打开：续测时追加，否则覆盖上一次运行的日志。
+    """
+    
+    def __init__(self, path, flush_every=200, fsync_interval=2.0):
+        self.path = path
+        self.flush_every = flush_every
+        self.fsync_interval = fsync_interval
+        self.append_mode = False
+        self.written = 0
+        self.syncs = 0
+        self._lock = threading.Lock()
+        self._buffer = []
+        self._file = None
+        self._last_sync = time.monotonic()
+    
+    def load(self, since=0):
+        """读取时间戳不早于since的结果"""
+        records = []
+        if not os.path.exists(self.path):
+            return records
+        with open(self.path, 'r', encoding='utf-8', errors='ignore') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue  # 崩溃时写了一半的行
+                if isinstance(record, dict) and record.get('t', 0) >= since:
+                    records.append(record)
+        return records
+    
+    def append(self, result):
+        """追加一条结果（带时间戳t），按批次落盘"""
+        line = json.dumps(dict(result, t=time.time()), ensure_ascii=False)
+        with self._lock:
+            self._buffer.append(line)
+            if (len(self._buffer) >= self.flush_every
+                    or time.monotonic() - self._last_sync >= self.fsync_interval):
+                self._flush_locked()
+    
+    def _open(self):
+        if self.append_mode and os.path.exists(self.path) and os.path.getsize(self.path):
+            self._file = open(self.path, 'a', encoding='utf-8')
+            # 上次崩溃可能留下不完整的末行，先换行隔开
+            with open(self.path, 'rb') as f:
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b"\n":
+                    self._file.write("\n")
+        else:
+            self._file = open(self.path, 'w', encoding='utf-8')
+    
+    def _flush_locked(self):
+        self._last_sync = time.monotonic()
+        if not self._buffer:
+            return
+        if self._file is None:
+            self._open()
+        self._file.write("\n".join(self._buffer) + "\n")
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self.written += len(self._buffer)
+        self.syncs += 1
+        self._buffer = []
+    
+    def flush(self):
+        """立即落盘缓冲区中的结果"""
+        with self._lock:
+            self._flush_locked()
+    
+    def close(self):
+        with self._lock:
+            self._flush_locked()
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+def shard_of(proxy, proxy_type, count):
+    """代理所属的分片（1..count）: crc32与进程、机器和PYTHONHASHSEED无关，各分片互不重叠"""
+    return zlib.crc32(f"{proxy_type}|{proxy}".encode('utf-8')) % count + 1
+
+
+def parse_shard(text):
+    """解析 'i/n' 形式的分片参数（i从1开始）"""
+    try:
+        index, count = (int(part) for part in text.split('/'))
+    except ValueError:
+        raise ValueError(f"分片格式应为 i/n: {text}")
+    if not 1 <= index <= count:
+        raise ValueError(f"分片序号应在1..{count}之间: {text}")
+    return index, count
+
+
+class MetricsCollector:
+    """运行指标: 计数器、仪表（记录峰值）和直方图，导出为Prometheus文本格式与JSON汇总"""
+    
+    LATENCY_BUCKETS = (50, 100, 200, 500, 1000, 2000, 5000, 10000)
+    
+    HELP = {
+        'daili_probes_started_total': ('counter', '已派发的代理探测数'),
+        'daili_probes_finished_total': ('counter', '已完成的代理探测数'),
+        'daili_probe_failures_total': ('counter', '按错误类别统计的失败探测数'),
+        'daili_probe_bytes_read_total': ('counter', '页面校验读取的字节数'),
+        'daili_source_bytes_downloaded_total': ('counter', '下载代理源的实际传输字节数'),
+        'daili_source_bytes_saved_total': ('counter', '代理源缓存命中节省的字节数'),
+        'daili_budget_skipped_total': ('counter', '时间预算不足而未测试的代理数'),
+        'daili_probe_early_kills_total': ('counter', '被自适应超时提前终止的探测数'),
+        'daili_result_record_seconds_total': ('counter', '调度线程记录结果（日志、汇总、指标）的累计耗时'),
+        'daili_progress_writes_total': ('counter', '进度输出次数'),
+        'daili_progress_write_seconds_total': ('counter', '进度输出写stdout的累计耗时'),
+        'daili_probes_in_flight': ('gauge', '在途探测数'),
+        'daili_queue_depth': ('gauge', '等待派发的代理数'),
+        'daili_run_duration_seconds': ('gauge', '本次运行耗时'),
+        'daili_probe_latency_ms': ('histogram', '成功探测的总延迟（毫秒）'),
+    }
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters = {}
+        self.gauges = {}
+        self.gauge_peaks = {}
+        self.histograms = {}
+    
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted(labels.items()))
+    
+    def inc(self, name, value=1, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+    
+    def set_counter(self, name, value, **labels):
+        """计数器取外部累计值（如缓存统计），而不是逐次累加"""
+        key = self._key(name, labels)
+        with self._lock:
+            self.counters[key] = value
+    
+    def set_gauge(self, name, value, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            self.gauges[key] = value
+            self.gauge_peaks[key] = max(self.gauge_peaks.get(key, value), value)
+    
+    def add_gauge(self, name, delta, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            value = self.gauges.get(key, 0) + delta
+            self.gauges[key] = value
+            self.gauge_peaks[key] = max(self.gauge_peaks.get(key, value), value)
+    
+    def observe(self, name, value, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            # [各桶计数..., +Inf桶计数, 总和]
+            histogram = self.histograms.setdefault(key, [0] * (len(self.LATENCY_BUCKETS) + 1) + [0.0])
+            histogram[bisect.bisect_left(self.LATENCY_BUCKETS, value)] += 1
+            histogram[-1] += value
+    
+    def value(self, name, default=0, **labels):
+        """读取一个计数器或仪表序列的当前值（标签需完全一致）"""
+        key = self._key(name, labels)
+        with self._lock:
+            if key in self.counters:
+                return self.counters[key]
+            return self.gauges.get(key, default)
+    
+    def total(self, name):
+        """计数器在所有标签组合上的合计"""
+        with self._lock:
+            return sum(value for (series, _), value in self.counters.items() if series == name)
+    
+    @staticmethod
+    def _format_labels(labels, extra=()):
+        items = list(labels) + list(extra)
+        if not items:
+            return ""
+        escaped = (f'{k}="{str(v).replace(chr(92), chr(92) * 2).replace(chr(34), chr(92) + chr(34))}"' for k, v in items)
+        return "{" + ",".join(escaped) + "}"
+    
+    def to_prometheus(self):
+        """Prometheus文本格式（textfile collector可直接读取）"""
+        lines = []
+        with self._lock:
+            series = {}
+            for (name, labels), value in list(self.counters.items()) + list(self.gauges.items()):
+                series.setdefault(name, []).append((labels, value))
+            for (name, labels), histogram in self.histograms.items():
+                series.setdefault(name, []).append((labels, list(histogram)))
+        
+        for name in sorted(series):
+            kind, help_text = self.HELP.get(name, ('untyped', name))
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, value in sorted(series[name], key=lambda item: item[0]):
+                if kind != 'histogram':
+                    lines.append(f"{name}{self._format_labels(labels)} {value}")
+                    continue
+                cumulative = 0
+                bounds = [str(b) for b in self.LATENCY_BUCKETS] + ['+Inf']
+                for bound, count in zip(bounds, value[:-1]):
+                    cumulative += count
+                    lines.append(f"{name}_bucket{self._format_labels(labels, [('le', bound)])} {cumulative}")
+                lines.append(f"{name}_sum{self._format_labels(labels)} {value[-1]:.1f}")
+                lines.append(f"{name}_count{self._format_labels(labels)} {cumulative}")
+        return "\n".join(lines) + "\n"
+    
+    def summary(self):
+        """JSON汇总: 序列名 -> 数值（仪表附带峰值，直方图附带各桶计数）"""
+        with self._lock:
+            def series(name, labels):
+                return name + self._format_labels(labels)
+            
+            histograms = {}
+            for (name, labels), histogram in self.histograms.items():
+                count = sum(histogram[:-1])
+                histograms[series(name, labels)] = {
+                    'count': count,
+                    'sum': round(histogram[-1], 1),
+                    'avg': round(histogram[-1] / count, 1) if count else 0,
+                    'buckets': dict(zip([str(b) for b in self.LATENCY_BUCKETS] + ['+Inf'], histogram[:-1])),
+                }
+            return {
+                'generated_at': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+                'counters': {series(n, l): v for (n, l), v in sorted(self.counters.items())},
+                'gauges': {
+                    series(n, l): {'value': v, 'peak': self.gauge_peaks.get((n, l), v)}
+                    for (n, l), v in sorted(self.gauges.items())
+                },
+                'histograms': histograms,
+            }
+    
+    def write(self, result_dir, name="metrics"):
+        """写出 {name}.prom 和 {name}.json（先写临时文件再替换，读取方不会看到半个文件）"""
+        outputs = {
+            os.path.join(result_dir, f"{name}.prom"): self.to_prometheus(),
+            os.path.join(result_dir, f"{name}.json"): json.dumps(self.summary(), ensure_ascii=False, indent=2),
+        }
+        for path, content in outputs.items():
+            write_atomic(path, content)
+        return list(outputs)
+
+
+class LatencyHistogram:
+    """固定对数分桶的延迟直方图: 相邻桶边界相差GROWTH倍（1ms到约4分钟），
+    分位数取所在桶的上界，误差不超过一个桶宽（5%）"""
+    
+    GROWTH = 1.05
+    BUCKETS = 256
+    
     def __init__(self):
+        self.counts = [0] * self.BUCKETS
+        self.count = 0
+        self.max = 0.0
+    
+    def add(self, ms):
+        index = 0 if ms <= 1 else min(self.BUCKETS - 1, math.ceil(math.log(ms, self.GROWTH)))
+        self.counts[index] += 1
+        self.count += 1
+        if ms > self.max:
+            self.max = ms
+    
+    def percentile(self, q):
+        if not self.count:
+            return 0.0
+        rank = max(1, math.ceil(q / 100 * self.count))
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                return min(self.max, self.GROWTH ** index)
+        return self.max
+
+
+class ResultAggregator:
+    """某类型测试结果的流式汇总（display_results的数据来源）
+    
+    每条完成的结果O(1)更新: 固定区间的延迟分布、分阶段延迟直方图、网站计数、
+    错误类别计数，以及用大小为top_k的堆保留最快的代理。内存与结果数无关。
+    """
+    
+    LATENCY_RANGES = [
+        (0, 100, "极快 <100ms"),
+        (100, 200, "快速 100-200ms"),
+        (200, 500, "中等 200-500ms"),
+        (500, 1000, "较慢 500ms-1s"),
+        (1000, 3000, "慢 1-3s"),
+        (3000, float('inf'), "很慢 >3s"),
+    ]
+    RANGE_BOUNDS = [upper for _, upper, _ in LATENCY_RANGES[:-1]]
+    
+    def __init__(self, top_k=5):
+        self.top_k = top_k
+        self.total = 0
+        self.successful = 0
+        self.latency_sum = 0.0
+        self.latency_min = None
+        self.latency_max = None
+        self.range_counts = [0] * len(self.LATENCY_RANGES)
+        self.phases = {}
+        self.site_counts = {}
+        self.error_counts = {}
+        self._fastest = []      # (-延迟, 序号, 结果) 的最大堆，堆顶是保留中最慢的
+    
+    @classmethod
+    def from_results(cls, results):
+        aggregator = cls()
+        for result in results:
+            aggregator.add(result)
+        return aggregator
+    
+    def add(self, result):
+        self.total += 1
+        if not result['success']:
+            error = result.get('error') or '未知错误'
+            error_key = error.split(':')[0]
+            self.error_counts[error_key] = self.error_counts.get(error_key, 0) + 1
+            return
+        
+        self.successful += 1
+        latency = result['latency_ms']
+        self.latency_sum += latency
+        self.latency_min = latency if self.latency_min is None else min(self.latency_min, latency)
+        self.latency_max = latency if self.latency_max is None else max(self.latency_max, latency)
+        self.range_counts[bisect.bisect_right(self.RANGE_BOUNDS, latency)] += 1
+        
+        site_abbr = result.get('site_abbr', 'unk')
+        self.site_counts[site_abbr] = self.site_counts.get(site_abbr, 0) + 1
+        for name, ms in (result.get('phases') or {}).items():
+            histogram = self.phases.get(name)
+            if histogram is None:
+                histogram = self.phases[name] = LatencyHistogram()
+            histogram.add(ms)
+        
+        entry = (-latency, self.successful, result)
+        if len(self._fastest) < self.top_k:
+            heapq.heappush(self._fastest, entry)
+        elif latency < -self._fastest[0][0]:
+            heapq.heapreplace(self._fastest, entry)
+    
+    @property
+    def failed(self):
+        return self.total - self.successful
+    
+    def fastest(self):
+        """保留的最快代理，按延迟升序"""
+        return [result for _, _, result in sorted(self._fastest, key=lambda e: (-e[0], e[1]))]
+
+
+class ProgressReporter:
+    """定时采样计数器并输出进度的后台线程
+    
+    探测线程和调度线程都不再写stdout: 计数器只由调度线程更新，这里每interval秒
+    读取一次（读int不需要加锁）。退出时输出最终进度，不换行，调用方随后print()。
+    """
+    
+    def __init__(self, tester, total, interval=1.0):
+        self.tester = tester
+        self.total = total          # 流水线模式下由调用方随下载更新
+        self.interval = interval
+        self.writes = 0
+        self.write_seconds = 0.0
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="progress", daemon=True)
+    
+    def __enter__(self):
+        self._thread.start()
+        return self
+    
+    def __exit__(self, *exc_info):
+        self._stopped.set()
+        self._thread.join()
+        self._write()
+        metrics = self.tester.metrics
+        metrics.inc('daili_progress_writes_total', self.writes)
+        metrics.inc('daili_progress_write_seconds_total', self.write_seconds)
+        return False
+    
+    def _run(self):
+        last = None
+        while not self._stopped.wait(self.interval):
+            if self.tester.total_tested != last:
+                last = self.tester.total_tested
+                self._write()
+    
+    def _write(self):
+        tester = self.tester
+        tested = tester.total_tested
+        percentage = tested / self.total * 100 if self.total else 100.0
+        started = time.perf_counter()
+        print(f"\r📈📈📈📈 进度: {tested}/{self.total} "
+              f"[{percentage:.1f}%] | "
+              f"✅: {tester.successful} | "
+              f"❌❌❌❌: {tester.failed}", end="", flush=True)
+        self.write_seconds += time.perf_counter() - started
+        self.writes += 1
+
+
+class GitHubProxyTester:
+    def __init__(self, engine="thread", async_concurrency=500, tiered=False, sweep=False,
+                 max_workers=80, type_quotas=None, type_priorities=None, use_store=True,
+                 streaming=False, resume=False, budget=None, processes=1, shard=None):
         self.version = "1.0.0"
         self.total_tested = 0
         self.successful = 0
@@ -39,10 +1498,111 @@ class GitHubProxyTester:
         # 缓存测试网站
         self._test_urls = None
         
+        # 统一调度: 初始并发数（由AIMD控制器调整）、每类型配额与优先级
+        self.max_workers = max_workers
+        self.type_quotas = type_quotas or {}
+        self.type_priorities = type_priorities or {}
+        self.streaming = streaming
+        
+        # 测试引擎: thread（线程池+requests）或 async（单事件循环）
+        self.engine = engine
+        self.async_concurrency = async_concurrency
+        self._ssl_context = insecure_ssl_context()
+        self._dns_cache = {}
+        
+        # 自适应并发: 线程引擎最多thread_ceiling个线程，async引擎最多初始值的4倍
+        self.adaptive_concurrency = True
+        self.thread_ceiling = 512
+        self.download_workers = 8
+        self.concurrency_runs = []
+        
+        # 线程引擎的连接复用: 每个代理一个Session，所有工作线程共享有界缓存
+        self.session_pool = SessionPool(max_size=256)
+        
+        # 页面校验最多读取的字节数（命中check_string会提前停止）
+        self.body_cap_bytes = 256 * 1024
+        
+        # 网站竞速: 每隔race_stagger秒向下一个网站发起请求（上一个失败则立即发起），
+        # 先成功者胜出，其余取消；单个代理的最坏耗时约为一个超时
+        self.race_targets = False
+        self.race_stagger = 0.25
+        # 竞速请求在有界线程池中执行，在途请求数计入调度器的并发额度
+        self._race_executor = None
+        self._race_lock = threading.Lock()
+        self.race_attempts = 0
+        
+        # 分级验证: 先做廉价的协议握手，只有通过的代理才做完整HTTP测试
+        self.tiered = tiered
+        self.handshake_timeout = 5
+        self.handshake_workers = 200
+        self.stage_stats = {}
+        
+        # TCP可达性扫描: 非阻塞connect + epoll，在任何协议测试之前过滤死代理
+        self.sweep_enabled = sweep
+        self.sweep_timeout = 1.5
+        self.sweep_max_sockets = 2000
+        # 扫描测得的到代理的TCP连接耗时: 作为结果的phases['tcp']，也是历史排序的次要键
+        self.connect_latency = {}
+        
         # 确保必要的目录存在
         self.result_dir = os.path.join(self.base_dir, "result")
         os.makedirs(self.result_dir, exist_ok=True)
         
+        # 代理健康库（跨运行的历史记录），候选窗口内出现或成功过的代理参与测试
+        self.run_started = time.time()
+        self.candidate_window = 36 * 3600
+        self.store = ProxyStore(os.path.join(self.result_dir, "proxies.db")) if use_store else None
+        
+        # 分片: shard=(i, n)时只测试shard_of()落在第i片的代理，结果日志和指标按分片命名，
+        # 由 --merge 合并成最终输出；processes>1时本机启动n个子进程各测一片后自动合并
+        self.shard = shard
+        self.processes = processes
+        
+        # 结果日志: 每条结果完成即追加；续测时跳过resume_window内已测过的代理，
+        # 最终输出合并日志中的旧结果与本次的结果
+        self.resume = resume
+        self.resume_window = 6 * 3600
+        self.journal = ResultJournal(os.path.join(self.result_dir, f"journal{self._shard_suffix()}.jsonl"))
+        self._resumed = set()
+        self._resumed_results = {}
+        self.resume_skipped = 0
+        if resume:
+            self._resume_from_journal()
+        
+        # 时间预算（秒）: 按比例分配给下载阶段，测试阶段在剩余时间
+        # 不足一次探测的最坏耗时时停止派发，在途探测正常结束
+        self.budget = budget
+        self.deadline = None
+        # 预算与派发判断使用的时钟（模拟器注入虚拟时钟）
+        self.clock = time.monotonic
+        self.download_share = 0.2
+        self.budget_skipped = 0
+        self.phase_times = {}
+        
+        # 按类型的流式结果汇总，每条结果完成时更新（见display_results）
+        self.aggregators = {}
+        
+        # 自适应超时: 默认关闭（--timeout-percentile开启），以上次运行日志中
+        # 成功探测的耗时作为初始样本
+        self.timeout_policy = TimeoutPolicy(percentile=0)
+        for record in self.journal.load():
+            self.timeout_policy.observe(record)
+        
+        # 运行指标（result/metrics.prom 与 result/metrics.json）
+        self.metrics = MetricsCollector()
+        
+        # 代理源条件下载缓存
+        self.source_cache = SourceCache(os.path.join(self.base_dir, "cache"))
+        
+        # 基于历史的测试排序与退避: 连续失败backoff_after次后按指数退避跳过，
+        # 每天按recheck_ratio的比例抽查被退避的代理
+        self.history_ordering = use_store
+        self.backoff_after = 3
+        self.backoff_base = 12 * 3600
+        self.backoff_max = 7 * 24 * 3600
+        self.recheck_ratio = 0.05
+        self.success_half_life = 3 * 24 * 3600
+        
         print(f"🔧🔧🔧🔧 初始化GitHub代理测试器")
         print(f"📁📁📁📁 工作目录: {self.base_dir}")
         print(f"💾💾💾💾 结果目录: {self.result_dir}")
@@ -315,8 +1875,124 @@ class GitHubProxyTester:
             return self.load_test_urls()
         return self._test_urls
     
+    def _endpoint(self, proxy, proxy_type):
+        """代理对应的 (主机, 端口)，作为健康库主键"""
+        _, host, port, _, _ = split_proxy_url(self.get_proxy_url(proxy, proxy_type.upper()))
+        return (host or proxy).lower(), port
+    
+    def _store_entries(self, proxies, proxy_type):
+        """把代理字符串转换为健康库的 (主机, 端口, 代理) 记录"""
+        entries = []
+        for proxy in proxies:
+            try:
+                host, port = self._endpoint(proxy, proxy_type)
+            except ValueError:
+                continue
+            entries.append((host, port, proxy))
+        return entries
+    
+    def _parse_result_line(self, line):
+        """解析result/*.txt中的一行，返回 (代理, 延迟ms, 网站缩写)"""
+        latency, site_abbr = None, 'unk'
+        if '/#' in line:
+            annotation = line.split('/#', 1)[1]
+            match = re.match(r'([\d.]+)ms(?:%20(\w+))?', annotation)
+            if match:
+                latency = float(match.group(1))
+                site_abbr = match.group(2) or 'unk'
+        return self.clean_and_validate_proxy(line), latency, site_abbr
+    
+    def export_candidates(self, proxy_type):
+        """从健康库导出候选代理文件（http.txt等）"""
+        info = self.proxy_files[proxy_type]
+        since = self.run_started - self.candidate_window
+        proxies = self.store.candidates(proxy_type, since)
+        
+        target_path = os.path.join(self.base_dir, info['file'])
+        with open(target_path, 'w', encoding='utf-8') as f:
+            f.write(f"# {info['name']}代理列表（从代理健康库导出）\n")
+            f.write(f"# 总代理数: {len(proxies)}\n")
+            f.write("#" * 50 + "\n\n")
+            
+            for proxy in proxies:
+                f.write(f"{proxy}\n")
+        
+        return len(proxies)
+    
+    def load_candidates(self, proxy_type, limit=0):
+        """加载某类型的候选代理：优先从健康库查询，库为空时读取txt并写入库"""
+        info = self.proxy_files[proxy_type]
+        file_path = os.path.join(self.base_dir, info['file'])
+        
+        if self.store is None:
+            return self.load_proxies(file_path, limit)
+        
+        self._seed_store_from_file(proxy_type)
+        proxies = self.store.candidates(proxy_type, self.run_started - self.candidate_window)
+        print(f"✅ 从健康库加载 {len(proxies)} 个{info['name']}代理")
+        if limit > 0:
+            proxies = proxies[:limit]
+        return proxies
+    
+    def _seed_store_from_file(self, proxy_type):
+        """本窗口内没有下载到该类型代理时，把现有候选txt合并进健康库"""
+        if self.store.has_sourced_since(proxy_type, self.run_started - self.candidate_window):
+            return
+        
+        info = self.proxy_files[proxy_type]
+        file_path = os.path.join(self.base_dir, info['file'])
+        if os.path.exists(file_path):
+            proxies = self.load_proxies(file_path)
+            self.store.upsert_candidates(proxy_type, self._store_entries(proxies, proxy_type), source=info['file'])
+    
+    def _import_into_store(self):
+        """健康库模式的导入：首次运行时迁移result/*.txt历史，再导出候选文件"""
+        imported_count = 0
+        
+        for proxy_type, info in self.proxy_files.items():
+            result_file = os.path.join(self.result_dir, f"{proxy_type}.txt")
+            
+            try:
+                if not self.store.has_successes(proxy_type) and os.path.exists(result_file):
+                    rows = []
+                    invalid = 0
+                    with open(result_file, 'r', encoding='utf-8') as f:
+                        for line in f:
+                            line = line.strip()
+                            if line and not line.startswith('#'):
+                                proxy, latency, site_abbr = self._parse_result_line(line)
+                                if not proxy:
+                                    continue
+                                try:
+                                    host, port = self._endpoint(proxy, proxy_type)
+                                except ValueError:
+                                    # 端口越界或格式错误的行跳过，不影响其余代理
+                                    invalid += 1
+                                    continue
+                                rows.append((host, port, proxy, True, latency or 0, site_abbr))
+                    if invalid:
+                        print(f"⚠️ {info['name']}历史结果中有 {invalid} 行无法解析，已跳过")
+                    if rows:
+                        self.store.record_results(proxy_type, rows, now=os.path.getmtime(result_file))
+                        print(f"✅ 迁移 {len(rows)} 个历史成功{info['name']}代理到健康库")
+                        imported_count += len(rows)
+                
+                self._seed_store_from_file(proxy_type)
+                if self.store.count(proxy_type):
+                    total = self.export_candidates(proxy_type)
+                    print(f"💾💾💾💾 {info['name']}候选代理已从健康库导出: {total} 个")
+            except Exception as e:
+                print(f"❌❌❌❌ 导入{info['name']}代理失败: {e}")
+        
+        if imported_count > 0:
+            print(f"✅ 总共导入 {imported_count} 个成功代理")
+    
     def import_previous_successful_proxies(self):
         """导入上次测试成功的代理到对应文件"""
+        if self.store is not None:
+            # 成功记录已在健康库中，合并即为带索引的查询
+            return self._import_into_store()
+        
         if not os.path.exists(self.result_dir):
             print("❌❌❌❌ result目录不存在，跳过导入")
             return
@@ -329,15 +2005,7 @@ class GitHubProxyTester:
             if os.path.exists(result_file):
                 try:
                     with open(result_file, 'r', encoding='utf-8') as f:
-                        successful_proxies = []
-                        
-                        for line in f:
-                            line = line.strip()
-                            if line and not line.startswith('#'):
-                                # 使用合并的清理和验证功能
-                                proxy = self.clean_and_validate_proxy(line)
-                                if proxy:
-                                    successful_proxies.append(proxy)
+                        successful_proxies = parse_proxy_blob(f.read())
                     
                     if successful_proxies:
                         target_path = os.path.join(self.base_dir, info['file'])
@@ -345,15 +2013,10 @@ class GitHubProxyTester:
                         
                         if os.path.exists(target_path):
                             with open(target_path, 'r', encoding='utf-8') as f:
-                                for line in f:
-                                    line = line.strip()
-                                    if line and not line.startswith('#'):
-                                        # 使用合并的清理和验证功能
-                                        proxy = self.clean_and_validate_proxy(line)
-                                        if proxy:
-                                            existing_proxies.append(proxy)
+                                existing_proxies = parse_proxy_blob(f.read())
                         
-                        all_proxies = list(set(existing_proxies + successful_proxies))
+                        all_proxies = PackedProxySet(existing_proxies)
+                        all_proxies.extend(successful_proxies)
                         
                         with open(target_path, 'w', encoding='utf-8') as f:
                             f.write(f"# {info['name']}代理列表（包含导入的成功代理）\n")
@@ -361,7 +2024,7 @@ class GitHubProxyTester:
                             f.write(f"# 导入成功代理: {len(successful_proxies)}\n")
                             f.write("#" * 50 + "\n\n")
                             
-                            for proxy in sorted(all_proxies):
+                            for proxy in all_proxies:
                                 f.write(f"{proxy}\n")
                         
                         print(f"✅ 导入 {len(successful_proxies)} 个成功{info['name']}代理")
@@ -380,40 +2043,66 @@ class GitHubProxyTester:
         print(f"🌐🌐🌐🌐 下载{proxy_type}代理: {url}")
         
         try:
+            cached = self.source_cache.load(url) if self.source_cache else None
             headers = {
                 'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36',
+                'Accept-Encoding': 'gzip, deflate',
             }
+            if self.source_cache:
+                headers.update(self.source_cache.conditional_headers(cached))
             
-            # 下载代理列表时不使用代理，验证SSL证书
-            response = requests.get(url, headers=headers, timeout=30, verify=True)
-            
-            if response.status_code == 200:
-                proxies = []
-                for line in response.text.splitlines():
-                    line = line.strip()
-                    if line and not line.startswith('#') and not line.startswith('//'):
-                        # 使用合并的清理和验证功能
-                        proxy = self.clean_and_validate_proxy(line)
-                        if proxy:
-                            proxies.append(proxy)
+            # 下载代理列表时不使用代理，验证SSL证书；流式响应在with结束时归还连接
+            with requests.get(url, headers=headers, timeout=30, verify=True, stream=True) as response:
+                if response.status_code == 304 and cached:
+                    # 源未变化: 直接复用上次的解析结果
+                    proxies = self.source_cache.entries(url)
+                    self.source_cache.record(saved_bytes=cached.get('size', 0), not_modified=True)
+                    print(f"✅ 源未变化(304)，复用缓存 {len(proxies)} 个{proxy_type}代理")
+                    return proxies
                 
-                print(f"✅ 下载到 {len(proxies)} 个{proxy_type}代理")
-                return proxies
-            else:
-                print(f"❌❌❌❌ 下载失败: HTTP {response.status_code}")
-                return []
+                if response.status_code != 200:
+                    print(f"❌❌❌❌ 下载失败: HTTP {response.status_code}")
+                    return []
+                
+                body = response.content
+                # 实际传输的字节数（gzip压缩后）
+                wire_bytes = response.raw.tell() if hasattr(response.raw, 'tell') else len(body)
+                encoding = response.encoding or 'utf-8'
+                etag = response.headers.get('ETag')
+                last_modified = response.headers.get('Last-Modified')
+            
+            proxies = parse_proxy_blob(body.decode(encoding, errors='ignore'))
+            # 摘要取排序去重后的条目: 只改了格式或顺序的列表不算变化
+            digest = hashlib.sha256("\n".join(sorted(set(proxies))).encode('utf-8')).hexdigest()
+            if self.source_cache:
+                unchanged = bool(cached) and cached.get('digest') == digest
+                self.source_cache.record(wire_bytes=wire_bytes, unchanged=unchanged)
+                self.source_cache.save(url, body, etag, last_modified, digest, proxies)
+            
+            print(f"✅ 下载到 {len(proxies)} 个{proxy_type}代理")
+            return proxies
                 
         except Exception as e:
             print(f"❌❌❌❌ 下载失败: {e}")
             return []
     
+    def print_cache_summary(self):
+        """打印代理源缓存命中率与节省的流量"""
+        if not self.source_cache:
+            return
+        summary = self.source_cache.summary()
+        if summary['requests']:
+            print(f"🗄🗄🗄🗄 源缓存: {summary['not_modified']}/{summary['requests']} 命中304 "
+                  f"({summary['hit_ratio'] * 100:.0f}%) | 内容未变 {summary['unchanged']} | "
+                  f"下载 {summary['bytes_downloaded'] / 1024:.1f}KB | 节省 {summary['bytes_saved'] / 1024:.1f}KB")
+    
     def save_proxies_to_file(self, proxies, file_path, proxy_type):
         """保存代理列表到文件"""
         if not proxies:
             print(f"⚠️ 没有{proxy_type}代理可保存")
             return
         
-        unique_proxies = list(set(proxies))
+        unique_proxies = proxies if isinstance(proxies, PackedProxySet) else PackedProxySet(proxies)
         print(f"📊📊📊📊 {proxy_type}代理去重后: {len(unique_proxies)} 个")
         
         with open(file_path, 'w', encoding='utf-8') as f:
@@ -421,7 +2110,7 @@ class GitHubProxyTester:
             f.write(f"# 总代理数: {len(unique_proxies)}\n")
             f.write("#" * 50 + "\n\n")
             
-            for proxy in sorted(unique_proxies):
+            for proxy in unique_proxies:
                 f.write(f"{proxy}\n")
         
         print(f"💾💾💾💾 已保存到: {file_path}")
@@ -494,8 +2183,8 @@ class GitHubProxyTester:
             print(f"❌❌❌❌ 解析source.txt文件失败: {e}")
             return {}
     
-    def download_and_classify_proxies(self):
-        """从source.txt下载代理并分类保存"""
+    def download_and_classify_proxies(self, deadline=None):
+        """从source.txt下载代理并分类保存（deadline为time.monotonic()截止时间，超时放弃未完成的源）"""
         print("\n" + "="*60)
         print("📥📥📥📥 开始下载代理并分类")
         print("="*60)
@@ -512,31 +2201,47 @@ class GitHubProxyTester:
             if not links:
                 continue
                 
+            if deadline is not None and time.monotonic() >= deadline:
+                print(f"\n⏳⏳⏳⏳ 下载阶段预算已用完，跳过{proxy_type.upper()}的 {len(links)} 个源")
+                continue
+            
             print(f"\n📥📥📥📥 处理{proxy_type.upper()}代理...")
             
-            all_proxies = []
+            all_proxies = PackedProxySet()
             
-            with concurrent.futures.ThreadPoolExecutor(max_workers=5) as executor:
-                future_to_url = {
-                    executor.submit(self.download_proxy_list, url, proxy_type): url 
-                    for url in links
-                }
-                
-                for future in concurrent.futures.as_completed(future_to_url):
+            executor = concurrent.futures.ThreadPoolExecutor(max_workers=min(self.download_workers, len(links)))
+            future_to_url = {
+                executor.submit(self.download_proxy_list, url, proxy_type): url 
+                for url in links
+            }
+            timeout = None if deadline is None else max(0, deadline - time.monotonic())
+            
+            try:
+                for future in concurrent.futures.as_completed(future_to_url, timeout=timeout):
                     url = future_to_url[future]
                     try:
                         proxies = future.result()
                         all_proxies.extend(proxies)
+                        if self.store is not None and proxies:
+                            self.store.upsert_candidates(proxy_type, self._store_entries(proxies, proxy_type), source=url)
                     except Exception as e:
                         print(f"❌❌❌❌ 下载失败: {e}")
+            except concurrent.futures.TimeoutError:
+                pending = sum(1 for future in future_to_url if not future.done())
+                print(f"⏳⏳⏳⏳ 下载阶段预算已用完，放弃 {pending} 个未完成的源")
+            finally:
+                executor.shutdown(wait=deadline is None, cancel_futures=True)
             
-            if all_proxies:
-                file_path = os.path.join(self.base_dir, self.proxy_files[proxy_type]['file'])
-                self.save_proxies_to_file(all_proxies, file_path, proxy_type.upper())
-                total_downloaded += len(all_proxies)
+            if all_proxies.total_added:
+                if self.store is None:
+                    file_path = os.path.join(self.base_dir, self.proxy_files[proxy_type]['file'])
+                    self.save_proxies_to_file(all_proxies, file_path, proxy_type.upper())
+                total_downloaded += all_proxies.total_added
             else:
                 print(f"❌❌❌❌ 没有下载到有效的{proxy_type}代理")
         
+        self.print_cache_summary()
+        
         print(f"\n📥📥📥📥 下载完成，开始导入上次测试成功的代理...")
         self.import_previous_successful_proxies()
         
@@ -553,26 +2258,14 @@ class GitHubProxyTester:
         
         try:
             with open(file_path, 'r', encoding='utf-8', errors='ignore') as f:
-                proxies = []
-                lines = 0
+                proxies = parse_proxy_blob(f.read())
                 
-                for line in f:
-                    line = line.strip()
-                    
-                    if not line or line.startswith('#') or line.startswith('//'):
-                        continue
-                    
-                    # 使用合并的清理和验证功能
-                    proxy = self.clean_and_validate_proxy(line)
-                    if proxy:
-                        proxies.append(proxy)
-                        lines += 1
-                    
-                    if limit > 0 and lines >= limit:
-                        break
+                limited = limit > 0 and len(proxies) >= limit
+                if limited:
+                    proxies = proxies[:limit]
                 
                 print(f"✅ 成功加载 {len(proxies)} 个代理")
-                if limit > 0 and lines >= limit:
+                if limited:
                     print(f"📊📊📊📊 只加载前 {limit} 个代理")
                 
                 return proxies
@@ -581,9 +2274,9 @@ class GitHubProxyTester:
             print(f"❌❌❌❌ 读取文件失败: {e}")
             return []
     
-    def test_single_url(self, proxy, test_config, proxy_type):
-        """测试单个URL - 只在requests.get中使用verify=False"""
-        result = {
+    def _new_result(self, proxy, test_config, proxy_type):
+        """生成单次测试的结果字典"""
+        return {
             'proxy': proxy,
             'proxy_type': proxy_type,
             'test_name': test_config['name'],
@@ -593,80 +2286,81 @@ class GitHubProxyTester:
             'status_code': 0,
             'error': None,
             'timestamp': datetime.now().strftime("%H:%M:%S"),
-            'site_abbr': test_config.get('site_abbr', 'web')
+            'site_abbr': test_config.get('site_abbr', 'web'),
+            'bytes_read': 0,
+            'phases': {}
         }
+    
+    def test_single_url(self, proxy, test_config, proxy_type, cancel=None):
+        """测试单个URL - 只在requests.get中使用verify=False
         
-        # 生成代理URL
-        proxy_url = self.get_proxy_url(proxy, proxy_type)
-        
-        # 设置代理
-        proxies = {
-            'http': proxy_url,
-            'https': proxy_url
-        }
+        requests不暴露连接建立的细节，阶段只分为首字节（含DNS/连接/握手/TLS，
+        复用连接时为0）和正文两段；完整的分阶段耗时见asyncio引擎。
+        cancel: 竞速模式下其他网站已胜出时置位，正文读取提前停止。
+        """
+        result = self._new_result(proxy, test_config, proxy_type)
+        phases = result['phases']
+        base_timeout = test_config.get('timeout', 8)
+        connect_timeout, read_timeout = self.timeout_policy.deadlines(base_timeout)
         
-        headers = {
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36',
-            'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8',
-            'Accept-Language': 'en-US,en;q=0.5',
-        }
+        # 生成代理URL，并取出该代理的复用Session
+        proxy_url = self.get_proxy_url(proxy, proxy_type)
+        session = self.session_pool.get(proxy_url)
         
         try:
-            start_time = time.time()
+            start_time = time.perf_counter()
             
             # 只在测试代理时禁用SSL验证
             with warnings.catch_warnings():
                 warnings.simplefilter("ignore")
-                response = requests.get(
+                response = session.get(
                     test_config['url'],
-                    proxies=proxies,
-                    timeout=test_config.get('timeout', 8),
-                    headers=headers,
+                    timeout=(connect_timeout, read_timeout),
                     verify=False,  # 只在测试代理时禁用SSL验证
-                    allow_redirects=True
+                    allow_redirects=True,
+                    stream=True
                 )
+            add_phase(phases, 'ttfb', start_time)
             
-            latency = time.time() - start_time
-            result['latency_ms'] = latency * 1000
-            result['status_code'] = response.status_code
-            
-            if response.status_code == 200:
-                check_string = test_config.get('check_string', '')
-                if check_string:
-                    if check_string.lower() in response.text.lower():
-                        result['success'] = True
-                        result['error'] = None
-                    else:
-                        # 检查页面是否包含常见HTML标记
-                        page_text = response.text.lower()
-                        common_indicators = ['html', 'http', 'www', 'com', 'net', 'org', 'title', 'body', 'head']
-                        indicators_found = sum(1 for indicator in common_indicators if indicator in page_text)
-                        
-                        if indicators_found >= 2:  # 提高阈值减少误判
-                            result['success'] = True
-                            result['error'] = f"未找到 '{check_string}' 但页面有效"
-                        else:
-                            result['error'] = f"未找到 '{check_string}' 且页面无效"
+            try:
+                result['status_code'] = response.status_code
+                
+                if response.status_code == 200:
+                    # 流式读取页面，命中check_string或达到字节上限即停止
+                    body_start = time.perf_counter()
+                    verifier = BodyVerifier(test_config.get('check_string', ''), self.body_cap_bytes)
+                    if not verifier.done:
+                        for chunk in response.iter_content(chunk_size=16384):
+                            if verifier.feed(chunk) or (cancel is not None and cancel.is_set()):
+                                break
+                    add_phase(phases, 'body', body_start)
+                    verifier.apply(result)
                 else:
-                    result['success'] = True
-                    result['error'] = None
-            else:
-                result['error'] = f"HTTP {response.status_code}"
+                    result['error'] = f"HTTP {response.status_code}"
+            finally:
+                response.close()
+            
+            latency = time.perf_counter() - start_time
+            result['latency_ms'] = latency * 1000
                 
         except requests.exceptions.ConnectTimeout:
             result['error'] = '连接超时'
+            self._timeout_cut(result, 'connect', connect_timeout, base_timeout)
         except requests.exceptions.ReadTimeout:
             result['error'] = '读取超时'
+            self._timeout_cut(result, 'read', read_timeout, base_timeout)
         except requests.exceptions.ConnectionError as e:
             error_str = str(e)
             if 'timed out' in error_str.lower():
                 result['error'] = '连接超时'
+                self._timeout_cut(result, 'connect', connect_timeout, base_timeout)
             elif 'reset' in error_str.lower():
                 result['error'] = '连接被重置'
             elif 'refused' in error_str.lower():
                 result['error'] = '连接被拒绝'
             else:
                 result['error'] = f'连接错误: {error_str[:30]}'
+            result['local_error'] = is_local_resource_error(e)
         except requests.exceptions.ProxyError as e:
             error_str = str(e)
             if 'timed out' in error_str.lower():
@@ -682,148 +2376,1190 @@ class GitHubProxyTester:
         except Exception as e:
             error_str = str(e)
             result['error'] = f'其他错误: {error_str[:30]}'
+            result['local_error'] = is_local_resource_error(e)
+        
+        return result
+    
+    def test_proxy_connectivity(self, proxy, proxy_type):
+        """测试单个代理的连通性"""
+        if self.race_targets and len(self.get_test_urls()) > 1:
+            # 竞速模式在最后一个网站请求结束（或被取消）时才释放Session
+            return self._race_proxy_sites(proxy, proxy_type)
+        try:
+            return self._test_proxy_sites(proxy, proxy_type)
+        finally:
+            # 该代理的测试结束，释放其复用的Session
+            self.session_pool.release(self.get_proxy_url(proxy, proxy_type))
+    
+    def _better_failure(self, best_result, result):
+        """多个网站都失败时保留的结果: 收到过HTTP响应的优先"""
+        if best_result is None or (result.get('status_code', 0) > 0 and best_result.get('status_code', 0) == 0):
+            return result
+        return best_result
+    
+    def _all_failed_result(self, proxy, proxy_type):
+        return {
+            'proxy': proxy,
+            'proxy_type': proxy_type,
+            'success': False,
+            'error': '所有测试都失败',
+            'latency_ms': 0,
+            'test_name': '综合测试',
+            'test_url': '多个URL',
+            'timestamp': datetime.now().strftime("%H:%M:%S"),
+            'site_abbr': 'unk'
+        }
+    
+    def _test_proxy_sites(self, proxy, proxy_type):
+        """依次测试ym.txt中的网站，遇到成功或收到HTTP响应即停止"""
+        test_urls = self.get_test_urls()
+        best_result = None
+        
+        for test_config in test_urls:
+            result = self.test_single_url(proxy, test_config, proxy_type)
+            
+            if result['success']:
+                return result
+            
+            best_result = self._better_failure(best_result, result)
+            
+            if result.get('status_code', 0) > 0:
+                break
+        
+        return best_result or self._all_failed_result(proxy, proxy_type)
+    
+    def _race_proxy_sites(self, proxy, proxy_type):
+        """竞速测试ym.txt中的网站（happy eyeballs）: 按顺序每隔race_stagger秒发起下一个，
+        前一个失败时立即发起；第一个成功的结果胜出，尚未发起的不再发起
+        
+        各网站的请求在有界的竞速线程池中执行。requests无法中断进行中的连接，落败的请求
+        按各自的超时结束，正文读取会因cancel置位提前停止，尚未开始的请求直接取消；
+        全部结束后才释放该代理的Session。收到HTTP响应的失败不再发起新的网站（与顺序测试一致）。
+        """
+        test_urls = self.get_test_urls()
+        completed = queue.SimpleQueue()
+        cancel = threading.Event()
+        attempts = []
+        best_result = None
+        launched = finished = 0
+        
+        def attempt(test_config):
+            if cancel.is_set():
+                return
+            try:
+                completed.put(self.test_single_url(proxy, test_config, proxy_type, cancel))
+            except Exception as e:
+                result = self._new_result(proxy, test_config, proxy_type)
+                result['error'] = f'其他错误: {str(e)[:30]}'
+                completed.put(result)
+        
+        try:
+            while finished < launched or launched < len(test_urls):
+                if launched < len(test_urls):
+                    attempts.append(self._submit_race_attempt(attempt, test_urls[launched]))
+                    launched += 1
+                
+                stagger = self.race_stagger if launched < len(test_urls) else None
+                try:
+                    result = completed.get(timeout=stagger)
+                except queue.Empty:
+                    continue  # 错开时间已到，发起下一个网站
+                finished += 1
+                
+                if result['success']:
+                    return result
+                best_result = self._better_failure(best_result, result)
+                if result.get('status_code', 0) > 0:
+                    test_urls = test_urls[:launched]
+        finally:
+            cancel.set()
+            for future in attempts:
+                future.cancel()
+            self._release_when_done(attempts, self.get_proxy_url(proxy, proxy_type))
+        
+        return best_result or self._all_failed_result(proxy, proxy_type)
+    
+    def _submit_race_attempt(self, fn, *args):
+        """把一个竞速请求提交到有界线程池（按需创建），并计入在途竞速请求数"""
+        with self._race_lock:
+            if self._race_executor is None:
+                self._race_executor = concurrent.futures.ThreadPoolExecutor(
+                    max_workers=self.thread_ceiling, thread_name_prefix='race')
+            self.race_attempts += 1
+            future = self._race_executor.submit(fn, *args)
+        future.add_done_callback(self._race_attempt_done)
+        return future
+    
+    def _race_attempt_done(self, future):
+        with self._race_lock:
+            self.race_attempts -= 1
+    
+    def _release_when_done(self, futures, proxy_url):
+        """所有竞速请求结束（或被取消）后再释放代理的Session，避免落败请求重新创建Session"""
+        remaining = [len(futures)]
+        lock = threading.Lock()
+        
+        def done(_):
+            with lock:
+                remaining[0] -= 1
+                last = remaining[0] == 0
+            if last:
+                self.session_pool.release(proxy_url)
+        
+        if not futures:
+            self.session_pool.release(proxy_url)
+        for future in futures:
+            future.add_done_callback(done)
+    
+    def _probe_executor(self, max_workers):
+        """线程引擎调度器执行探测的线程池（模拟器替换为虚拟时钟上的执行器）"""
+        return concurrent.futures.ThreadPoolExecutor(max_workers=max_workers)
+    
+    def _completion_queue(self):
+        """探测完成时由回调放入的队列，调度线程从中逐个取出结果"""
+        return queue.SimpleQueue()
+    
+    def _has_slot(self, controller, in_flight):
+        """调度器是否还能派发新探测: 在途探测与在途竞速请求共用控制器的并发额度
+        
+        没有在途探测时总是允许派发一个，避免落败请求占满额度时调度停滞。
+        """
+        return in_flight < max(1, controller.limit - self.race_attempts)
+    
+    def _close_probe_resources(self):
+        """等待竞速线程池中的请求结束（未开始的取消），再关闭所有Session"""
+        with self._race_lock:
+            executor, self._race_executor = self._race_executor, None
+        if executor is not None:
+            executor.shutdown(wait=True, cancel_futures=True)
+        self.session_pool.close_all()
+    
+    def probe_timeout(self):
+        """单个代理探测的最坏耗时: 依次测试所有网站都超时（分级模式另加握手超时）；
+        竞速模式下为最长的网站超时加上所有错开间隔"""
+        test_urls = self.get_test_urls()
+        if self.race_targets and len(test_urls) > 1:
+            timeout = (max(config.get('timeout', 8) for config in test_urls)
+                       + self.race_stagger * (len(test_urls) - 1))
+        else:
+            timeout = sum(config.get('timeout', 8) for config in test_urls)
+        if self.tiered:
+            timeout += self.handshake_timeout
+        return timeout
+    
+    def _can_launch(self):
+        """剩余预算是否还够一次探测的最坏耗时"""
+        return self.deadline is None or self.deadline - self.clock() >= self.probe_timeout()
+    
+    def _stop_launching(self, queues, in_flight):
+        """预算不足: 清空待测队列，返回放弃的代理数"""
+        dropped = sum(len(queue) for queue in queues.values())
+        for queue in queues.values():
+            queue.clear()
+        self.budget_skipped += dropped
+        print(f"\n⏳⏳⏳⏳ 剩余预算不足一次探测({self.probe_timeout()}秒)，停止派发: "
+              f"放弃 {dropped} 个待测代理，等待在途的 {in_flight} 个完成")
+        return dropped
+    
+    def _resume_from_journal(self):
+        """读取窗口内的日志结果，本次运行跳过这些代理并在其后追加"""
+        previous = self.journal.load(self.run_started - self.resume_window)
+        self.journal.append_mode = True
+        latest = {}
+        for record in previous:
+            latest[(record.get('proxy_type'), record.get('proxy'))] = record
+        self._resumed = set(latest)
+        for (proxy_type, _), record in latest.items():
+            self._resumed_results.setdefault(proxy_type, []).append(record)
+        print(f"📝📝📝📝 续测: 日志中已有 {len(self._resumed)} 个代理的结果，本次跳过")
+    
+    def _skip_resumed(self, proxies, proxy_type):
+        """去掉续测日志中已经测过的代理"""
+        if not self._resumed:
+            return proxies
+        remaining = [proxy for proxy in proxies if (proxy_type, proxy) not in self._resumed]
+        skipped = len(proxies) - len(remaining)
+        if skipped:
+            self.resume_skipped += skipped
+            print(f"📝📝📝📝 续测: 跳过 {skipped} 个已测过的{proxy_type}代理")
+        return remaining
+    
+    def _shard_suffix(self):
+        """分片模式下结果日志、指标和子进程输出的文件名后缀"""
+        if self.shard is None:
+            return ""
+        return ".shard-%d-of-%d" % self.shard
+    
+    def _own_shard(self, proxies, proxy_type):
+        """分片模式下只保留属于本分片的代理"""
+        if self.shard is None:
+            return proxies
+        index, count = self.shard
+        return [proxy for proxy in proxies if shard_of(proxy, proxy_type, count) == index]
+    
+    def _probe_result(self, future, proxy, proxy_type):
+        """取出一次探测的结果；探测本身抛出的异常记为该代理的失败结果，不中断整个运行"""
+        try:
+            return future.result()
+        except Exception as e:
+            result = self._new_result(proxy, {'name': '综合测试', 'url': '多个URL', 'site_abbr': 'unk'}, proxy_type)
+            result['error'] = f'其他错误: {str(e)[:30]}'
+            result['local_error'] = is_local_resource_error(e)
+            return result
+    
+    def _aggregate(self, result):
+        """把一条结果计入该类型的流式汇总"""
+        proxy_type = result.get('proxy_type', 'unk')
+        aggregator = self.aggregators.get(proxy_type)
+        if aggregator is None:
+            aggregator = self.aggregators[proxy_type] = ResultAggregator()
+        aggregator.add(result)
+    
+    def _journal_results(self, results):
+        """把没有经过_record_result的结果（扫描/握手淘汰）写入日志和汇总"""
+        for result in results:
+            if self.journal is not None:
+                self.journal.append(result)
+            self._aggregate(result)
+    
+    def _final_results(self, all_results, successful_results, proxy_type):
+        """某类型的最终结果: 续测时在本次结果前补上日志中的旧结果（同一代理以本次为准），
+        并计入流式汇总；否则直接使用本次运行的内存结果"""
+        resumed = self._resumed_results.pop(proxy_type, None)
+        if not resumed:
+            return all_results, successful_results
+        tested = {r['proxy'] for r in all_results}
+        resumed = [r for r in resumed if r['proxy'] not in tested]
+        for record in resumed:
+            self._aggregate(record)
+        return resumed + all_results, [r for r in resumed if r['success']] + successful_results
+    
+    def _new_controller(self, initial, engine=None):
+        """为一次测试创建并发控制器，并记入本次运行的并发历史"""
+        if (engine or self.engine) == "async":
+            ceiling = initial * 4
+        else:
+            ceiling = max(initial, self.thread_ceiling)
+        controller = ConcurrencyController(initial, ceiling, adaptive=self.adaptive_concurrency)
+        self.concurrency_runs.append(controller)
+        return controller
+    
+    def _observe_concurrency(self, controller, result):
+        """把完成的探测交给控制器，返回新的并发上限"""
+        limit = controller.record(result)
+        self.metrics.set_gauge('daili_concurrency_limit', limit)
+        return limit
+    
+    def _timeout_cut(self, result, kind, deadline, base):
+        """超时发生在自适应截止时间（短于网站配置）上时，标记为提前终止"""
+        if self.timeout_policy.record_kill(kind, deadline, base):
+            result['cut_off'] = kind
+            self.metrics.inc('daili_probe_early_kills_total', kind=kind)
+    
+    def _probe_started(self, proxy_type):
+        """记录派发了一次探测（与_record_result成对）"""
+        self.metrics.inc('daili_probes_started_total', type=proxy_type)
+        self.metrics.add_gauge('daili_probes_in_flight', 1)
+    
+    def _record_metrics(self, result, total):
+        """把一条结果计入运行指标"""
+        metrics = self.metrics
+        proxy_type = result.get('proxy_type', 'unk')
+        outcome = 'success' if result['success'] else 'failure'
+        metrics.inc('daili_probes_finished_total', type=proxy_type, result=outcome)
+        metrics.add_gauge('daili_probes_in_flight', -1)
+        in_flight = metrics.value('daili_probes_in_flight')
+        metrics.set_gauge('daili_queue_depth', max(0, total - self.total_tested - in_flight))
+        if result.get('bytes_read'):
+            metrics.inc('daili_probe_bytes_read_total', result['bytes_read'], type=proxy_type)
+        if result['success']:
+            metrics.observe('daili_probe_latency_ms', result['latency_ms'],
+                            type=proxy_type, site=result.get('site_abbr', 'unk'))
+        else:
+            error = result.get('error') or '未知错误'
+            metrics.inc('daili_probe_failures_total', type=proxy_type, error=error.split(':')[0])
+    
+    def write_metrics(self):
+        """补齐运行级指标并写出 result/metrics.prom 与 result/metrics.json"""
+        if self.source_cache:
+            cache = self.source_cache.summary()
+            self.metrics.set_counter('daili_source_bytes_downloaded_total', cache['bytes_downloaded'])
+            self.metrics.set_counter('daili_source_bytes_saved_total', cache['bytes_saved'])
+        self.metrics.set_counter('daili_budget_skipped_total', self.budget_skipped)
+        self.metrics.set_gauge('daili_run_duration_seconds', round(time.time() - self.run_started, 1))
+        paths = self.metrics.write(self.result_dir, f"metrics{self._shard_suffix()}")
+        print(f"📐📐📐📐 运行指标已保存: {', '.join(os.path.basename(path) for path in paths)}")
+    
+    def _record_result(self, result, total, all_results, successful_results):
+        """记录一条测试结果（只在调度线程/事件循环中调用，计数器和结果列表无需加锁）
+        
+        进度由ProgressReporter定时输出；这里的累计耗时计入daili_result_record_seconds_total。
+        """
+        started = time.perf_counter()
+        connect_ms = self.connect_latency.get(result['proxy'])
+        if connect_ms is not None:
+            # TCP扫描测得的到代理的连接耗时单独记为'tcp'阶段: 不含代理握手和代理到目标的连接，
+            # 不能作为requests连接超时的样本（TimeoutPolicy.CONNECT_PHASES不包含它）
+            result.setdefault('phases', {})['tcp'] = connect_ms
+        all_results.append(result)
+        if self.journal is not None:
+            self.journal.append(result)
+        self.timeout_policy.observe(result)
+        self._aggregate(result)
+        
+        if result['success']:
+            successful_results.append(result)
+        
+        self.total_tested += 1
+        if result['success']:
+            self.successful += 1
+        else:
+            self.failed += 1
+        
+        self._record_metrics(result, total)
+        self.metrics.inc('daili_result_record_seconds_total', time.perf_counter() - started)
+    
+    def batch_test_proxies(self, proxies, proxy_type, max_workers=20, engine=None):
+        """批量测试代理"""
+        if not proxies:
+            return [], []
+        
+        if (engine or self.engine) == "async":
+            return self.async_batch_test_proxies(proxies, proxy_type, self.async_concurrency)
+        
+        controller = self._new_controller(max_workers, "thread")
+        
+        print(f"\n🚀🚀🚀🚀 开始测试 {len(proxies)} 个{proxy_type}代理")
+        print(f"📊📊📊📊 并发线程: 初始 {controller.limit}，自适应上限 {controller.maximum}")
+        self._print_probe_timeouts()
+        print("-"*50)
+        
+        all_results = []
+        successful_results = []
+        pending = deque(proxies)
+        futures = {}
+        skipped = 0
+        # 完成的探测由工作线程的回调放入队列，调度线程是唯一的结果收集者
+        completed = self._completion_queue()
+        
+        start_time = time.time()
+        
+        # 按控制器给出的上限逐个派发，线程按需创建
+        with self._probe_executor(controller.maximum) as executor, ProgressReporter(self, len(proxies)):
+            while pending or futures:
+                while pending and self._has_slot(controller, len(futures)):
+                    if not self._can_launch():
+                        skipped += len(pending)
+                        pending.clear()
+                        break
+                    proxy = pending.popleft()
+                    self._probe_started(proxy_type)
+                    future = executor.submit(self.test_proxy_connectivity, proxy, proxy_type)
+                    futures[future] = proxy
+                    future.add_done_callback(completed.put)
+                
+                if not futures:
+                    break
+                
+                future = completed.get()
+                result = self._probe_result(future, futures.pop(future), proxy_type)
+                self._record_result(result, len(proxies), all_results, successful_results)
+                self._observe_concurrency(controller, result)
+        
+        self._close_probe_resources()
+        total_time = time.time() - start_time
+        
+        print()
+        if skipped:
+            self.budget_skipped += skipped
+            print(f"⏳⏳⏳⏳ 预算用尽，{skipped} 个代理未测试")
+        print(f"🎛🎛🎛🎛 并发: {controller.describe()}")
+        self._print_timeout_summary()
+        self._print_collector_summary()
+        print(f"⏱⏱⏱⏱⏱⏱⏱⏱⏱ 总耗时: {total_time:.1f}秒")
+        print(f"📊📊📊📊 平均速度: {len(proxies)/total_time:.1f}个/秒")
+        
+        self._print_bytes_summary(all_results)
+        
+        pool_stats = self.session_pool.stats()
+        print(f"🔁🔁🔁🔁 Session复用命中: {pool_stats['session_hits']} | "
+              f"新建: {pool_stats['session_misses']} | "
+              f"连接复用: {pool_stats['connections_reused']}/{pool_stats['requests_sent']}")
+        
+        return all_results, successful_results
+    
+    async def _async_resolve(self, host):
+        """异步解析主机名为IPv4地址（带缓存）"""
+        try:
+            ipaddress.ip_address(host)
+            return host
+        except ValueError:
+            pass
+        
+        if host not in self._dns_cache:
+            loop = asyncio.get_running_loop()
+            infos = await loop.getaddrinfo(host, None, family=socket.AF_INET, type=socket.SOCK_STREAM)
+            self._dns_cache[host] = infos[0][4][0]
+        return self._dns_cache[host]
+    
+    async def _async_start_tls(self, writer, server_hostname):
+        """在已建立的连接（代理隧道）上升级TLS"""
+        if hasattr(writer, 'start_tls'):  # Python 3.11+
+            await writer.start_tls(self._ssl_context, server_hostname=server_hostname)
+            return
+        
+        loop = asyncio.get_running_loop()
+        transport = writer.transport
+        new_transport = await loop.start_tls(
+            transport, transport.get_protocol(), self._ssl_context, server_hostname=server_hostname
+        )
+        writer._transport = new_transport
+    
+    async def _async_open_tunnel(self, proxy_url, target_host, target_port, use_tls, phases=None):
+        """连接代理并完成握手，返回 (reader, writer)；各阶段耗时累加到phases"""
+        phases = {} if phases is None else phases
+        scheme, proxy_host, proxy_port, username, password = split_proxy_url(proxy_url)
+        proxy_ssl = self._ssl_context if scheme == 'https' else None
+        
+        started = time.perf_counter()
+        proxy_ip = await self._async_resolve(proxy_host)
+        add_phase(phases, 'dns', started)
+        
+        started = time.perf_counter()
+        reader, writer = await asyncio.open_connection(
+            proxy_ip, proxy_port, ssl=proxy_ssl, server_hostname=proxy_host if proxy_ssl else None, limit=2 ** 17
+        )
+        add_phase(phases, 'connect', started)
+        
+        try:
+            # HTTP代理访问http://网站时直接发送absolute-form请求，无需CONNECT
+            if scheme.startswith('socks') or use_tls:
+                target_ip = None
+                if scheme.startswith('socks'):
+                    started = time.perf_counter()
+                    target_ip = await self._async_resolve(target_host)
+                    add_phase(phases, 'dns', started)
+                
+                started = time.perf_counter()
+                await drive_handshake_async(reader, writer, proxy_handshake_steps(
+                    scheme, target_host, target_ip, target_port, username, password
+                ))
+                add_phase(phases, 'handshake', started)
+            
+            if use_tls:
+                started = time.perf_counter()
+                await self._async_start_tls(writer, target_host)
+                add_phase(phases, 'tls', started)
+        except BaseException:
+            writer.close()
+            raise
+        
+        return reader, writer
+    
+    async def _async_read_body(self, reader, headers, timeout, verifier):
+        """流式读取HTTP正文并交给BodyVerifier，校验完成即停止"""
+        if 'chunked' in headers.get('transfer-encoding', '').lower():
+            while not verifier.done:
+                size_line = await asyncio.wait_for(reader.readline(), timeout)
+                size = int(size_line.split(b';')[0].strip() or b'0', 16)
+                if size == 0:
+                    break
+                chunk = await asyncio.wait_for(reader.readexactly(size + 2), timeout)
+                verifier.feed(chunk[:-2])
+        else:
+            remaining = int(headers.get('content-length', verifier.max_bytes))
+            while remaining > 0 and not verifier.done:
+                chunk = await asyncio.wait_for(reader.read(min(remaining, 16384)), timeout)
+                if not chunk:
+                    break
+                verifier.feed(chunk)
+                remaining -= len(chunk)
+    
+    async def async_test_single_url(self, proxy, test_config, proxy_type):
+        """异步测试单个URL，返回与test_single_url相同结构的结果"""
+        result = self._new_result(proxy, test_config, proxy_type)
+        phases = result['phases']
+        proxy_url = self.get_proxy_url(proxy, proxy_type)
+        scheme, _, _, username, password = split_proxy_url(proxy_url)
+        base_timeout = test_config.get('timeout', 8)
+        connect_timeout, timeout = self.timeout_policy.deadlines(base_timeout)
+        
+        phase = 'connect'
+        writer = None
+        
+        try:
+            start_time = time.perf_counter()
+            url = test_config['url']
+            
+            # 跟随重定向（最多5次），与requests的allow_redirects=True保持一致
+            for _ in range(6):
+                parsed = urlparse(url)
+                use_tls = parsed.scheme == 'https'
+                target_port = parsed.port or (443 if use_tls else 80)
+                
+                phase = 'connect'
+                reader, writer = await asyncio.wait_for(
+                    self._async_open_tunnel(proxy_url, parsed.hostname, target_port, use_tls, phases), connect_timeout
+                )
+                
+                phase = 'read'
+                started = time.perf_counter()
+                absolute_form = scheme in ('http', 'https') and not use_tls
+                proxy_auth = None
+                if absolute_form and username:
+                    proxy_auth = base64.b64encode(f"{username}:{password or ''}".encode()).decode()
+                writer.write(build_http_request(url, absolute_form, proxy_auth))
+                await writer.drain()
+                
+                head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), timeout)
+                add_phase(phases, 'ttfb', started)
+                status, headers = parse_http_head(head)
+                
+                if status in REDIRECT_CODES and headers.get('location'):
+                    writer.close()
+                    writer = None
+                    url = urljoin(url, headers['location'])
+                    continue
+                break
+            
+            result['status_code'] = status
+            
+            if status == 200:
+                started = time.perf_counter()
+                verifier = BodyVerifier(test_config.get('check_string', ''), self.body_cap_bytes)
+                await self._async_read_body(reader, headers, timeout, verifier)
+                add_phase(phases, 'body', started)
+                verifier.apply(result)
+            else:
+                result['error'] = f"HTTP {status}"
+            
+            latency = time.perf_counter() - start_time
+            result['latency_ms'] = latency * 1000
+        
+        except asyncio.TimeoutError:
+            result['error'] = '连接超时' if phase == 'connect' else '读取超时'
+            self._timeout_cut(result, phase, connect_timeout if phase == 'connect' else timeout, base_timeout)
+        except ConnectionRefusedError:
+            result['error'] = '连接被拒绝'
+        except ConnectionResetError:
+            result['error'] = '连接被重置'
+        except ProxyHandshakeError as e:
+            if scheme.startswith('socks'):
+                result['error'] = 'SOCKS代理错误'
+            else:
+                result['error'] = f'代理错误: {str(e)[:30]}'
+        except asyncio.IncompleteReadError:
+            result['error'] = '连接被重置'
+        except ssl.SSLError as e:
+            result['error'] = f'SSL错误: {str(e)[:30]}'
+        except OSError as e:
+            result['error'] = f'连接错误: {str(e)[:30]}'
+            result['local_error'] = is_local_resource_error(e)
+        except Exception as e:
+            result['error'] = f'其他错误: {str(e)[:30]}'
+            result['local_error'] = is_local_resource_error(e)
+        finally:
+            if writer is not None:
+                writer.close()
+        
+        return result
+    
+    async def async_test_proxy_connectivity(self, proxy, proxy_type):
+        """异步测试单个代理的连通性（逻辑与test_proxy_connectivity一致）"""
+        if self.race_targets and len(self.get_test_urls()) > 1:
+            return await self._async_race_proxy_sites(proxy, proxy_type)
+        
+        best_result = None
+        
+        for test_config in self.get_test_urls():
+            result = await self.async_test_single_url(proxy, test_config, proxy_type)
+            
+            if result['success']:
+                return result
+            
+            best_result = self._better_failure(best_result, result)
+            
+            if result.get('status_code', 0) > 0:
+                break
+        
+        return best_result or self._all_failed_result(proxy, proxy_type)
+    
+    async def _async_race_proxy_sites(self, proxy, proxy_type):
+        """竞速测试（逻辑与_race_proxy_sites一致），胜出后取消其余请求并关闭其连接"""
+        test_urls = self.get_test_urls()
+        pending = set()
+        best_result = None
+        launched = 0
+        
+        try:
+            while launched < len(test_urls) or pending:
+                if launched < len(test_urls):
+                    pending.add(asyncio.ensure_future(
+                        self.async_test_single_url(proxy, test_urls[launched], proxy_type)))
+                    launched += 1
+                
+                stagger = self.race_stagger if launched < len(test_urls) else None
+                done, pending = await asyncio.wait(pending, timeout=stagger,
+                                                   return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    result = task.result()
+                    if result['success']:
+                        return result
+                    best_result = self._better_failure(best_result, result)
+                    if result.get('status_code', 0) > 0:
+                        test_urls = test_urls[:launched]
+        finally:
+            for task in pending:
+                task.cancel()
+            if pending:
+                await asyncio.gather(*pending, return_exceptions=True)
+        
+        return best_result or self._all_failed_result(proxy, proxy_type)
+    
+    async def _async_batch_test(self, proxies, proxy_type, controller):
+        """在单个事件循环上并发测试，同时在途的探测数由并发控制器决定"""
+        all_results = []
+        successful_results = []
+        pending = deque(proxies)
+        tasks = {}
+        skipped = 0
+        # 完成的任务由回调放入队列，不必每次在全部在途任务上asyncio.wait
+        completed = asyncio.Queue()
+        
+        with ProgressReporter(self, len(proxies)):
+            while pending or tasks:
+                while pending and len(tasks) < controller.limit:
+                    if not self._can_launch():
+                        skipped += len(pending)
+                        pending.clear()
+                        break
+                    proxy = pending.popleft()
+                    self._probe_started(proxy_type)
+                    task = asyncio.ensure_future(self.async_test_proxy_connectivity(proxy, proxy_type))
+                    tasks[task] = proxy
+                    task.add_done_callback(completed.put_nowait)
+                
+                if not tasks:
+                    break
+                
+                task = await completed.get()
+                result = self._probe_result(task, tasks.pop(task), proxy_type)
+                self._record_result(result, len(proxies), all_results, successful_results)
+                self._observe_concurrency(controller, result)
+        
+        if skipped:
+            self.budget_skipped += skipped
+            print(f"\n⏳⏳⏳⏳ 预算用尽，{skipped} 个代理未测试")
+        return all_results, successful_results
+    
+    def async_batch_test_proxies(self, proxies, proxy_type, concurrency=500):
+        """批量测试代理（asyncio引擎）"""
+        if not proxies:
+            return [], []
+        
+        controller = self._new_controller(concurrency, "async")
+        
+        print(f"\n🚀🚀🚀🚀 开始测试 {len(proxies)} 个{proxy_type}代理 (asyncio引擎)")
+        print(f"📊📊📊📊 并发上限: 初始 {controller.limit}，自适应上限 {controller.maximum}")
+        self._print_probe_timeouts()
+        print("-"*50)
+        
+        start_time = time.time()
+        all_results, successful_results = asyncio.run(
+            self._async_batch_test(proxies, proxy_type, controller)
+        )
+        total_time = time.time() - start_time
+        
+        print()
+        print(f"🎛🎛🎛🎛 并发: {controller.describe()}")
+        self._print_timeout_summary()
+        self._print_collector_summary()
+        print(f"⏱⏱⏱⏱⏱⏱⏱⏱⏱ 总耗时: {total_time:.1f}秒")
+        print(f"📊📊📊📊 平均速度: {len(proxies)/total_time:.1f}个/秒")
+        self._print_bytes_summary(all_results)
+        
+        return all_results, successful_results
+    
+    def _print_probe_timeouts(self):
+        """打印各网站在ym.txt中的超时，以及自适应超时当前生效的截止时间"""
+        test_urls = self.get_test_urls()
+        if not test_urls:
+            return
+        sites = " | ".join(f"{config.get('site_abbr', config['name']).upper()} {config.get('timeout', 8):g}秒"
+                           for config in test_urls)
+        print(f"⏱⏱⏱⏱⏱⏱⏱⏱⏱ 超时时间: {sites}")
+        if self.timeout_policy.enabled:
+            base = max((config.get('timeout', 8) for config in test_urls), default=8)
+            connect, read = self.timeout_policy.deadlines(base)
+            print(f"⏱⏱⏱⏱⏱⏱⏱⏱⏱ 自适应截止: 连接 {connect:.1f}秒 / 读取 {read:.1f}秒（不超过各网站的超时）")
+    
+    def _print_timeout_summary(self):
+        """打印当前的自适应超时截止时间与提前终止数"""
+        if self.timeout_policy.enabled:
+            base = max((config.get('timeout', 8) for config in self.get_test_urls()), default=8)
+            print(f"⏱⏱⏱⏱⏱⏱⏱⏱⏱ 自适应超时: {self.timeout_policy.describe(base)}")
+    
+    def _print_collector_summary(self):
+        """结果收集与进度输出的累计开销（调度线程上的串行部分）"""
+        metrics = self.metrics
+        recorded = metrics.total('daili_probes_finished_total')
+        record_seconds = metrics.value('daili_result_record_seconds_total')
+        writes = metrics.value('daili_progress_writes_total')
+        write_seconds = metrics.value('daili_progress_write_seconds_total')
+        print(f"🧾🧾🧾🧾 结果收集: {recorded} 条，共 {record_seconds * 1000:.0f}ms "
+              f"(每条 {record_seconds / max(recorded, 1) * 1e6:.0f}µs) | "
+              f"进度输出: {writes} 次，共 {write_seconds * 1000:.1f}ms")
+    
+    def _print_bytes_summary(self, all_results):
+        """打印页面校验读取的字节数"""
+        read_results = [r for r in all_results if r.get('bytes_read')]
+        if read_results:
+            total_bytes = sum(r['bytes_read'] for r in read_results)
+            print(f"📦📦📦📦 页面读取: {total_bytes / 1024:.1f}KB | "
+                  f"平均每次探测 {total_bytes / len(read_results) / 1024:.1f}KB | "
+                  f"上限 {self.body_cap_bytes // 1024}KB")
+    
+    def _resolve(self, host):
+        """同步解析主机名为IPv4地址（带缓存）"""
+        try:
+            ipaddress.ip_address(host)
+            return host
+        except ValueError:
+            pass
+        
+        if host not in self._dns_cache:
+            self._dns_cache[host] = socket.gethostbyname(host)
+        return self._dns_cache[host]
+    
+    def _sweep_addresses(self, proxies, proxy_type):
+        """解析扫描所需的 (代理, (地址族, socket地址))，域名与IPv6地址在线程池中并发解析"""
+        endpoints = []
+        for proxy in proxies:
+            _, host, port, _, _ = split_proxy_url(self.get_proxy_url(proxy, proxy_type))
+            endpoints.append((proxy, host, port))
+        
+        # 纯IPv4地址直接使用；域名和IPv6地址（可能带%网卡）交给getaddrinfo选择地址族
+        hostnames = {host for _, host, _ in endpoints if host and not host.replace('.', '').isdigit()}
+        resolved = {}
+        
+        def resolve(host):
+            try:
+                family, _, _, _, sockaddr = socket.getaddrinfo(host, None, 0, socket.SOCK_STREAM)[0]
+                return host, (family, sockaddr)
+            except (socket.gaierror, UnicodeError, IndexError):
+                return host, None
+        
+        if hostnames:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=32) as executor:
+                resolved = dict(executor.map(resolve, hostnames))
+        
+        addresses = []
+        for proxy, host, port in endpoints:
+            if not host:
+                address = None
+            elif host in resolved:
+                entry = resolved[host]
+                # IPv6的socket地址为 (地址, 端口, flowinfo, scope_id)
+                address = entry and (entry[0], (entry[1][0], port) + tuple(entry[1][2:]))
+            else:
+                address = (socket.AF_INET, (host, port))
+            addresses.append((proxy, address))
+        return addresses
+    
+    def tcp_sweep(self, proxies, proxy_type, timeout=None, max_sockets=None):
+        """非阻塞TCP连接扫描（selectors/epoll），同时打开数千个socket
+        
+        返回 (按连接延迟排序的[(代理, 连接ms)], 不可达代理的结果列表)，
+        连接延迟同时记录到self.connect_latency，之后写入该代理结果的phases['tcp']。
+        """
+        timeout = timeout or self.sweep_timeout
+        max_sockets = max_sockets or self.sweep_max_sockets
+        # 给线程池、日志文件等保留一部分文件描述符
+        max_sockets = max(16, min(max_sockets, fd_limit() - 128))
+        
+        print(f"\n📡📡📡📡 TCP可达性扫描 {len(proxies)} 个{proxy_type}代理")
+        print(f"📊📊📊📊 同时打开socket上限: {max_sockets} | 连接超时: {timeout}秒")
+        
+        start_time = time.monotonic()
+        pending = deque()
+        reachable = []
+        rejected_results = []
+        
+        def reject(proxy, error):
+            result = self._new_result(proxy, {'name': 'TCP连接', 'url': 'tcp'}, proxy_type)
+            result['error'] = error
+            rejected_results.append(result)
+        
+        for proxy, address in self._sweep_addresses(proxies, proxy_type):
+            if address is None:
+                reject(proxy, 'DNS解析失败')
+            else:
+                pending.append((proxy, address))
+        
+        selector = selectors.DefaultSelector()
+        in_flight = {}        # fd -> (socket, 代理, 开始时间)
+        deadlines = deque()   # (截止时间, fd, socket)，超时相同所以天然有序
+        
+        try:
+            while pending or in_flight:
+                # 填满并发窗口
+                while pending and len(in_flight) < max_sockets:
+                    proxy, (family, address) = pending.popleft()
+                    try:
+                        sock = socket.socket(family, socket.SOCK_STREAM)
+                    except OSError as e:
+                        if e.errno in (errno.EMFILE, errno.ENFILE, errno.ENOBUFS) and in_flight:
+                            # 文件描述符耗尽: 收缩窗口，等待已有连接完成
+                            pending.appendleft((proxy, (family, address)))
+                            max_sockets = max(16, len(in_flight) - 16)
+                            break
+                        reject(proxy, f'连接错误: {str(e)[:30]}')
+                        continue
+                    
+                    sock.setblocking(False)
+                    err = sock.connect_ex(address)
+                    now = time.monotonic()
+                    if err in (0, errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EALREADY):
+                        selector.register(sock, selectors.EVENT_WRITE)
+                        in_flight[sock.fileno()] = (sock, proxy, now)
+                        deadlines.append((now + timeout, sock.fileno(), sock))
+                    else:
+                        sock.close()
+                        reject(proxy, '连接被拒绝' if err == errno.ECONNREFUSED else f'连接错误: {os.strerror(err)[:30]}')
+                
+                if not in_flight:
+                    continue
+                
+                wait = max(0, deadlines[0][0] - time.monotonic()) if deadlines else timeout
+                for key, _ in selector.select(timeout=wait):
+                    sock, proxy, started = in_flight.pop(key.fd)
+                    selector.unregister(sock)
+                    err = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                    sock.close()
+                    if err == 0:
+                        connect_ms = (time.monotonic() - started) * 1000
+                        reachable.append((proxy, connect_ms))
+                    elif err == errno.ECONNREFUSED:
+                        reject(proxy, '连接被拒绝')
+                    else:
+                        reject(proxy, f'连接错误: {os.strerror(err)[:30]}')
+                
+                # 清理超时的连接
+                now = time.monotonic()
+                while deadlines and deadlines[0][0] <= now:
+                    _, fd, sock = deadlines.popleft()
+                    entry = in_flight.get(fd)
+                    if entry is not None and entry[0] is sock:
+                        del in_flight[fd]
+                        selector.unregister(sock)
+                        sock.close()
+                        reject(entry[1], '连接超时')
+                # 丢弃已完成连接留下的截止时间记录
+                while deadlines and in_flight.get(deadlines[0][1], (None,))[0] is not deadlines[0][2]:
+                    deadlines.popleft()
+        finally:
+            for sock, _, _ in in_flight.values():
+                sock.close()
+            selector.close()
         
-        return result
+        reachable.sort(key=lambda item: item[1])
+        for proxy, connect_ms in reachable:
+            self.connect_latency[proxy] = connect_ms
+        
+        sweep_time = time.monotonic() - start_time
+        self.stage_stats.setdefault(proxy_type, {})['tcp_reachable'] = len(reachable)
+        print(f"✅ TCP扫描完成: {len(reachable)}/{len(proxies)} 可达，耗时 {sweep_time:.1f}秒")
+        
+        return reachable, rejected_results
     
-    def test_proxy_connectivity(self, proxy, proxy_type):
-        """测试单个代理的连通性"""
+    def _history_score(self, record, now):
+        """历史成功概率 × 成功新近度；未测试过的代理取先验0.5"""
+        if record is None:
+            return 0.5
+        test_count, success_count, _, _, last_success = record
+        # Beta(1,1)先验下的成功率估计
+        probability = (success_count + 1) / (test_count + 2)
+        if last_success is None:
+            return probability * 0.5
+        recency = math.exp(-max(0, now - last_success) * math.log(2) / self.success_half_life)
+        return probability * (0.5 + 0.5 * recency)
+    
+    def _in_backoff(self, proxy, record, now):
+        """连续失败的代理是否仍在退避期内（少量按天抽查，不受退避限制）"""
+        if record is None:
+            return False
+        _, _, failure_streak, last_tested, _ = record
+        if failure_streak < self.backoff_after or last_tested is None:
+            return False
+        
+        wait = min(self.backoff_max, self.backoff_base * 2 ** (failure_streak - self.backoff_after))
+        if now - last_tested >= wait:
+            return False
+        
+        # 抽查: 按 代理+日期 做确定性哈希，同一天内结果稳定
+        day = int(now // 86400)
+        bucket = zlib.crc32(f"{proxy}|{day}".encode()) % 10000
+        return bucket >= self.recheck_ratio * 10000
+    
+    def order_by_history(self, proxies, proxy_type):
+        """按历史成功概率排序并跳过退避中的代理，返回 (排序后列表, 跳过数量)
+        
+        排序键: 历史分数高者优先；分数相同（如都未测试过）时TCP扫描的连接延迟低者优先，
+        未扫描的代理保持原有顺序。
+        """
+        history = self.store.history(proxy_type.lower())
+        now = time.time()
+        scored = []
+        skipped = 0
+        connect_latency = self.connect_latency
+        
+        for proxy in proxies:
+            try:
+                record = history.get(self._endpoint(proxy, proxy_type))
+            except ValueError:
+                record = None
+            if self._in_backoff(proxy, record, now):
+                skipped += 1
+                continue
+            scored.append((-self._history_score(record, now), connect_latency.get(proxy, math.inf), proxy))
+        
+        # 稳定排序: 分数和连接延迟都相同时保持原有顺序
+        scored.sort(key=lambda item: item[:2])
+        return [proxy for _, _, proxy in scored], skipped
+    
+    def prepare_candidates(self, proxies, proxy_type):
+        """测试前的候选预处理，返回 (待测代理列表, 已判定失败的结果列表)"""
+        if self.shard is not None:
+            total = len(proxies)
+            proxies = self._own_shard(proxies, proxy_type)
+            print(f"🧩🧩🧩🧩 分片 {self.shard[0]}/{self.shard[1]}: {proxy_type} {total} 个候选中 {len(proxies)} 个属于本分片")
+        proxies = self._skip_resumed(proxies, proxy_type)
+        if not proxies:
+            return proxies, []
+        
+        use_history = self.history_ordering and self.store is not None
+        if use_history:
+            # 先跳过退避中的代理，省下后续扫描和测试的开销
+            ordered, skipped = self.order_by_history(proxies, proxy_type)
+            print(f"📚📚📚📚 历史排序: {len(ordered)} 个待测，{skipped} 个连续失败的代理处于退避期被跳过")
+            self.stage_stats.setdefault(proxy_type, {})['backoff_skipped'] = skipped
+            proxies = ordered
+        
+        if not self.sweep_enabled:
+            return proxies, []
+        
+        reachable, rejected_results = self.tcp_sweep(proxies, proxy_type)
+        self._journal_results(rejected_results)
+        # 无历史时按连接延迟排序；有历史时历史分数优先，连接延迟作为次要键
+        proxies = [proxy for proxy, _ in reachable]
+        if use_history:
+            proxies, _ = self.order_by_history(proxies, proxy_type)
+        return proxies, rejected_results
+    
+    def _handshake_target(self):
+        """协议握手阶段使用的目标地址（取第一个测试网站）"""
         test_urls = self.get_test_urls()
-        best_result = None
+        if not test_urls:
+            return None, None
+        parsed = urlparse(test_urls[0]['url'])
+        return parsed.hostname, parsed.port or (443 if parsed.scheme == 'https' else 80)
+    
+    def check_proxy_handshake(self, proxy, proxy_type, target_host, target_port, timeout=None):
+        """原始socket协议握手检查，返回 (是否通过, 错误信息, 耗时ms)
         
-        for test_config in test_urls:
-            result = self.test_single_url(proxy, test_config, proxy_type)
-            
-            if result['success']:
-                return result
+        SOCKS4: CONNECT请求并等待0x5A授权；SOCKS5: 问候+方法协商+CONNECT；
+        HTTP/HTTPS: CONNECT请求需返回200。不发起TLS和页面请求。
+        """
+        timeout = timeout or self.handshake_timeout
+        proxy_url = self.get_proxy_url(proxy, proxy_type)
+        scheme, proxy_host, proxy_port, username, password = split_proxy_url(proxy_url)
+        phase = 'connect'
+        start_time = time.perf_counter()
+        sock = None
+        
+        try:
+            sock = socket.create_connection((proxy_host, proxy_port), timeout=timeout)
+            if scheme == 'https':
+                sock = self._ssl_context.wrap_socket(sock, server_hostname=proxy_host)
             
-            if best_result is None or (result.get('status_code', 0) > 0 and best_result.get('status_code', 0) == 0):
-                best_result = result
+            phase = 'handshake'
+            target_ip = self._resolve(target_host) if scheme.startswith('socks') else None
+            drive_handshake_sync(sock, proxy_handshake_steps(
+                scheme, target_host, target_ip, target_port, username, password
+            ))
+            return True, None, (time.perf_counter() - start_time) * 1000
+        
+        except socket.timeout:
+            error = '连接超时' if phase == 'connect' else '代理超时'
+        except ConnectionRefusedError:
+            error = '连接被拒绝'
+        except ConnectionResetError:
+            error = '连接被重置'
+        except ProxyHandshakeError as e:
+            error = 'SOCKS代理错误' if scheme.startswith('socks') else f'代理错误: {str(e)[:30]}'
+        except ssl.SSLError as e:
+            error = f'SSL错误: {str(e)[:30]}'
+        except OSError as e:
+            error = f'连接错误: {str(e)[:30]}'
+        except Exception as e:
+            error = f'其他错误: {str(e)[:30]}'
+        finally:
+            if sock is not None:
+                sock.close()
+        
+        return False, error, (time.perf_counter() - start_time) * 1000
+    
+    async def async_check_proxy_handshake(self, proxy, proxy_type, target_host, target_port, timeout=None):
+        """check_proxy_handshake的asyncio版本，返回 (是否通过, 错误信息, 耗时ms)"""
+        timeout = timeout or self.handshake_timeout
+        proxy_url = self.get_proxy_url(proxy, proxy_type)
+        scheme, proxy_host, proxy_port, username, password = split_proxy_url(proxy_url)
+        proxy_ssl = self._ssl_context if scheme == 'https' else None
+        phase = 'connect'
+        start_time = time.perf_counter()
+        writer = None
+        
+        try:
+            proxy_ip = await self._async_resolve(proxy_host)
+            reader, writer = await asyncio.wait_for(asyncio.open_connection(
+                proxy_ip, proxy_port, ssl=proxy_ssl, server_hostname=proxy_host if proxy_ssl else None
+            ), timeout)
             
-            if result.get('status_code', 0) > 0:
-                break
+            phase = 'handshake'
+            target_ip = await self._async_resolve(target_host) if scheme.startswith('socks') else None
+            remaining = max(0.1, timeout - (time.perf_counter() - start_time))
+            await asyncio.wait_for(drive_handshake_async(reader, writer, proxy_handshake_steps(
+                scheme, target_host, target_ip, target_port, username, password
+            )), remaining)
+            return True, None, (time.perf_counter() - start_time) * 1000
         
-        return best_result or {
-            'proxy': proxy,
-            'proxy_type': proxy_type,
-            'success': False,
-            'error': '所有测试都失败',
-            'latency_ms': 0,
-            'test_name': '综合测试',
-            'test_url': '多个URL',
-            'timestamp': datetime.now().strftime("%H:%M:%S"),
-            'site_abbr': 'unk'
-        }
+        except asyncio.TimeoutError:
+            error = '连接超时' if phase == 'connect' else '代理超时'
+        except ConnectionRefusedError:
+            error = '连接被拒绝'
+        except ConnectionResetError:
+            error = '连接被重置'
+        except ProxyHandshakeError as e:
+            error = 'SOCKS代理错误' if scheme.startswith('socks') else f'代理错误: {str(e)[:30]}'
+        except ssl.SSLError as e:
+            error = f'SSL错误: {str(e)[:30]}'
+        except OSError as e:
+            error = f'连接错误: {str(e)[:30]}'
+        except Exception as e:
+            error = f'其他错误: {str(e)[:30]}'
+        finally:
+            if writer is not None:
+                writer.close()
+        
+        return False, error, (time.perf_counter() - start_time) * 1000
     
-    def batch_test_proxies(self, proxies, proxy_type, max_workers=20):
-        """批量测试代理"""
+    def tiered_test_proxies(self, proxies, proxy_type, max_workers=20):
+        """分级验证：阶段1协议握手 -> 阶段2完整HTTP测试（test_single_url）"""
         if not proxies:
             return [], []
         
-        print(f"\n🚀🚀🚀🚀 开始测试 {len(proxies)} 个{proxy_type}代理")
-        print(f"📊📊📊📊 并发线程: {max_workers}")
-        print(f"⏱⏱⏱⏱⏱⏱⏱⏱⏱ 超时时间: 8秒")
-        print("-"*50)
-        
-        all_results = []
-        successful_results = []
+        target_host, target_port = self._handshake_target()
+        if not target_host:
+            return self.batch_test_proxies(proxies, proxy_type, max_workers)
         
-        def worker(proxy):
-            result = self.test_proxy_connectivity(proxy, proxy_type)
-            
-            with self.lock:
-                all_results.append(result)
-                
-                if result['success']:
-                    successful_results.append(result)
-                
-                self.total_tested += 1
-                if result['success']:
-                    self.successful += 1
-                else:
-                    self.failed += 1
-                
-                if self.total_tested % 10 == 0 or self.total_tested == len(proxies):
-                    percentage = self.total_tested / len(proxies) * 100
-                    print(f"\r📈📈📈📈 进度: {self.total_tested}/{len(proxies)} "
-                          f"[{percentage:.1f}%] | "
-                          f"✅: {self.successful} | "
-                          f"❌❌❌❌: {self.failed}", end="")
-            
-            return result
+        print(f"\n🤝🤝🤝🤝 阶段1: {proxy_type}协议握手检查 {len(proxies)} 个代理")
+        print(f"📊📊📊📊 握手目标: {target_host}:{target_port} | 并发: {self.handshake_workers}")
         
         start_time = time.time()
+        survivors = []
+        rejected_results = []
         
-        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
-            futures = {executor.submit(worker, proxy): proxy for proxy in proxies}
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.handshake_workers) as executor:
+            futures = {
+                executor.submit(self.check_proxy_handshake, proxy, proxy_type, target_host, target_port): proxy
+                for proxy in proxies
+            }
             for future in concurrent.futures.as_completed(futures):
-                pass
+                proxy = futures[future]
+                try:
+                    ok, error, handshake_ms = future.result()
+                except Exception as e:
+                    ok, error, handshake_ms = False, f'其他错误: {str(e)[:30]}', 0
+                if ok:
+                    survivors.append(proxy)
+                else:
+                    result = self._new_result(proxy, {'name': '协议握手', 'url': f"{target_host}:{target_port}"}, proxy_type)
+                    result['latency_ms'] = handshake_ms
+                    result['error'] = error
+                    rejected_results.append(result)
         
-        total_time = time.time() - start_time
+        handshake_time = time.time() - start_time
+        self._journal_results(rejected_results)
+        print(f"✅ 阶段1完成: {len(survivors)}/{len(proxies)} 通过握手，耗时 {handshake_time:.1f}秒")
         
-        print()
-        print(f"⏱⏱⏱⏱⏱⏱⏱⏱⏱ 总耗时: {total_time:.1f}秒")
-        print(f"📊📊📊📊 平均速度: {len(proxies)/total_time:.1f}个/秒")
+        # 保持原始顺序，阶段2只测试通过握手的代理
+        survivor_set = set(survivors)
+        survivors = [proxy for proxy in proxies if proxy in survivor_set]
+        all_results, successful_results = self.batch_test_proxies(survivors, proxy_type, max_workers)
         
-        return all_results, successful_results
+        self.stage_stats.setdefault(proxy_type, {}).update({
+            'candidates': len(proxies),
+            'handshake_passed': len(survivors),
+            'http_passed': len(successful_results),
+            'handshake_seconds': round(handshake_time, 1),
+        })
+        
+        print(f"\n📊📊📊📊 分级统计: 候选 {len(proxies)} -> 握手通过 {len(survivors)} -> HTTP通过 {len(successful_results)}")
+        
+        return rejected_results + all_results, successful_results
     
     def display_results(self, all_results, successful_results, proxy_type):
-        """显示测试结果"""
+        """显示测试结果
+        
+        统计来自测试过程中逐条更新的ResultAggregator；结果列表与汇总不一致时
+        （续测、合并分片、单独调用batch_test_proxies）才对all_results重新汇总一遍。
+        """
         print("\n" + "="*60)
         print("📊📊📊📊 测试结果汇总")
         print("="*60)
         
-        total = len(all_results)
-        success_rate = (self.successful / total * 100) if total > 0 else 0
+        aggregator = self.aggregators.get(proxy_type)
+        if (aggregator is None or aggregator.total != len(all_results)
+                or aggregator.successful != len(successful_results)):
+            aggregator = self.aggregators[proxy_type] = ResultAggregator.from_results(all_results)
+        
+        total = aggregator.total
+        successful = aggregator.successful
+        success_rate = (successful / total * 100) if total > 0 else 0
         
         print(f"代理类型: {proxy_type}")
         print(f"总代理数: {total}")
-        print(f"成功代理: {self.successful} ({success_rate:.1f}%)")
-        print(f"失败代理: {total - self.successful}")
+        print(f"成功代理: {successful} ({success_rate:.1f}%)")
+        print(f"失败代理: {aggregator.failed}")
         
-        if successful_results:
-            site_stats = {}
-            for result in successful_results:
-                site_abbr = result.get('site_abbr', 'unk')
-                site_stats[site_abbr] = site_stats.get(site_abbr, 0) + 1
-            
+        if successful:
             print(f"\n🌐🌐🌐🌐 成功网站分布:")
-            for site_abbr, count in site_stats.items():
+            for site_abbr, count in aggregator.site_counts.items():
                 print(f"  {site_abbr.upper()}成功: {count}个")
-        
-        if successful_results:
-            latencies = [r['latency_ms'] for r in successful_results]
-            avg_latency = sum(latencies) / len(latencies)
-            min_latency = min(latencies)
-            max_latency = max(latencies)
             
             print(f"\n⏱⏱⏱⏱⏱⏱⏱⏱⏱ 延迟统计:")
-            print(f"  平均延迟: {avg_latency:.0f}ms")
-            print(f"  最快延迟: {min_latency:.0f}ms")
-            print(f"  最慢延迟: {max_latency:.0f}ms")
+            print(f"  平均延迟: {aggregator.latency_sum / successful:.0f}ms")
+            print(f"  最快延迟: {aggregator.latency_min:.0f}ms")
+            print(f"  最慢延迟: {aggregator.latency_max:.0f}ms")
+            
+            if aggregator.phases:
+                print(f"\n🔬🔬🔬🔬 分阶段延迟 (P50 / P90 / P99):")
+                for name, label in PHASE_LABELS.items():
+                    histogram = aggregator.phases.get(name)
+                    if histogram is not None:
+                        print(f"  {label:6s}: {histogram.percentile(50):6.0f}ms / {histogram.percentile(90):6.0f}ms / "
+                              f"{histogram.percentile(99):6.0f}ms  ({histogram.count}个)")
             
             print(f"\n📈📈📈📈 延迟分布:")
-            latency_ranges = [
-                (0, 100, "极快 <100ms"),
-                (100, 200, "快速 100-200ms"),
-                (200, 500, "中等 200-500ms"),
-                (500, 1000, "较慢 500ms-1s"),
-                (1000, 3000, "慢 1-3s"),
-                (3000, float('inf'), "很慢 >3s")
-            ]
-            
-            for min_r, max_r, label in latency_ranges:
-                count = sum(1 for r in successful_results if min_r <= r['latency_ms'] < max_r)
+            for (_, _, label), count in zip(ResultAggregator.LATENCY_RANGES, aggregator.range_counts):
                 if count > 0:
-                    percentage = count / len(successful_results) * 100
+                    percentage = count / successful * 100
                     bar_length = int(percentage / 5)
                     bar = "█" * bar_length
                     print(f"  {label:15s}: {count:3d}个 ({percentage:5.1f}%) {bar}")
-        
-        if successful_results:
-            fastest = sorted(successful_results, key=lambda x: x['latency_ms'])[:5]
             
-            print(f"\n🚀🚀🚀🚀 最快的5个代理:")
-            for i, result in enumerate(fastest, 1):
+            print(f"\n🚀🚀🚀🚀 最快的{aggregator.top_k}个代理:")
+            for i, result in enumerate(aggregator.fastest(), 1):
                 latency = result['latency_ms']
                 site_abbr = result.get('site_abbr', 'unk')
                 
@@ -840,90 +3576,103 @@ class GitHubProxyTester:
                 
                 print(f"  {i}. {indicator} {result['proxy']:20s} | {latency:5.0f}ms | {site_abbr}")
         
-        failed_results = [r for r in all_results if not r['success']]
-        if failed_results:
-            error_stats = {}
-            for r in failed_results:
-                error = r.get('error', '未知错误')
-                error_key = error.split(':')[0] if ':' in error else error
-                error_stats[error_key] = error_stats.get(error_key, 0) + 1
-            
-            print(f"\n❌❌❌❌ 失败原因分析 ({len(failed_results)} 个):")
-            for error, count in sorted(error_stats.items(), key=lambda x: x[1], reverse=True)[:5]:
-                percentage = count / len(failed_results) * 100
+        if aggregator.failed:
+            print(f"\n❌❌❌❌ 失败原因分析 ({aggregator.failed} 个):")
+            for error, count in sorted(aggregator.error_counts.items(), key=lambda x: x[1], reverse=True)[:5]:
+                percentage = count / aggregator.failed * 100
                 print(f"  {error:30s}: {count:3d}个 ({percentage:5.1f}%)")
     
-    def extract_proxy_info_from_txt(self, txt_file_path, proxy_type):
-        """从txt文件中提取代理信息，去掉协议头"""
-        proxies_list = []
+    def _record_into_store(self, all_results, proxy_type):
+        """把本次测试结果写入健康库，返回从库中导出的本次成功代理"""
+        store_type = proxy_type.lower()
+        rows = []
+        for result in all_results:
+            try:
+                host, port = self._endpoint(result['proxy'], proxy_type)
+            except ValueError:
+                continue
+            rows.append((host, port, result['proxy'], bool(result['success']),
+                         result.get('latency_ms', 0), result.get('site_abbr', 'unk')))
+        self.store.record_results(store_type, rows)
+        return self.store.successful_since(store_type, self.run_started)
+    
+    def export_results(self, total, successful_results, proxy_type):
+        """一次遍历内存中的成功结果，写出三种格式（均为原子替换），返回 {格式: 路径}
         
-        try:
-            with open(txt_file_path, 'r', encoding='utf-8') as f:
-                for line in f:
-                    line = line.strip()
-                    if line and not line.startswith('#'):
-                        # 提取/#之前的所有内容
-                        if '/#' in line:
-                            full_proxy = line.split('/#')[0].strip()
-                        else:
-                            full_proxy = line
-                        
-                        # 使用合并的清理和验证功能
-                        proxy = self.clean_and_validate_proxy(full_proxy)
-                        if proxy:
-                            proxies_list.append(proxy)
+        txt:       协议://IP:端口/#延迟ms%20网站缩写（原有格式）
+        json:      {"ts": [协议://IP:端口, ...]}（仓库根目录daili.py读取）
+        annotated: 每个代理的延迟、通过的网站、测试地址和分阶段耗时
+        """
+        successful_sorted = sorted(successful_results, key=lambda x: x['latency_ms'])
+        tested_at = datetime.now()
+        
+        txt_lines = [
+            f"# {proxy_type}代理测试结果 - 有效代理列表\n",
+            f"# 总测试数: {total}\n",
+            f"# 成功代理: {len(successful_results)}\n",
+            f"# 成功率: {len(successful_results)/total*100:.1f}%\n",
+            f"# 测试时间: {tested_at.strftime('%Y-%m-%d %H:%M:%S')}\n",
+            f"# 格式: 协议://IP:端口/#延迟ms%20网站缩写\n",
+            "#"*60 + "\n\n",
+        ]
+        json_proxies = []
+        annotated = []
+        
+        for result in successful_sorted:
+            latency = result['latency_ms']
+            site_abbr = result.get('site_abbr', 'unk')
             
-            print(f"✅ 从txt文件中提取了 {len(proxies_list)} 个{proxy_type}代理")
-            return proxies_list
+            if latency.is_integer():
+                latency_str = f"{int(latency)}ms"
+            else:
+                latency_str = f"{latency:.1f}ms"
             
-        except Exception as e:
-            print(f"❌❌❌❌ 从txt文件提取代理信息失败: {e}")
-            return []
+            proxy_url = self.get_proxy_url(result['proxy'], proxy_type)
+            txt_lines.append(f"{proxy_url}/#{latency_str}%20{site_abbr}\n")
+            json_proxies.append(proxy_url)
+            
+            entry = {'proxy': proxy_url, 'latency_ms': round(latency, 1), 'site': site_abbr}
+            if result.get('test_url'):
+                entry['test_url'] = result['test_url']
+            if result.get('phases'):
+                entry['phases'] = {name: round(ms, 1) for name, ms in result['phases'].items()}
+            annotated.append(entry)
+        
+        base = os.path.join(self.result_dir, proxy_type.lower())
+        paths = {'txt': f"{base}.txt", 'json': f"{base}.json", 'annotated': f"{base}.annotated.json"}
+        write_atomic(paths['txt'], "".join(txt_lines))
+        write_atomic(paths['json'], json.dumps({"ts": json_proxies}, indent=2, ensure_ascii=False))
+        write_atomic(paths['annotated'], json.dumps({
+            'type': proxy_type,
+            'tested_at': tested_at.strftime('%Y-%m-%d %H:%M:%S'),
+            'total': total,
+            'successful': len(successful_results),
+            'proxies': annotated,
+        }, indent=2, ensure_ascii=False))
+        return paths
     
     def save_results(self, all_results, successful_results, proxy_type):
         """保存测试结果到result文件夹"""
+        if self.shard is not None:
+            # 各分片只有部分结果，输出文件和健康库留给合并步骤
+            print(f"🧩🧩🧩🧩 分片 {self.shard[0]}/{self.shard[1]}: {proxy_type}结果保留在 "
+                  f"{os.path.basename(self.journal.path)}，由 --merge 合并输出")
+            return None
+        
+        if self.store is not None and all_results:
+            # 库中导出的结果没有测试地址和分阶段耗时，从本次的内存结果补上
+            details = {r['proxy']: r for r in successful_results}
+            successful_results = [dict(details.get(r['proxy'], {}), **r)
+                                  for r in self._record_into_store(all_results, proxy_type)]
+        
         if successful_results:
-            successful_sorted = sorted(successful_results, key=lambda x: x['latency_ms'])
-            
-            # 1. 保存为txt格式（原有格式）
-            result_txt_file = os.path.join(self.result_dir, f"{proxy_type.lower()}.txt")
-            
-            with open(result_txt_file, 'w', encoding='utf-8') as f:
-                f.write(f"# {proxy_type}代理测试结果 - 有效代理列表\n")
-                f.write(f"# 总测试数: {len(all_results)}\n")
-                f.write(f"# 成功代理: {len(successful_results)}\n")
-                f.write(f"# 成功率: {len(successful_results)/len(all_results)*100:.1f}%\n")
-                f.write(f"# 测试时间: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n")
-                f.write(f"# 格式: 协议://IP:端口/#延迟ms%20网站缩写\n")
-                f.write("#"*60 + "\n\n")
-                
-                for i, result in enumerate(successful_sorted, 1):
-                    proxy = result['proxy']
-                    latency = result['latency_ms']
-                    site_abbr = result.get('site_abbr', 'unk')
-                    
-                    if latency.is_integer():
-                        latency_str = f"{int(latency)}ms"
-                    else:
-                        latency_str = f"{latency:.1f}ms"
-                    
-                    proxy_url = self.get_proxy_url(proxy, proxy_type)
-                    f.write(f"{proxy_url}/#{latency_str}%20{site_abbr}\n")
+            paths = self.export_results(len(all_results), successful_results, proxy_type)
+            result_txt_file = paths['txt']
             
             print(f"💾💾💾💾 TXT结果已保存: {result_txt_file}")
-            
-            # 2. 从txt文件中提取代理信息并保存为JSON格式
-            json_proxies = self.extract_proxy_info_from_txt(result_txt_file, proxy_type)
-            
-            if json_proxies:
-                result_json_file = os.path.join(self.result_dir, f"{proxy_type.lower()}.json")
-                json_data = {"ts": json_proxies}
-                
-                with open(result_json_file, 'w', encoding='utf-8') as f:
-                    json.dump(json_data, f, indent=2, ensure_ascii=False)
-                
-                print(f"💾💾💾💾 JSON结果已保存: {result_json_file}")
-                print(f"📋📋📋📋 JSON格式: {{'ts': [代理列表]}}")
+            print(f"💾💾💾💾 JSON结果已保存: {paths['json']}")
+            print(f"📋📋📋📋 JSON格式: {{'ts': [代理列表]}}")
+            print(f"💾💾💾💾 带注释结果已保存: {paths['annotated']}")
             
             return result_txt_file
         else:
@@ -939,7 +3688,7 @@ class GitHubProxyTester:
         info = self.proxy_files[proxy_type]
         file_path = os.path.join(self.base_dir, info['file'])
         
-        if not os.path.exists(file_path):
+        if self.store is None and not os.path.exists(file_path):
             print(f"❌❌❌❌ 代理文件不存在: {file_path}")
             return
         
@@ -952,20 +3701,27 @@ class GitHubProxyTester:
         self.total_tested = 0
         self.successful = 0
         self.failed = 0
+        self.aggregators = {}
         
         # 加载代理
-        proxies = self.load_proxies(file_path, limit)
+        proxies = self.load_candidates(proxy_type, limit)
         
         if not proxies:
             print("❌❌❌❌ 没有找到有效的代理，跳过测试")
             return
         
+        # TCP可达性预筛选（可选）
+        proxies, rejected_results = self.prepare_candidates(proxies, info['name'])
+        
         # 测试代理
-        all_results, successful_results = self.batch_test_proxies(
+        test_func = self.tiered_test_proxies if self.tiered else self.batch_test_proxies
+        all_results, successful_results = test_func(
             proxies=proxies,
             proxy_type=info['name'],
             max_workers=max_workers
         )
+        all_results = rejected_results + all_results
+        all_results, successful_results = self._final_results(all_results, successful_results, info['name'])
         
         # 显示结果
         self.display_results(all_results, successful_results, info['name'])
@@ -993,50 +3749,525 @@ class GitHubProxyTester:
         
         return len(successful_results)
     
-    def auto_run(self):
-        """自动运行完整的测试流程"""
-        print("🚀🚀🚀🚀 开始GitHub自动代理测试")
-        print(f"📁📁📁📁 工作目录: {self.base_dir}")
-        print(f"💾💾💾💾 结果目录: {self.result_dir}")
+    def _tier_target(self):
+        """分级模式下调度器使用的握手目标；未开启或没有测试网站时为None"""
+        if not self.tiered:
+            return None
+        handshake_target = self._handshake_target()
+        return handshake_target if handshake_target[0] else None
+    
+    def _handshake_failure(self, proxy, proxy_type, handshake_target, error, handshake_ms):
+        """握手预检未通过的结果"""
+        result = self._new_result(proxy, {'name': '协议握手', 'url': '%s:%s' % handshake_target}, proxy_type)
+        result['latency_ms'] = handshake_ms
+        result['phases']['handshake'] = handshake_ms
+        result['error'] = error
+        return result
+    
+    def _probe(self, proxy, proxy_type, handshake_target=None):
+        """调度器使用的单代理探测：可选的握手预检 + 完整HTTP测试"""
+        if handshake_target is not None:
+            ok, error, handshake_ms = self.check_proxy_handshake(proxy, proxy_type, *handshake_target)
+            if not ok:
+                return self._handshake_failure(proxy, proxy_type, handshake_target, error, handshake_ms)
+            result = self.test_proxy_connectivity(proxy, proxy_type)
+            # 预检连接上测得的代理握手耗时（requests路径本身测不到）
+            result.setdefault('phases', {}).setdefault('handshake', handshake_ms)
+            return result
+        return self.test_proxy_connectivity(proxy, proxy_type)
+    
+    async def _async_probe(self, proxy, proxy_type, handshake_target=None):
+        """_probe的asyncio版本"""
+        if handshake_target is not None:
+            ok, error, handshake_ms = await self.async_check_proxy_handshake(proxy, proxy_type, *handshake_target)
+            if not ok:
+                return self._handshake_failure(proxy, proxy_type, handshake_target, error, handshake_ms)
+        return await self.async_test_proxy_connectivity(proxy, proxy_type)
+    
+    def _load_type_candidates(self, proxy_types, limit=0):
+        """加载各类型的候选代理，返回 {类型: (待测列表, 已失败结果)}"""
+        candidates = {}
+        for proxy_type in proxy_types:
+            info = self.proxy_files.get(proxy_type)
+            if info is None:
+                print(f"❌❌❌❌ 未知代理类型: {proxy_type}")
+                continue
+            
+            file_path = os.path.join(self.base_dir, info['file'])
+            if self.store is None and not os.path.exists(file_path):
+                print(f"❌❌❌❌ 跳过{info['name']}代理测试，文件不存在: {file_path}")
+                continue
+            
+            proxies = self.load_candidates(proxy_type, limit)
+            candidates[proxy_type] = self.prepare_candidates(proxies, info['name'])
+        return candidates
+    
+    def test_all_types(self, proxy_types=None, max_workers=80, quotas=None, priorities=None, limit=0):
+        """统一调度：所有类型的代理共用一个工作池
+        
+        quotas: {类型: 最多同时占用的工作线程数}，默认不限（即max_workers）
+        priorities: {类型: 优先级}，数值越小越优先；同优先级按在途数量均分
+        返回 {类型: 成功代理数}
+        """
+        proxy_types = proxy_types or list(self.proxy_files.keys())
+        quotas = quotas or {}
+        priorities = priorities or {}
+        
+        print(f"\n" + "="*60)
+        print(f"🧭🧭🧭🧭 统一调度测试: {', '.join(t.upper() for t in proxy_types)}")
+        print("="*60)
+        
+        self.aggregators = {}
+        candidates = self._load_type_candidates(proxy_types, limit)
+        queues = {t: deque(proxies) for t, (proxies, _) in candidates.items()}
+        all_results = {t: list(rejected) for t, (_, rejected) in candidates.items()}
+        successful_results = {t: [] for t in candidates}
+        total = sum(len(q) for q in queues.values())
+        
+        self.total_tested = 0
+        self.successful = 0
+        self.failed = 0
+        
+        if total == 0:
+            print("❌❌❌❌ 没有找到有效的代理，跳过测试")
+        else:
+            print(f"📊📊📊📊 待测代理: " + ", ".join(f"{t.upper()} {len(q)}" for t, q in queues.items()))
+            print(f"📊📊📊📊 初始并发: {max_workers} | 配额: {quotas or '不限'} | 优先级: {priorities or '相同'}")
+            print("-"*50)
+            
+            start_time = time.time()
+            if self.engine == "async":
+                asyncio.run(self._async_schedule(queues, all_results, successful_results, total, quotas, priorities))
+            else:
+                self._thread_schedule(queues, all_results, successful_results, total, max_workers, quotas, priorities)
+            self._close_probe_resources()
+            total_time = time.time() - start_time
+            
+            print()
+            print(f"🎛🎛🎛🎛 并发: {self.concurrency_runs[-1].describe()}")
+            self._print_timeout_summary()
+            self._print_collector_summary()
+            print(f"⏱⏱⏱⏱⏱⏱⏱⏱⏱ 测试总耗时: {total_time:.1f}秒")
+            print(f"📊📊📊📊 平均速度: {total/max(total_time, 0.001):.1f}个/秒")
+        
+        counts = {}
+        for proxy_type in candidates:
+            name = self.proxy_files[proxy_type]['name']
+            if self.tiered:
+                tested = [r for r in all_results[proxy_type] if r.get('test_name') not in ('TCP连接',)]
+                self.stage_stats.setdefault(name, {}).update({
+                    'candidates': len(tested),
+                    'handshake_passed': sum(1 for r in tested if r.get('test_name') != '协议握手'),
+                    'http_passed': len(successful_results[proxy_type]),
+                })
+            results, successes = self._final_results(all_results[proxy_type], successful_results[proxy_type], name)
+            self.display_results(results, successes, name)
+            self.save_results(results, successes, name)
+            counts[proxy_type] = len(successes)
+        return counts
+    
+    def _shard_journal_paths(self):
+        """result目录中所有分片的结果日志"""
+        return sorted(glob.glob(os.path.join(self.result_dir, "journal.shard-*.jsonl")))
+    
+    def _shard_settings(self):
+        """传给子进程的构造参数与属性（子进程重新初始化，不继承本进程的连接和线程）"""
+        options = {
+            'engine': self.engine,
+            'async_concurrency': self.async_concurrency,
+            'tiered': self.tiered,
+            'sweep': self.sweep_enabled,
+            'max_workers': self.max_workers,
+            'type_quotas': self.type_quotas,
+            'type_priorities': self.type_priorities,
+            'use_store': self.store is not None,
+            'resume': self.resume,
+        }
+        attributes = {
+            '_test_urls': self.get_test_urls(),
+            'body_cap_bytes': self.body_cap_bytes,
+            'race_targets': self.race_targets,
+            'race_stagger': self.race_stagger,
+            'history_ordering': self.history_ordering,
+            'adaptive_concurrency': self.adaptive_concurrency,
+            'timeout_percentile': self.timeout_policy.percentile,
+            'budget_remaining': None if self.deadline is None else self.deadline - self.clock(),
+        }
+        return options, attributes
+    
+    def test_in_processes(self, proxy_types):
+        """多进程模式: 启动processes个子进程各测试一个分片，结束后合并各分片的结果日志
+        
+        每个子进程有自己的工作池/事件循环和--workers初始并发，绕开单进程GIL和
+        单事件循环的CPU上限。返回 {类型: 成功代理数}
+        """
+        count = self.processes
+        print(f"\n" + "="*60)
+        print(f"🧩🧩🧩🧩 多进程测试: {count} 个进程，按代理哈希分片")
         print("="*60)
         
+        if not self.resume:
+            # 上一次运行（可能分片数不同）的分片日志不能混入本次合并
+            for path in self._shard_journal_paths():
+                os.remove(path)
+        
+        options, attributes = self._shard_settings()
+        context = multiprocessing.get_context('spawn')
+        workers = []
         start_time = time.time()
+        for index in range(1, count + 1):
+            log_path = os.path.join(self.result_dir, f"run.shard-{index}-of-{count}.log")
+            process = context.Process(target=run_shard, name=f"shard-{index}",
+                                      args=(options, attributes, (index, count), proxy_types, log_path))
+            process.start()
+            workers.append((index, process, log_path))
         
-        # 1. 下载代理
-        print("\n📥📥📥📥 步骤1: 下载代理")
-        downloaded_count = self.download_and_classify_proxies()
+        for index, process, log_path in workers:
+            process.join()
+            status = "完成" if process.exitcode == 0 else f"退出码 {process.exitcode}"
+            print(f"🧩🧩🧩🧩 分片 {index}/{count}: {status} | 输出: {log_path}")
+        print(f"⏱⏱⏱⏱⏱⏱⏱⏱⏱ 多进程测试耗时: {time.time() - start_time:.1f}秒")
         
-        # 2. 导入上次成功的代理
-        print("\n📥📥📥📥 步骤2: 导入上次成功的代理")
-        self.import_previous_successful_proxies()
+        return self.merge_shard_journals()
+    
+    def merge_shard_journals(self, paths=None):
+        """合并分片结果日志，生成与单进程运行相同的 result/*.txt 和 result/*.json
         
-        # 3. 依次测试各种类型的代理
-        print("\n🧪🧪🧪🧪 步骤3: 开始测试代理")
+        paths默认为result目录中的所有 journal.shard-*.jsonl（矩阵作业把各自的日志
+        下载到这里后运行 --merge）。同一代理以最后一条记录为准。返回 {类型: 成功代理数}
+        """
+        paths = paths or self._shard_journal_paths()
+        if not paths:
+            print(f"❌❌❌❌ 没有找到分片结果日志: {os.path.join(self.result_dir, 'journal.shard-*.jsonl')}")
+            return {}
         
-        test_results = {}
-        proxy_types = ['http', 'https', 'socks4', 'socks5']
+        latest = {}
+        for path in paths:
+            records = ResultJournal(path).load()
+            for record in records:
+                latest.setdefault(record.get('proxy_type'), {})[record['proxy']] = record
+            print(f"🧩🧩🧩🧩 分片日志: {os.path.basename(path)} ({len(records)} 条)")
         
-        for proxy_type in proxy_types:
-            if proxy_type in self.proxy_files:
-                info = self.proxy_files[proxy_type]
-                file_path = os.path.join(self.base_dir, info['file'])
+        counts = {}
+        for proxy_type, info in self.proxy_files.items():
+            results = list(latest.get(info['name'], {}).values())
+            if not results:
+                continue
+            successes = [r for r in results if r['success']]
+            self.display_results(results, successes, info['name'])
+            self.save_results(results, successes, info['name'])
+            counts[proxy_type] = len(successes)
+        return counts
+    
+    def _next_type(self, queues, in_flight, quotas, priorities, limit):
+        """选出下一个可以派发的代理类型，没有则返回None"""
+        ready = [
+            t for t, queue in queues.items()
+            if queue and in_flight[t] < quotas.get(t, limit)
+        ]
+        if not ready:
+            return None
+        return min(ready, key=lambda t: (priorities.get(t, 0), in_flight[t]))
+    
+    def _thread_schedule(self, queues, all_results, successful_results, total, max_workers, quotas, priorities):
+        """线程池调度：按优先级与配额从各类型队列中派发任务"""
+        handshake_target = self._tier_target()
+        in_flight = {t: 0 for t in queues}
+        futures = {}
+        completed = self._completion_queue()
+        controller = self._new_controller(max_workers, "thread")
+        
+        with self._probe_executor(controller.maximum) as executor, ProgressReporter(self, total):
+            while True:
+                if not self._can_launch() and any(queues.values()):
+                    self._stop_launching(queues, len(futures))
+                
+                while self._has_slot(controller, len(futures)):
+                    proxy_type = self._next_type(queues, in_flight, quotas, priorities, controller.limit)
+                    if proxy_type is None:
+                        break
+                    proxy = queues[proxy_type].popleft()
+                    name = self.proxy_files[proxy_type]['name']
+                    self._probe_started(name)
+                    future = executor.submit(self._probe, proxy, name, handshake_target)
+                    futures[future] = (proxy_type, proxy)
+                    future.add_done_callback(completed.put)
+                    in_flight[proxy_type] += 1
+                
+                if not futures:
+                    break
+                
+                future = completed.get()
+                proxy_type, proxy = futures.pop(future)
+                in_flight[proxy_type] -= 1
+                result = self._probe_result(future, proxy, self.proxy_files[proxy_type]['name'])
+                self._record_result(result, total, all_results[proxy_type], successful_results[proxy_type])
+                self._observe_concurrency(controller, result)
+    
+    async def _async_schedule(self, queues, all_results, successful_results, total, quotas, priorities):
+        """事件循环调度：全局并发上限 + 每类型配额，按优先级派发"""
+        handshake_target = self._tier_target()
+        in_flight = {t: 0 for t in queues}
+        tasks = {}
+        completed = asyncio.Queue()
+        controller = self._new_controller(self.async_concurrency, "async")
+        
+        with ProgressReporter(self, total):
+            while True:
+                if not self._can_launch() and any(queues.values()):
+                    self._stop_launching(queues, len(tasks))
                 
-                if os.path.exists(file_path):
-                    print(f"\n" + "="*60)
-                    print(f"🧪🧪🧪🧪 测试 {info['name']} 代理")
-                    print("="*60)
+                while len(tasks) < controller.limit:
+                    proxy_type = self._next_type(queues, in_flight, quotas, priorities, controller.limit)
+                    if proxy_type is None:
+                        break
+                    proxy = queues[proxy_type].popleft()
+                    name = self.proxy_files[proxy_type]['name']
+                    self._probe_started(name)
+                    task = asyncio.ensure_future(self._async_probe(proxy, name, handshake_target))
+                    tasks[task] = (proxy_type, proxy)
+                    task.add_done_callback(completed.put_nowait)
+                    in_flight[proxy_type] += 1
+                
+                if not tasks:
+                    break
+                
+                task = await completed.get()
+                proxy_type, proxy = tasks.pop(task)
+                in_flight[proxy_type] -= 1
+                result = self._probe_result(task, proxy, self.proxy_files[proxy_type]['name'])
+                self._record_result(result, total, all_results[proxy_type], successful_results[proxy_type])
+                self._observe_concurrency(controller, result)
+    
+    def _previous_successes(self, proxy_type):
+        """上次测试成功的代理（result/<类型>.txt），流水线中最先测试"""
+        result_file = os.path.join(self.result_dir, f"{proxy_type}.txt")
+        if not os.path.exists(result_file):
+            return []
+        with open(result_file, 'r', encoding='utf-8', errors='ignore') as f:
+            return parse_proxy_blob(f.read())
+    
+    def stream_download_and_test(self, max_workers=80, quotas=None, priorities=None):
+        """下载与测试重叠的流水线：每个源下载完成后立即解析、在线去重并进入测试队列
+        
+        代理文件（http.txt等）在结束时作为副产物写出，不再是下载与测试之间的交接点。
+        返回 {类型: 成功代理数}
+        """
+        quotas = quotas or {}
+        priorities = priorities or {}
+        
+        print("\n" + "="*60)
+        print("🌊🌊🌊🌊 流水线模式: 边下载边测试")
+        print("="*60)
+        
+        all_links = self.parse_source_file()
+        proxy_types = list(self.proxy_files.keys())
+        queues = {t: deque() for t in proxy_types}
+        seen = {t: set() for t in proxy_types}
+        downloaded = {t: PackedProxySet() for t in proxy_types}
+        all_results = {t: [] for t in proxy_types}
+        successful_results = {t: [] for t in proxy_types}
+        in_flight = {t: 0 for t in proxy_types}
+        
+        self.total_tested = 0
+        self.successful = 0
+        self.failed = 0
+        self.aggregators = {}
+        start_time = time.time()
+        first_success_at = None
+        
+        def enqueue(proxy_type, proxies, source=None):
+            """在线去重后按历史排序加入测试队列，返回新增数量
+            
+            去重键是 (主机, 端口)（与健康库主键相同），上次成功的"socks5://ip:端口"
+            与下载到的"ip:端口"视为同一个代理，只测试先进入队列的那一个。
+            """
+            fresh = []
+            for proxy in proxies:
+                try:
+                    key = self._endpoint(proxy, proxy_type)
+                except ValueError:
+                    key = proxy
+                if key not in seen[proxy_type]:
+                    seen[proxy_type].add(key)
+                    fresh.append(proxy)
+            fresh = self._own_shard(fresh, self.proxy_files[proxy_type]['name'])
+            fresh = self._skip_resumed(fresh, self.proxy_files[proxy_type]['name'])
+            
+            if self.store is not None and source is not None and proxies:
+                self.store.upsert_candidates(proxy_type, self._store_entries(proxies, proxy_type), source=source)
+            
+            if fresh and self.history_ordering and self.store is not None:
+                fresh, skipped = self.order_by_history(fresh, self.proxy_files[proxy_type]['name'])
+                stats = self.stage_stats.setdefault(self.proxy_files[proxy_type]['name'], {})
+                stats['backoff_skipped'] = stats.get('backoff_skipped', 0) + skipped
+            
+            queues[proxy_type].extend(fresh)
+            return len(fresh)
+        
+        # 上次成功的代理不必等下载，直接进入队列
+        for proxy_type in proxy_types:
+            count = enqueue(proxy_type, self._previous_successes(proxy_type))
+            if count:
+                print(f"📥📥📥📥 {proxy_type.upper()}: 上次成功的 {count} 个代理已入队")
+        
+        handshake_target = self._tier_target()
+        controller = self._new_controller(max_workers, "thread")
+        download_executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.download_workers)
+        test_executor = concurrent.futures.ThreadPoolExecutor(max_workers=controller.maximum)
+        # 下载和探测完成时都由回调放入同一个队列，调度线程逐个取出处理
+        completed = queue.SimpleQueue()
+        downloads = {
+            download_executor.submit(self.download_proxy_list, url, proxy_type): (proxy_type, url)
+            for proxy_type, links in all_links.items() for url in links
+        }
+        for future in downloads:
+            future.add_done_callback(completed.put)
+        probes = {}
+        progress = ProgressReporter(self, 0)
+        
+        try:
+            with progress:
+                while downloads or probes or any(queues.values()):
+                    if not self._can_launch() and (downloads or any(queues.values())):
+                        # 预算不足: 放弃未完成的下载和待测代理，只等在途探测
+                        if downloads:
+                            print(f"\n⏳⏳⏳⏳ 放弃 {len(downloads)} 个未完成的下载")
+                            for future in downloads:
+                                future.cancel()
+                            downloads.clear()
+                        self._stop_launching(queues, len(probes))
+                        if not probes:
+                            break
                     
-                    successful_count = self.test_proxy_type(proxy_type, max_workers=20, limit=0)
-                    test_results[proxy_type] = successful_count
+                    # 派发测试任务
+                    while self._has_slot(controller, len(probes)):
+                        proxy_type = self._next_type(queues, in_flight, quotas, priorities, controller.limit)
+                        if proxy_type is None:
+                            break
+                        proxy = queues[proxy_type].popleft()
+                        self._probe_started(self.proxy_files[proxy_type]['name'])
+                        future = test_executor.submit(self._probe, proxy, self.proxy_files[proxy_type]['name'], handshake_target)
+                        probes[future] = (proxy_type, proxy)
+                        future.add_done_callback(completed.put)
+                        in_flight[proxy_type] += 1
                     
-                    # 短暂暂停，避免请求过于密集
-                    time.sleep(2)
-                else:
-                    print(f"❌❌❌❌ 跳过{info['name']}代理测试，文件不存在: {file_path}")
-                    test_results[proxy_type] = 0
+                    if not downloads and not probes:
+                        break
+                    
+                    future = completed.get()
+                    total = sum(len(s) for s in seen.values())
+                    progress.total = total
+                    
+                    if future in downloads:
+                        proxy_type, url = downloads.pop(future)
+                        try:
+                            proxies = future.result()
+                        except Exception as e:
+                            print(f"\n❌❌❌❌ 下载失败: {e}")
+                            continue
+                        downloaded[proxy_type].extend(proxies)
+                        count = enqueue(proxy_type, proxies, source=url)
+                        progress.total = sum(len(s) for s in seen.values())
+                        print(f"\n📥📥📥📥 {proxy_type.upper()}: 新增 {count} 个待测代理 ({url})")
+                    elif future in probes:
+                        proxy_type, proxy = probes.pop(future)
+                        in_flight[proxy_type] -= 1
+                        result = self._probe_result(future, proxy, self.proxy_files[proxy_type]['name'])
+                        self._record_result(result, total, all_results[proxy_type], successful_results[proxy_type])
+                        self._observe_concurrency(controller, result)
+                        if result['success'] and first_success_at is None:
+                            first_success_at = time.time() - start_time
+                            print(f"\n⚡⚡⚡⚡ 首个有效代理: {result['proxy']} ({proxy_type.upper()}) "
+                                  f"- 流水线启动后 {first_success_at:.1f}秒")
+                    # 其余是预算不足时取消的下载，已从downloads中移除
+        finally:
+            download_executor.shutdown(wait=self.deadline is None, cancel_futures=True)
+            test_executor.shutdown(wait=True)
+            self._close_probe_resources()
+        
+        total_time = time.time() - start_time
+        print()
+        self.print_cache_summary()
+        print(f"🎛🎛🎛🎛 并发: {controller.describe()}")
+        self._print_collector_summary()
+        print(f"⏱⏱⏱⏱⏱⏱⏱⏱⏱ 流水线总耗时: {total_time:.1f}秒")
+        if first_success_at is not None:
+            print(f"⚡⚡⚡⚡ 首个有效代理用时: {first_success_at:.1f}秒")
+        self.stage_stats.setdefault('流水线', {})['first_success_seconds'] = first_success_at
+        
+        # 副产物: 写出候选代理文件
+        for proxy_type in proxy_types:
+            if self.store is not None:
+                if self.store.count(proxy_type):
+                    self.export_candidates(proxy_type)
+            elif downloaded[proxy_type].total_added:
+                file_path = os.path.join(self.base_dir, self.proxy_files[proxy_type]['file'])
+                self.save_proxies_to_file(downloaded[proxy_type], file_path, proxy_type.upper())
+        
+        counts = {}
+        for proxy_type in proxy_types:
+            name = self.proxy_files[proxy_type]['name']
+            results, successes = self._final_results(all_results[proxy_type], successful_results[proxy_type], name)
+            if not results:
+                continue
+            self.display_results(results, successes, name)
+            self.save_results(results, successes, name)
+            counts[proxy_type] = len(successes)
+        return counts
+    
+    def auto_run(self):
+        """自动运行完整的测试流程"""
+        print("🚀🚀🚀🚀 开始GitHub自动代理测试")
+        print(f"📁📁📁📁 工作目录: {self.base_dir}")
+        print(f"💾💾💾💾 结果目录: {self.result_dir}")
+        print("="*60)
+        
+        start_time = time.time()
+        proxy_types = ['http', 'https', 'socks4', 'socks5']
+        test_results = {proxy_type: 0 for proxy_type in proxy_types}
+        
+        download_deadline = None
+        if self.budget:
+            self.deadline = self.clock() + self.budget
+            download_deadline = self.clock() + self.budget * self.download_share
+            print(f"⏳⏳⏳⏳ 时间预算: {self.budget:.0f}秒 (下载阶段最多 {self.budget * self.download_share:.0f}秒，"
+                  f"剩余不足 {self.probe_timeout()}秒时停止派发新探测)")
+        
+        if self.streaming:
+            # 下载、导入与测试重叠进行
+            print("\n🌊🌊🌊🌊 步骤1-3: 边下载边测试")
+            test_results.update(self.stream_download_and_test(
+                max_workers=self.max_workers,
+                quotas=self.type_quotas,
+                priorities=self.type_priorities
+            ))
+        else:
+            # 1. 下载代理
+            print("\n📥📥📥📥 步骤1: 下载代理")
+            phase_start = time.monotonic()
+            downloaded_count = self.download_and_classify_proxies(deadline=download_deadline)
+            self.phase_times['下载'] = time.monotonic() - phase_start
+            
+            # 2. 导入上次成功的代理
+            print("\n📥📥📥📥 步骤2: 导入上次成功的代理")
+            phase_start = time.monotonic()
+            self.import_previous_successful_proxies()
+            self.phase_times['导入'] = time.monotonic() - phase_start
+            
+            # 3. 所有类型的代理共用一个工作池统一调度测试
+            print("\n🧪🧪🧪🧪 步骤3: 开始测试代理")
+            phase_start = time.monotonic()
+            if self.processes > 1:
+                test_results.update(self.test_in_processes(proxy_types))
             else:
-                print(f"❌❌❌❌ 未知代理类型: {proxy_type}")
-                test_results[proxy_type] = 0
+                test_results.update(self.test_all_types(
+                    proxy_types,
+                    max_workers=self.max_workers,
+                    quotas=self.type_quotas,
+                    priorities=self.type_priorities
+                ))
+            self.phase_times['测试'] = time.monotonic() - phase_start
         
         # 4. 生成测试报告
         print("\n" + "="*60)
@@ -1051,6 +4282,41 @@ class GitHubProxyTester:
                 info = self.proxy_files[proxy_type]
                 print(f"  {info['name']}: {count} 个")
         
+        if self.stage_stats:
+            print(f"\n🤝🤝🤝🤝 分级验证统计 (候选 -> 握手通过 -> HTTP通过):")
+            for name, stats in self.stage_stats.items():
+                if stats.get('first_success_seconds') is not None:
+                    print(f"  {name}: 首个有效代理 {stats['first_success_seconds']:.1f}秒")
+                if 'candidates' in stats:
+                    print(f"  {name}: {stats['candidates']} -> {stats['handshake_passed']} -> {stats['http_passed']}")
+                if 'tcp_reachable' in stats:
+                    print(f"  {name}: TCP可达 {stats['tcp_reachable']} 个")
+                if stats.get('backoff_skipped'):
+                    print(f"  {name}: 退避跳过 {stats['backoff_skipped']} 个")
+        
+        self.print_cache_summary()
+        
+        if self.timeout_policy.enabled:
+            base = max((config.get('timeout', 8) for config in self.get_test_urls()), default=8)
+            print(f"\n⏱⏱⏱⏱⏱⏱⏱⏱⏱ 自适应超时: {self.timeout_policy.describe(base)}")
+        
+        if self.concurrency_runs:
+            print(f"\n🎛🎛🎛🎛 自适应并发 ({'AIMD' if self.adaptive_concurrency else '固定'}):")
+            for controller in self.concurrency_runs:
+                print(f"  {controller.describe()}")
+        
+        if self.budget:
+            phases = " | ".join(f"{name} {seconds:.0f}秒" for name, seconds in self.phase_times.items())
+            print(f"⏳⏳⏳⏳ 时间预算: {self.budget:.0f}秒，已用 {time.time() - start_time:.0f}秒"
+                  f"{f' ({phases})' if phases else ''} | 预算不足未测试 {self.budget_skipped} 个")
+        
+        if self.journal is not None:
+            self.journal.flush()
+            print(f"📝📝📝📝 结果日志: {self.journal.written} 条，fsync {self.journal.syncs} 次"
+                  f"{f' | 续测跳过 {self.resume_skipped} 个' if self.resume_skipped else ''} -> {self.journal.path}")
+        
+        self.write_metrics()
+        
         total_time = time.time() - start_time
         minutes = int(total_time // 60)
         seconds = int(total_time % 60)
@@ -1060,19 +4326,133 @@ class GitHubProxyTester:
         
         print("\n✅ GitHub自动代理测试完成!")
 
+def run_shard(options, attributes, shard, proxy_types, log_path):
+    """--processes模式的子进程入口: 测试一个分片，输出写入该分片的日志文件"""
+    with open(log_path, 'w', encoding='utf-8') as log:
+        sys.stdout = sys.stderr = log
+        tester = GitHubProxyTester(shard=shard, **options)
+        try:
+            attributes = dict(attributes)
+            tester.timeout_policy.percentile = attributes.pop('timeout_percentile')
+            remaining = attributes.pop('budget_remaining')
+            if remaining is not None:
+                tester.deadline = time.monotonic() + remaining
+            for name, value in attributes.items():
+                setattr(tester, name, value)
+            tester.test_all_types(proxy_types, max_workers=tester.max_workers,
+                                  quotas=tester.type_quotas, priorities=tester.type_priorities)
+            tester.write_metrics()
+        finally:
+            tester.journal.close()
+            if tester.store is not None:
+                tester.store.close()
+
+def parse_type_map(text):
+    """解析 'socks5=40,http=10' 形式的按类型配置"""
+    mapping = {}
+    for item in (text or '').split(','):
+        if '=' in item:
+            key, value = item.split('=', 1)
+            mapping[key.strip().lower()] = int(value)
+    return mapping
+
+def parse_args(argv=None):
+    """解析命令行参数（不带参数时与原有行为一致）"""
+    import argparse
+    
+    parser = argparse.ArgumentParser(description="GitHub自动代理测试")
+    parser.add_argument("--engine", choices=["thread", "async"], default="thread",
+                        help="测试引擎: thread=线程池, async=单事件循环")
+    parser.add_argument("--concurrency", type=int, default=500,
+                        help="async引擎同时在途的最大探测数")
+    parser.add_argument("--tiered", action="store_true",
+                        help="分级验证: 先做协议握手，通过后再做完整HTTP测试")
+    parser.add_argument("--tcp-sweep", action="store_true",
+                        help="测试前用epoll非阻塞TCP扫描过滤不可达的代理")
+    parser.add_argument("--body-cap", type=int, default=256,
+                        help="页面校验最多读取的KB数（命中check_string会提前停止）")
+    parser.add_argument("--workers", type=int, default=80,
+                        help="统一调度时所有类型共享的初始并发数（之后由AIMD控制器调整）")
+    parser.add_argument("--timeout-percentile", type=float, default=0,
+                        help="自适应超时取成功探测耗时的百分位（×1.5），如95；默认0，始终使用ym.txt中的超时")
+    parser.add_argument("--fixed-concurrency", action="store_true",
+                        help="关闭自适应并发，始终使用--workers/--concurrency给定的并发数")
+    parser.add_argument("--quota", default="",
+                        help="每类型最多同时占用的线程数，如 socks5=40,http=20")
+    parser.add_argument("--priority", default="",
+                        help="每类型优先级（越小越先），如 socks5=0,http=1")
+    parser.add_argument("--no-store", action="store_true",
+                        help="不使用SQLite代理健康库，沿用txt文件合并")
+    parser.add_argument("--no-history", action="store_true",
+                        help="不按历史成功率排序，也不跳过连续失败的代理")
+    parser.add_argument("--no-source-cache", action="store_true",
+                        help="不使用代理源的条件下载缓存，每次完整下载")
+    parser.add_argument("--budget", type=float, default=None,
+                        help="总时间预算（秒），剩余时间不足一次探测时停止派发并正常收尾")
+    parser.add_argument("--resume", action="store_true",
+                        help="续测: 读取result/journal.jsonl，跳过6小时内已测过的代理")
+    parser.add_argument("--stream", action="store_true",
+                        help="流水线模式: 每个源下载完成后立即进入测试队列")
+    parser.add_argument("--race", action="store_true",
+                        help="网站竞速: 错开发起ym.txt中的多个网站，先成功者胜出，其余取消")
+    parser.add_argument("--race-stagger", type=float, default=0.25,
+                        help="竞速模式下发起下一个网站前等待的秒数")
+    parser.add_argument("--processes", type=int, default=1,
+                        help="多进程测试: 按代理哈希分成N片，每个子进程测一片，结束后自动合并")
+    parser.add_argument("--shard", default=None,
+                        help="只测试第i片（i/n，从1开始），结果写入result/journal.shard-i-of-n.jsonl，供矩阵作业使用")
+    parser.add_argument("--merge", action="store_true",
+                        help="不下载不测试，合并result/journal.shard-*.jsonl生成最终结果文件")
+    args = parser.parse_args(argv)
+    if args.shard is not None:
+        try:
+            args.shard = parse_shard(args.shard)
+        except ValueError as e:
+            parser.error(str(e))
+    if args.stream and args.processes > 1:
+        parser.error("--stream 不支持 --processes")
+    return args
+
 def main():
     """主函数"""
-    tester = GitHubProxyTester()
+    args = parse_args()
+    tester = GitHubProxyTester(engine=args.engine, async_concurrency=args.concurrency,
+                               tiered=args.tiered, sweep=args.tcp_sweep,
+                               max_workers=args.workers,
+                               type_quotas=parse_type_map(args.quota),
+                               type_priorities=parse_type_map(args.priority),
+                               use_store=not args.no_store, streaming=args.stream,
+                               resume=args.resume, budget=args.budget,
+                               processes=args.processes, shard=args.shard)
+    tester.body_cap_bytes = args.body_cap * 1024
+    if args.no_history:
+        tester.history_ordering = False
+    if args.no_source_cache:
+        tester.source_cache = None
+    if args.fixed_concurrency:
+        tester.adaptive_concurrency = False
+    tester.race_targets = args.race
+    tester.race_stagger = args.race_stagger
+    tester.timeout_policy.percentile = args.timeout_percentile
     
     try:
-        # 自动运行完整流程
-        tester.auto_run()
+        if args.merge:
+            # 合并矩阵作业的分片结果
+            tester.merge_shard_journals()
+        else:
+            # 自动运行完整流程
+            tester.auto_run()
     except KeyboardInterrupt:
         print("\n\n⚠️ 用户中断程序")
     except Exception as e:
         print(f"\n❌❌❌❌ 发生错误: {e}")
         import traceback
         traceback.print_exc()
+    finally:
+        if tester.journal is not None:
+            tester.journal.close()
+        if tester.store is not None:
+            tester.store.close()
 
 if __name__ == "__main__":
     main()
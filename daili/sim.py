@@ -0,0 +1,451 @@
+#!/usr/bin/env python3
+"""
+虚拟时钟模拟器 - 用结果日志中的结局/耗时分布代替真实探测，在虚拟时钟上运行
+GitHubProxyTester自己的调度代码，对比调度顺序、并发数和超时策略的效果
+
+只替换探测、时钟和健康库三处，调度逻辑与实际运行完全相同:
+  探测   - SimTester.test_proxy_connectivity 按抽样的结局生成结果，
+           连接/读取截止时间取自TimeoutPolicy（与实际运行一样会提前终止）
+  时钟   - 线程引擎: _probe_executor/_completion_queue 换成虚拟执行器，调度线程
+           取结果时虚拟时钟推进到最早完成的探测；async引擎: loop.time()为虚拟时钟的
+           事件循环，等待即推进时钟；预算判断（_can_launch）使用tester.clock
+  健康库 - 合成的历史记录交给order_by_history（历史分数排序与退避）
+经过的代码: _thread_schedule / _async_schedule（配额、优先级）、ConcurrencyController
+（AIMD）、TimeoutPolicy、_can_launch、order_by_history、_record_result。
+
+模型（每个模拟代理独立抽样，同一种子结果完全相同）:
+  成功  - 延迟和阶段耗时取自日志中的成功结果；超过截止时间则按超时失败计
+  超时  - 日志中的超时类错误，耗时等于当时的连接/读取截止时间
+  快速失败 - 拒绝/重置/代理错误等，耗时取自日志中该结果的耗时
+"""
+
+import os
+import sys
+import math
+import time
+import heapq
+import random
+import asyncio
+import argparse
+import selectors
+import contextlib
+import concurrent.futures
+from collections import deque
+
+from daili import (GitHubProxyTester, ResultJournal, TimeoutPolicy, TIMEOUT_ERRORS,
+                   percentile, parse_type_map)
+
+
+# 筛选阶段的结果不是完整探测，不进入模型
+PREFILTER_TESTS = ('TCP连接', '协议握手')
+
+# 调度器的类型队列（与GitHubProxyTester.proxy_files的键一致）
+PROXY_TYPES = ('http', 'https', 'socks4', 'socks5')
+
+
+class ProbeModel:
+    """按代理类型的探测结果分布"""
+
+    def __init__(self, successes, fast_failures, timeouts, outcome_counts):
+        self.successes = successes              # {类型: [(成功延迟ms, 阶段耗时)]}
+        self.fast_failures = fast_failures      # {类型: [(快速失败耗时ms, 错误)]}
+        self.timeouts = timeouts                # {类型: [超时类错误]}
+        self.outcome_counts = outcome_counts    # {类型: {'success'/'timeout'/'fast': 次数}}
+
+    @classmethod
+    def default(cls):
+        """没有日志时使用的分布（与公开代理列表的典型情况相近）"""
+        rng = random.Random(0)
+        successes, fast_failures, timeouts = {}, {}, {}
+        for proxy_type, median in (('SOCKS5', 1500), ('HTTP', 1000)):
+            successes[proxy_type] = []
+            for _ in range(2000):
+                latency = rng.lognormvariate(math.log(median), 0.7)
+                connect = latency * rng.uniform(0.2, 0.4)
+                successes[proxy_type].append((latency, {'connect': connect, 'ttfb': latency - connect}))
+            fast_failures[proxy_type] = [(rng.lognormvariate(math.log(300), 0.8), '连接被拒绝') for _ in range(2000)]
+            timeouts[proxy_type] = ['连接超时'] * 3 + ['读取超时']
+        return cls(successes, fast_failures, timeouts, {
+            'SOCKS5': {'success': 5, 'timeout': 57, 'fast': 38},
+            'HTTP': {'success': 3, 'timeout': 60, 'fast': 37},
+        })
+
+    @classmethod
+    def from_journal(cls, path):
+        """从result/journal.jsonl构建模型，没有可用记录时返回None"""
+        successes, fast_failures, timeouts, outcome_counts = {}, {}, {}, {}
+
+        for record in ResultJournal(path).load():
+            if record.get('test_name') in PREFILTER_TESTS:
+                continue
+            proxy_type = record.get('proxy_type', 'unk')
+            counts = outcome_counts.setdefault(proxy_type, {'success': 0, 'timeout': 0, 'fast': 0})
+            error = record.get('error') or ''
+
+            if record.get('success'):
+                counts['success'] += 1
+                successes.setdefault(proxy_type, []).append((record['latency_ms'], record.get('phases') or {}))
+            elif error in TIMEOUT_ERRORS:
+                counts['timeout'] += 1
+                timeouts.setdefault(proxy_type, []).append(error)
+            else:
+                counts['fast'] += 1
+                cost = record.get('latency_ms') or sum((record.get('phases') or {}).values())
+                if cost:
+                    fast_failures.setdefault(proxy_type, []).append((cost, error))
+
+        if not outcome_counts:
+            return None
+        return cls(successes, fast_failures, timeouts, outcome_counts)
+
+    def describe(self):
+        for proxy_type, counts in sorted(self.outcome_counts.items()):
+            total = sum(counts.values())
+            latencies = sorted(latency for latency, _ in self.successes.get(proxy_type, []))
+            print(f"  {proxy_type:7s}: {total:7d} 条 | 成功 {counts['success'] / total:6.1%} | "
+                  f"超时 {counts['timeout'] / total:6.1%} | 快速失败 {counts['fast'] / total:6.1%} | "
+                  f"成功延迟P50 {percentile(latencies, 50):.0f}ms")
+
+    def sample(self, count, seed):
+        """抽样count个模拟代理，返回 {代理: (类型, 结局, 耗时ms, 阶段耗时, 错误)}
+
+        结局: 'success' / 'timeout' / 'fast'；超时类代理的耗时在探测时按当时的截止时间决定。
+        代理是按序号生成的 10.x.y.z:端口，类型按日志中各类型的结果数加权。
+        """
+        rng = random.Random(seed)
+        types = [t for t in self.outcome_counts if t.lower() in PROXY_TYPES]
+        type_weights = [sum(self.outcome_counts[t].values()) for t in types]
+        plan = {}
+
+        for index, proxy_type in enumerate(rng.choices(types, type_weights, k=count)):
+            proxy = f"10.{(index >> 16) & 255}.{(index >> 8) & 255}.{index & 255}:{1080 + (index >> 24)}"
+            counts = self.outcome_counts[proxy_type]
+            outcome = rng.choices(('success', 'timeout', 'fast'),
+                                  (counts['success'], counts['timeout'], counts['fast']))[0]
+            cost, phases, error = 0, {}, None
+            if outcome == 'success' and self.successes.get(proxy_type):
+                cost, phases = rng.choice(self.successes[proxy_type])
+            elif outcome == 'fast' and self.fast_failures.get(proxy_type):
+                cost, error = rng.choice(self.fast_failures[proxy_type])
+            elif outcome == 'fast':
+                cost, error = 300, '连接被拒绝'
+            else:
+                outcome = 'timeout'
+                error = rng.choice(self.timeouts.get(proxy_type) or ['连接超时'])
+            plan[proxy] = (proxy_type, outcome, cost, phases, error)
+        return plan
+
+
+class SimStore:
+    """只提供history()的健康库替身，合成的历史由order_by_history按实际规则排序和退避"""
+
+    def __init__(self, plan, accuracy, seed, now=None):
+        """有效代理以accuracy的概率带有成功历史，其余带有连续失败的历史（部分处于退避期）"""
+        rng = random.Random(seed)
+        now = time.time() if now is None else now
+        self.records = {}
+        for proxy, (proxy_type, outcome, _, _, _) in plan.items():
+            host, port = proxy.rsplit(':', 1)
+            favoured = (outcome == 'success') == (rng.random() < accuracy)
+            tests = rng.randint(1, 6)
+            if favoured:
+                successes = rng.randint(1, tests)
+                record = (tests, successes, 0, now - rng.uniform(0, 86400), now - rng.uniform(0, 3 * 86400))
+            else:
+                record = (tests, 0, tests, now - rng.uniform(0, 3 * 86400), None)
+            self.records.setdefault(proxy_type.lower(), {})[(host, int(port))] = record
+
+    def history(self, proxy_type):
+        return self.records.get(proxy_type, {})
+
+
+class VirtualClock:
+    """虚拟时钟（秒），可作为tester.clock调用"""
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class VirtualExecutor:
+    """虚拟时钟上的"线程池": 提交时立即运行模型探测，结果在虚拟完成时间到达时才交付"""
+
+    def __init__(self, clock):
+        self.clock = clock
+        self._pending = []
+        self._sequence = 0
+
+    def submit(self, fn, *args):
+        future = concurrent.futures.Future()
+        future.set_running_or_notify_cancel()
+        try:
+            result = fn(*args)
+            seconds = result.pop('sim_seconds')
+        except Exception as e:
+            result, seconds = e, 0
+        self._sequence += 1
+        heapq.heappush(self._pending, (self.clock.now + seconds, self._sequence, future, result))
+        return future
+
+    def advance(self):
+        """把虚拟时钟推进到最早完成的探测并交付其结果（触发完成回调）"""
+        finished_at, _, future, result = heapq.heappop(self._pending)
+        self.clock.now = max(self.clock.now, finished_at)
+        if isinstance(result, Exception):
+            future.set_exception(result)
+        else:
+            future.set_result(result)
+
+    def shutdown(self, wait=True, cancel_futures=False):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+class VirtualCompletionQueue:
+    """调度线程的完成队列: 队列为空时推进虚拟执行器，代替阻塞等待"""
+
+    def __init__(self, tester):
+        self.tester = tester
+        self._items = deque()
+
+    def put(self, item):
+        self._items.append(item)
+
+    def get(self):
+        while not self._items:
+            self.tester.executor.advance()
+        return self._items.popleft()
+
+
+class VirtualTimeSelector(selectors.DefaultSelector):
+    """没有真实IO: 事件循环要等待timeout秒时直接把虚拟时钟推进timeout秒"""
+
+    def __init__(self, clock):
+        super().__init__()
+        self.clock = clock
+
+    def select(self, timeout=None):
+        if timeout:
+            self.clock.now += timeout
+        return super().select(0)
+
+
+class VirtualTimeLoop(asyncio.SelectorEventLoop):
+    """loop.time()返回虚拟时钟的事件循环，asyncio.sleep等计时器按虚拟时间触发"""
+
+    def __init__(self, clock):
+        self.clock = clock
+        super().__init__(VirtualTimeSelector(clock))
+
+    def time(self):
+        return self.clock.now
+
+
+class VirtualTimePolicy(asyncio.DefaultEventLoopPolicy):
+    """让调度器内部的asyncio.run()创建虚拟时间事件循环"""
+
+    def __init__(self, clock):
+        super().__init__()
+        self.clock = clock
+
+    def new_event_loop(self):
+        return VirtualTimeLoop(self.clock)
+
+
+class ResultSink:
+    """只计数不保留的结果列表，模拟大量探测时不占内存"""
+
+    def __init__(self):
+        self.count = 0
+
+    def append(self, result):
+        self.count += 1
+
+    def __len__(self):
+        return self.count
+
+
+class SimTester(GitHubProxyTester):
+    """注入模型探测和虚拟时钟的GitHubProxyTester，调度相关的方法全部沿用"""
+
+    def __init__(self, plan, clock, timeout, **kwargs):
+        super().__init__(use_store=False, **kwargs)
+        self.journal = None
+        self.plan = plan
+        self.clock = clock
+        self.executor = None
+        self.success_times = []
+        self._test_urls = [{'url': 'http://sim.invalid/', 'name': '模拟', 'timeout': timeout,
+                            'check_string': '', 'site_abbr': 'sim'}]
+
+    def _probe_executor(self, max_workers):
+        self.executor = VirtualExecutor(self.clock)
+        return self.executor
+
+    def _completion_queue(self):
+        return VirtualCompletionQueue(self)
+
+    def _record_result(self, result, total, all_results, successful_results):
+        if result['success']:
+            self.success_times.append(self.clock())
+        super()._record_result(result, total, all_results, successful_results)
+
+    def test_proxy_connectivity(self, proxy, proxy_type):
+        """模型探测: 按抽样的结局生成结果，虚拟耗时（秒）放在sim_seconds中由执行器/事件循环等待"""
+        _, outcome, cost, phases, error = self.plan[proxy]
+        config = self._test_urls[0]
+        base = config['timeout']
+        connect_deadline, read_deadline = self.timeout_policy.deadlines(base)
+        result = self._new_result(proxy, config, proxy_type)
+        connect_ms = sum(phases.get(name, 0) for name in TimeoutPolicy.CONNECT_PHASES)
+
+        if outcome == 'success':
+            if connect_ms > connect_deadline * 1000:
+                result['error'] = '连接超时'
+                self._timeout_cut(result, 'connect', connect_deadline, base)
+                seconds = connect_deadline
+            elif phases.get('ttfb', cost) > read_deadline * 1000 or cost > base * 1000:
+                result['error'] = '读取超时'
+                self._timeout_cut(result, 'read', read_deadline, base)
+                seconds = min(connect_ms / 1000 + read_deadline, base)
+            else:
+                result.update(success=True, latency_ms=cost, status_code=200, phases=dict(phases))
+                seconds = cost / 1000
+        elif outcome == 'timeout':
+            result['error'] = error
+            kind, deadline = ('read', read_deadline) if error == '读取超时' else ('connect', connect_deadline)
+            self._timeout_cut(result, kind, deadline, base)
+            seconds = deadline
+        else:
+            result['error'] = error
+            result['latency_ms'] = min(cost, base * 1000)
+            seconds = result['latency_ms'] / 1000
+
+        result['sim_seconds'] = seconds
+        return result
+
+    async def async_test_proxy_connectivity(self, proxy, proxy_type):
+        result = self.test_proxy_connectivity(proxy, proxy_type)
+        await asyncio.sleep(result.pop('sim_seconds'))
+        return result
+
+
+def simulate(plan, order, engine, concurrency, timeout, args, store=None):
+    """在虚拟时钟上跑一次调度，返回统计字典"""
+    by_type = {}
+    for proxy, (proxy_type, _, _, _, _) in plan.items():
+        by_type.setdefault(proxy_type.lower(), []).append(proxy)
+
+    # 调度器自身的输出（初始化信息、进度、预算提示）不混入对比表
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        clock = VirtualClock()
+        tester = SimTester(plan, clock, timeout, engine=engine, async_concurrency=concurrency)
+        tester.adaptive_concurrency = not args.fixed_concurrency
+        tester.timeout_policy.percentile = args.timeout_percentile
+        tester.store = store if order == 'history' else None
+        tester.history_ordering = order == 'history'
+
+        queues = {}
+        for proxy_type, proxies in by_type.items():
+            if order == 'shuffle':
+                proxies = random.Random(args.seed).sample(proxies, len(proxies))
+            proxies, _ = tester.prepare_candidates(proxies, tester.proxy_files[proxy_type]['name'])
+            queues[proxy_type] = deque(proxies)
+        total = sum(len(q) for q in queues.values())
+        all_results = {t: ResultSink() for t in queues}
+        successful_results = {t: ResultSink() for t in queues}
+        if args.budget:
+            tester.deadline = clock() + args.budget
+
+        quotas, priorities = parse_type_map(args.quota), parse_type_map(args.priority)
+        if engine == 'async':
+            asyncio.set_event_loop_policy(VirtualTimePolicy(clock))
+            try:
+                asyncio.run(tester._async_schedule(queues, all_results, successful_results, total,
+                                                   quotas, priorities))
+            finally:
+                asyncio.set_event_loop_policy(None)
+        else:
+            tester._thread_schedule(queues, all_results, successful_results, total, concurrency,
+                                    quotas, priorities)
+
+    success_times = tester.success_times
+    found = len(success_times)
+    makespan = clock()
+    controller = tester.concurrency_runs[-1]
+    return {
+        'launched': tester.total_tested,
+        'successful': found,
+        'backoff': sum(stats.get('backoff_skipped', 0) for stats in tester.stage_stats.values()),
+        'makespan_s': makespan,
+        'per_minute': found / makespan * 60 if makespan else 0,
+        'first_s': success_times[0] if success_times else None,
+        't90_s': success_times[max(0, math.ceil(found * 0.9) - 1)] if success_times else None,
+        'final_limit': controller.limit,
+        'peak_limit': max(limit for _, limit in controller.history),
+        'early_kills': sum(tester.timeout_policy.kills.values()),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="虚拟时钟代理测试模拟器")
+    parser.add_argument("--journal", default=os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                          "result", "journal.jsonl"),
+                        help="提供分布的结果日志（默认result/journal.jsonl，不存在时用内置分布）")
+    parser.add_argument("--proxies", type=int, default=100_000, help="模拟代理数")
+    parser.add_argument("--engines", default="thread", help="调度引擎: thread,async")
+    parser.add_argument("--concurrency", default="80,200,500", help="初始并发数，逗号分隔")
+    parser.add_argument("--timeouts", default="3,5,8", help="探测超时（秒），逗号分隔")
+    parser.add_argument("--orders", default="fifo,history", help="调度顺序: fifo,shuffle,history")
+    parser.add_argument("--history-accuracy", type=float, default=0.8, help="合成历史中有效代理带有成功记录的比例")
+    parser.add_argument("--quota", default="", help="每类型最多同时占用的并发数，如 socks5=40,http=20")
+    parser.add_argument("--priority", default="", help="每类型优先级（越小越先），如 socks5=0,http=1")
+    parser.add_argument("--fixed-concurrency", action="store_true", help="关闭AIMD自适应并发")
+    parser.add_argument("--timeout-percentile", type=float, default=0, help="自适应超时的百分位（如95），默认0关闭")
+    parser.add_argument("--budget", type=float, default=None, help="时间预算（秒）")
+    parser.add_argument("--seed", type=int, default=1, help="随机种子")
+    args = parser.parse_args()
+
+    model = ProbeModel.from_journal(args.journal) if os.path.exists(args.journal) else None
+    source = args.journal
+    if model is None:
+        model, source = ProbeModel.default(), "内置分布"
+
+    print(f"\n🧮🧮🧮🧮 虚拟时钟模拟: {args.proxies:,} 个代理 | 分布来源: {source}")
+    model.describe()
+
+    plan = model.sample(args.proxies, args.seed)
+    orders = args.orders.split(',')
+    store = SimStore(plan, args.history_accuracy, args.seed) if 'history' in orders else None
+
+    header = (f"{'顺序':8s} {'引擎':6s} {'并发':>6s} {'超时':>5s} {'派发':>9s} {'成功':>8s} {'退避':>8s} "
+              f"{'总耗时':>9s} {'成功/分钟':>10s} {'首个':>8s} {'90%成功':>9s} {'并发末/峰':>10s} {'提前终止':>9s}")
+    print("\n" + "="*len(header))
+    print(header)
+    print("-"*len(header))
+
+    for order in orders:
+        for engine in args.engines.split(','):
+            for concurrency in (int(c) for c in args.concurrency.split(',')):
+                for timeout in (float(t) for t in args.timeouts.split(',')):
+                    stats = simulate(plan, order, engine, concurrency, timeout, args, store)
+                    first = f"{stats['first_s']:.1f}s" if stats['first_s'] is not None else '-'
+                    t90 = f"{stats['t90_s']:.0f}s" if stats['t90_s'] is not None else '-'
+                    limits = f"{stats['final_limit']}/{stats['peak_limit']}"
+                    print(f"{order:8s} {engine:6s} {concurrency:6d} {timeout:4.0f}s {stats['launched']:9,d} "
+                          f"{stats['successful']:8,d} {stats['backoff']:8,d} {stats['makespan_s']:8.0f}s "
+                          f"{stats['per_minute']:10.1f} {first:>8s} {t90:>9s} {limits:>10s} "
+                          f"{stats['early_kills']:9,d}", flush=True)
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())